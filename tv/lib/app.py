@@ -72,6 +72,12 @@ sharing_manager = None
 # SharingTracker instance
 sharing_tracker = None
 
+# TranscodeManager instance: decides when transcode jobs run
+transcode_manager = None
+
+# MediaInfoCache instance: remembers what ffmpeg says about media files
+media_info_cache = None
+
 # platform-specific device tracker
 device_tracker = None
 
@@ -27,11 +27,14 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import heapq
+import itertools
+from datetime import datetime
+
 from miro import app
 from miro import models
 from miro import prefs
 from miro import eventloop
-from datetime import datetime
 
 def _key_for_feed(feed):
     """Get the key to use for feed_pending_count and
@@ -44,13 +47,154 @@ def _key_for_feed(feed):
 
     return feed.origURL
 
+def _release_sort_key(item):
+    """Sort key that puts the newest items first."""
+    delta = item.get_pub_date_parsed() - datetime.min
+    return -delta.total_seconds()
+
+class PendingQueue(object):
+    """Pending downloads, indexed so we can quickly pick the next one.
+
+    Items are grouped by feed key.  Each key has a heap of its items,
+    newest first.  There's also a heap of keys, ordered by how many
+    downloads are running for the key, then by when we last started a
+    download for it.  Removed items and out of date feed entries are
+    dropped when they reach the top of their heap, so adding, removing and
+    picking the next download are all O(log n).
+
+    Keys can be "parked" to take them out of the running until something
+    changes that might let them download again (for example when a feed
+    has as many new items as it wants).  Items whose download didn't start
+    are deferred instead, so the rest of their feed can still download.
+    """
+    def __init__(self):
+        # item id -> (key, heap entry, item)
+        self.items = {}
+        # key -> heap of (sort key, counter, item id) entries
+        self.feed_items = {}
+        # key -> number of pending items
+        self.feed_count = {}
+        # key -> (running count, last start time)
+        self.feed_state = {}
+        # key -> current entry in feed_heap
+        self.feed_entry = {}
+        # heap of (running count, last start time, counter, key) entries
+        self.feed_heap = []
+        self.parked = set()
+        # item id -> (key, item, sort key) for deferred items
+        self.deferred = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.items) + len(self.deferred)
+
+    def __contains__(self, item_id):
+        return item_id in self.items or item_id in self.deferred
+
+    def add(self, key, item, sort_key):
+        if item.id in self:
+            self.remove(item.id)
+        entry = (sort_key, self.counter.next(), item.id)
+        self.items[item.id] = (key, entry, item)
+        heap = self.feed_items.setdefault(key, [])
+        heapq.heappush(heap, entry)
+        self.feed_count[key] = self.feed_count.get(key, 0) + 1
+        if key not in self.feed_entry and key not in self.parked:
+            self._push_feed(key)
+
+    def remove(self, item_id):
+        if item_id in self.deferred:
+            del self.deferred[item_id]
+            return
+        try:
+            key, entry, item = self.items.pop(item_id)
+        except KeyError:
+            return
+        self.feed_count[key] -= 1
+        if self.feed_count[key] == 0:
+            del self.feed_count[key]
+            del self.feed_items[key]
+        else:
+            heap = self.feed_items[key]
+            if len(heap) > 2 * self.feed_count[key] + 64:
+                self.feed_items[key] = [e for e in heap
+                                        if self._item_entry_valid(e)]
+                heapq.heapify(self.feed_items[key])
+
+    def defer(self, item_id):
+        """Set an item aside until retry_deferred() is called."""
+        key, entry, item = self.items[item_id]
+        self.remove(item_id)
+        self.deferred[item_id] = (key, item, entry[0])
+
+    def retry_deferred(self):
+        """Put all deferred items back in the queue."""
+        deferred = self.deferred
+        self.deferred = {}
+        for key, item, sort_key in deferred.values():
+            self.add(key, item, sort_key)
+
+    def update_feed(self, key, running_count, last_start):
+        self.feed_state[key] = (running_count, last_start)
+        if key in self.feed_entry:
+            self._push_feed(key)
+
+    def park(self, key):
+        self.parked.add(key)
+        self.feed_entry.pop(key, None)
+
+    def unpark(self, key):
+        if key in self.parked:
+            self.parked.remove(key)
+            if key in self.feed_count:
+                self._push_feed(key)
+
+    def next_feed(self):
+        """Get the key that we should start a download for next.
+
+        :returns: a key, or None if there's nothing to download
+        """
+        while self.feed_heap:
+            entry = self.feed_heap[0]
+            key = entry[3]
+            if self.feed_entry.get(key) is entry:
+                if key in self.feed_count:
+                    return key
+                del self.feed_entry[key]
+            heapq.heappop(self.feed_heap)
+        return None
+
+    def next_item(self, key):
+        """Get the newest pending item for a key."""
+        heap = self.feed_items[key]
+        while not self._item_entry_valid(heap[0]):
+            heapq.heappop(heap)
+        return self.items[heap[0][2]][2]
+
+    def _item_entry_valid(self, entry):
+        return (entry[2] in self.items and
+                self.items[entry[2]][1] is entry)
+
+    def _push_feed(self, key):
+        running_count, last_start = self.feed_state.get(key,
+                                                        (0, datetime.min))
+        entry = (running_count, last_start, self.counter.next(), key)
+        self.feed_entry[key] = entry
+        heapq.heappush(self.feed_heap, entry)
+        if len(self.feed_heap) > 2 * len(self.feed_entry) + 64:
+            self.feed_heap = self.feed_entry.values()
+            heapq.heapify(self.feed_heap)
+
 class Downloader:
+    # seconds to wait before retrying items whose download didn't start
+    RETRY_DELAY = 300
+
     def __init__(self, is_auto):
         self.dc = None
+        self.retry_dc = None
         self.paused = False
         self.running_count = 0
-        self.pending_count = 0
-        self.feed_pending_count = {}
+        self.pending = PendingQueue()
         self.feed_running_count = {}
         self.feed_time = {}
         self.is_auto = is_auto
@@ -86,6 +230,10 @@ class Downloader:
             self.new_items_tracker.connect('added', self.new_on_add)
             self.new_items_tracker.connect('removed', self.new_on_remove)
 
+    @property
+    def pending_count(self):
+        return len(self.pending)
+
     def update_max_downloads(self):
         if self.is_auto:
             newmax = app.config.get(prefs.DOWNLOADS_TARGET)
@@ -95,42 +243,58 @@ class Downloader:
             self.MAX = newmax
             self.start_downloads()
 
+    def feed_changed(self, feed):
+        """Call this when a feed's settings change in a way that might let
+        it download more items.
+        """
+        self.pending.unpark(_key_for_feed(feed))
+        self.pending.retry_deferred()
+        self.start_downloads()
+
+    def _feed_is_full(self, feed, key):
+        max_new = feed.get_max_new()
+        if max_new == u"unlimited":
+            return False
+        count = self.feed_running_count.get(key, 0) + feed.num_unwatched()
+        return count >= max_new
+
+    def _update_feed(self, key):
+        self.pending.update_feed(key, self.feed_running_count.get(key, 0),
+                                 self.feed_time.get(key, datetime.min))
+
     def start_downloads_idle(self):
         if self.paused:
             return
-        last_count = 0
-        while (self.running_count < self.MAX
-               and self.pending_count > 0
-               and self.pending_count != last_count):
-            last_count = self.pending_count
-            candidate_feeds = []
-            for feed in models.Feed.make_view():
-                key = _key_for_feed(feed)
-                if self.is_auto:
-                    max_new = feed.get_max_new()
-                    if max_new != "unlimited":
-                        count = (self.feed_new_count.get(feed, 0) +
-                                self.feed_running_count.get(key, 0) +
-                                feed.num_unwatched())
-                        if count >= max_new:
-                            continue
-                if self.feed_pending_count.get(key, 0) <= 0:
-                    continue
-                candidate_feeds.append((feed,
-                                        self.feed_running_count.get(key, 0),
-                                        self.feed_time.get(feed, datetime.min)))
-            candidate_feeds.sort(key=lambda x: (x[1], x[2]))
-
-            for feed, count, dummy in candidate_feeds:
-                if self.is_auto:
-                    feed.start_auto_download()
-                else:
-                    feed.start_manual_download()
-                self.feed_time[feed] = datetime.now()
-                if self.running_count >= self.MAX:
-                    break
+        while self.running_count < self.MAX:
+            key = self.pending.next_feed()
+            if key is None:
+                break
+            item = self.pending.next_item(key)
+            if self.is_auto and self._feed_is_full(item.get_feed(), key):
+                # wait until the feed has room for more items
+                self.pending.park(key)
+                continue
+            item.download(autodl=self.is_auto)
+            self.feed_time[key] = datetime.now()
+            self._update_feed(key)
+            if item.id in self.pending:
+                # the download didn't start.  Move on to the feed's other
+                # items and try this one again later.
+                self.pending.defer(item.id)
+                self._schedule_retry()
         self.dc = None
 
+    def _schedule_retry(self):
+        if self.retry_dc is None:
+            self.retry_dc = eventloop.add_timeout(self.RETRY_DELAY,
+                                                  self._retry_deferred,
+                                                  "Retry deferred downloads")
+
+    def _retry_deferred(self):
+        self.retry_dc = None
+        self.pending.retry_deferred()
+        self.start_downloads()
+
     def start_downloads(self):
         if self.dc or self.paused:
             return
@@ -140,27 +304,26 @@ class Downloader:
     def pending_on_add(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
-        self.pending_count = self.pending_count + 1
-        self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) + 1
+        self.pending.add(key, obj, _release_sort_key(obj))
         self.start_downloads()
 
     def pending_on_remove(self, tracker, obj):
-        feed = obj.get_feed()
-        key = _key_for_feed(feed)
-        self.pending_count = self.pending_count - 1
-        self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) - 1
+        self.pending.remove(obj.id)
 
     def running_on_add(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count + 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) + 1
+        self._update_feed(key)
 
     def running_on_remove(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count - 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) - 1
+        self._update_feed(key)
+        self.pending.unpark(key)
         self.start_downloads()
 
     def new_on_add(self, tracker, obj):
@@ -174,6 +337,7 @@ class Downloader:
         key = _key_for_feed(feed)
         self.new_count = self.new_count - 1
         self.feed_new_count[key] = self.feed_new_count.get(key, 0) - 1
+        self.pending.unpark(key)
         self.start_downloads()
 
     def pause(self):
@@ -109,6 +109,8 @@ class Controller:
         app.db.finish_transaction()
         if app.item_info_cache is not None:
             app.item_info_cache.save()
+        if app.media_info_cache is not None:
+            app.media_info_cache.close()
         logging.info("Closing Database...")
         if app.db is not None:
             app.db.close()
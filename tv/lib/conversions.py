@@ -31,21 +31,29 @@ import os
 import re
 import time
 import Queue
+import select
 import shutil
 import logging
 import tempfile
 import threading
 import subprocess
 import errno
+from hashlib import sha1
 
 from glob import glob
 from ConfigParser import SafeConfigParser, NoOptionError
 
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
 from miro import app
 from miro.download_utils import next_free_filename
 from miro import eventloop
 from miro import fileutil
 from miro import item
+from miro import mediainfocache
 from miro import models
 from miro import util
 from miro import prefs
@@ -53,11 +61,19 @@ from miro import signals
 from miro import messages
 from miro.gtcache import gettext as _
 from miro.fileobject import FilenameType
+from miro.util import returns_filename
 from miro.plat import utils
 from miro.plat import resources
 from miro.plat.popen import Popen
 
 NON_WORD_CHARS = re.compile(r"[^a-zA-Z0-9]+")
+LINE_SEPARATORS = re.compile(r"[\r\n]")
+
+def get_max_concurrent_conversions():
+    max_conversions = app.config.get(prefs.MAX_CONCURRENT_CONVERSIONS)
+    if max_conversions is None:
+        return utils.get_logical_cpu_count()
+    return int(max_conversions)
 
 
 def get_conversions_folder():
@@ -72,6 +88,230 @@ def get_conversions_folder():
     return target_folder
 
 
+class ConversionCache(object):
+    """Keeps the output of conversions around so they don't need to be done
+    again, for example when syncing the same item to two devices.
+
+    Files are named after a hash of the source path, size and mtime and the
+    converter settings, so an entry is only used while the source file is
+    unchanged.  When the cache grows larger than MAX_SIZE, the least
+    recently used files are deleted.
+    """
+    MAX_SIZE = 2 * (2 ** 30) # 2GB
+
+    def __init__(self):
+        self.hits = self.misses = 0
+
+    def get_directory(self):
+        # hidden, so that it doesn't get picked up as new files
+        return os.path.join(get_conversions_folder(), '.cache')
+
+    def get_key(self, input_path, converter_info):
+        """Get the cache key for converting a file.
+
+        Returns None if we can't cache it.
+        """
+        try:
+            stat = os.stat(input_path)
+        except OSError:
+            return None
+        settings = sha1(repr((converter_info.executable,
+                              converter_info.parameters,
+                              converter_info.extension,
+                              converter_info.screen_size,
+                              converter_info.bit_rate))).hexdigest()
+        if isinstance(input_path, unicode):
+            input_path = input_path.encode('utf-8')
+        key = sha1('%s\0%d\0%r\0%s\0%s' % (input_path, stat.st_size,
+                                              stat.st_mtime,
+                                              converter_info.identifier,
+                                              settings))
+        return "%s.%s" % (key.hexdigest(), converter_info.extension)
+
+    def get_path(self, key):
+        return os.path.join(self.get_directory(), key)
+
+    def lookup(self, key):
+        """Get the path to the cached output for key, or None."""
+        path = self.get_path(key)
+        try:
+            # the mtime tracks when the entry was last used
+            os.utime(path, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def add(self, key, path):
+        """Add the output of a conversion to the cache."""
+        directory = self.get_directory()
+        try:
+            if not os.path.exists(directory):
+                fileutil.makedirs(directory)
+            link_or_copy(path, self.get_path(key))
+        except (IOError, OSError):
+            logging.exception("error adding %s to the conversion cache",
+                              path)
+            return
+        self.prune()
+
+    def prune(self):
+        directory = self.get_directory()
+        entries = []
+        total_size = 0
+        for name in os.listdir(directory):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total_size += stat.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total_size <= self.MAX_SIZE:
+                break
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                logging.warn("error removing %s from the conversion cache",
+                             name)
+            else:
+                total_size -= size
+
+def link_or_copy(source, destination):
+    """Hard link source to destination if we can, otherwise copy it."""
+    if hasattr(os, 'link'):
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass # different filesystems, or it doesn't support links
+    shutil.copyfile(source, destination)
+
+@returns_filename
+def generate_conversion_stats_filename():
+    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+    return os.path.join(support_dir, 'conversionstats.sqlite')
+
+class ConversionStats(object):
+    """Learns how large the output of each converter is and how fast it runs
+    from the conversions that finished.
+
+    For each converter we keep a moving average of the bytes of output per
+    second of media and of the seconds of media converted per second.
+    Those are a lot better guesses than the bit rate in the converter
+    settings, which is only a target and is missing for most converters.
+    The numbers are kept in an sqlite file so they survive restarts.  Can
+    be used from any thread.
+    """
+
+    # how much a new conversion counts in the moving averages
+    WEIGHT = 0.3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+        # converter identifier -> (bytes_per_second, speed, samples)
+        self.stats = None
+
+    # At this point: lock acquired
+    def _ensure_loaded(self):
+        if self.stats is not None:
+            return
+        path = generate_conversion_stats_filename()
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            fileutil.makedirs(directory)
+        self.connection = sqlite3.connect(path, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS "
+                                "conversion_stats "
+                                "(converter TEXT PRIMARY KEY, "
+                                "bytes_per_second REAL, speed REAL, "
+                                "samples INTEGER)")
+        stats = {}
+        for row in self.connection.execute("SELECT converter, "
+                                           "bytes_per_second, speed, samples "
+                                           "FROM conversion_stats"):
+            stats[row[0]] = tuple(row[1:])
+        self.stats = stats
+
+    def get_stats(self, converter_id):
+        """Get (bytes_per_second, speed, samples) for a converter, or None if
+        it hasn't finished any conversions yet.
+        """
+        with self.lock:
+            try:
+                self._ensure_loaded()
+            except (sqlite3.Error, OSError):
+                logging.exception("Error reading conversion stats")
+                return None
+            return self.stats.get(converter_id)
+
+    def record(self, converter_id, media_duration, output_size, elapsed):
+        """Update the stats for a converter with a finished conversion.
+
+        :param media_duration: length of the media in seconds
+        :param output_size: size of the converted file in bytes
+        :param elapsed: how long the conversion took in seconds
+        """
+        if media_duration <= 0 or output_size <= 0 or elapsed <= 0:
+            return
+        bytes_per_second = float(output_size) / media_duration
+        speed = float(media_duration) / elapsed
+        with self.lock:
+            try:
+                self._ensure_loaded()
+                old = self.stats.get(converter_id)
+                if old is None:
+                    samples = 1
+                else:
+                    bytes_per_second = (self.WEIGHT * bytes_per_second +
+                                        (1 - self.WEIGHT) * old[0])
+                    speed = self.WEIGHT * speed + (1 - self.WEIGHT) * old[1]
+                    samples = old[2] + 1
+                self.stats[converter_id] = (bytes_per_second, speed, samples)
+                self.connection.execute("INSERT OR REPLACE INTO "
+                                        "conversion_stats (converter, "
+                                        "bytes_per_second, speed, samples) "
+                                        "VALUES (?, ?, ?, ?)",
+                                        (converter_id, bytes_per_second,
+                                         speed, samples))
+            except (sqlite3.Error, OSError):
+                logging.exception("Error writing conversion stats")
+
+    def estimate_size(self, converter_info, item_info):
+        """Guess the size of the output of converting an item."""
+        if converter_info is None:
+            return item_info.size
+        if item_info.duration:
+            stats = self.get_stats(converter_info.identifier)
+            if stats is not None:
+                return int(stats[0] * item_info.duration)
+            if converter_info.bit_rate:
+                return converter_info.bit_rate * item_info.duration / 8
+        return item_info.size
+
+    def estimate_time(self, converter_info, media_duration):
+        """Guess how many seconds converting media_duration seconds of media
+        takes.  Returns None if we have no idea.
+        """
+        if converter_info is None or not media_duration:
+            return None
+        stats = self.get_stats(converter_info.identifier)
+        if stats is None or stats[1] <= 0:
+            return None
+        return media_duration / stats[1]
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = None
+            self.stats = None
+
+
 class Node(object):
     def __init__(self, line="", children=None):
         self.line = line
@@ -223,15 +463,7 @@ def get_media_info(filepath):
     container, audio_codec, video_codec
     """
 
-    ffmpeg_bin = utils.get_ffmpeg_executable_path()
-    retcode, stdout, stderr = util.call_command(
-        ffmpeg_bin, "-i", "%s" % filepath,
-        return_everything=True)
-
-    if stdout:
-        output = stdout
-    else:
-        output = stderr
+    output = mediainfocache.get_ffmpeg_output(filepath)
 
     # logging.info("get_media_info: %s %s", filepath, output)
     ast = parse_ffmpeg_output(output.splitlines())
@@ -348,6 +580,9 @@ class ConversionManager(signals.SignalEmitter):
                                        'all-tasks-removed',
                                        )
         self.converters = ConverterManager()
+        self.output_reader = ProcessOutputReader()
+        self.cache = ConversionCache()
+        self.stats = ConversionStats()
         self.task_loop = None
         self.message_queue = Queue.Queue(-1)
         self.pending_tasks = list()
@@ -364,6 +599,7 @@ class ConversionManager(signals.SignalEmitter):
         if self.task_loop is not None:
             self.cancel_all()
             self.task_loop.join()
+        self.stats.close()
 
     def set_last_conversion(self, conversion_id):
         self.last_conversion_id = conversion_id
@@ -398,16 +634,49 @@ class ConversionManager(signals.SignalEmitter):
     def lookup_converter(self, converter_id):
         return self.converters.lookup_converter(converter_id)
 
+    def can_convert(self, converter_id):
+        """Check if _make_conversion_task() would return a task for a
+        converter, without setting one up.
+        """
+        if converter_id == 'copy':
+            return True
+        converter_info = self.converters.lookup_converter(converter_id)
+        return converter_info.executable in ('ffmpeg', 'ffmpeg2theora')
+
+    def get_output_size_guess(self, converter_id, item_info):
+        """Guess the size of the output of converting an item, without
+        setting up a ConversionTask for it.
+        """
+        if converter_id == 'copy':
+            return item_info.size
+        converter_info = self.converters.lookup_converter(converter_id)
+        return self.stats.estimate_size(converter_info, item_info)
+
     def start_conversion(self, converter_id, item_info, target_folder=None,
-                         create_item=True):
+                         create_item=True, device_sync=False):
+        """Start converting an item.
+
+        :param device_sync: the conversion is for a device sync.  These run
+                            before the other conversions.
+        """
         task = self._make_conversion_task(
             converter_id, item_info, target_folder, create_item)
+        if task is not None and task.converter_info is not None:
+            task.cache_key = self.cache.get_key(task.input_path,
+                                                task.converter_info)
+            if task.cache_key is not None:
+                cached_path = self.cache.lookup(task.cache_key)
+                if cached_path is not None:
+                    task = CachedConversionTask(task.converter_info,
+                                                item_info, target_folder,
+                                                create_item, cached_path)
         if ((task is not None
              and task.get_executable() is not None
              and not self._has_running_task(task.key)
              and not self._has_finished_task(task.key))):
+            task.device_sync = device_sync
             self._check_task_loop()
-            self.pending_tasks.append(task)
+            self._enqueue_message("add_task", task=task)
             self._notify_task_added(task)
 
         return task
@@ -447,45 +716,91 @@ class ConversionManager(signals.SignalEmitter):
             self.emit('begin-loop')
             self._run_loop_cycle()
             self.emit('end-loop')
-            time.sleep(0.5)
         logging.debug("Conversions manager thread loop finished.")
         self.task_loop = None
 
     def _run_loop_cycle(self):
-        self._process_message_queue()
+        # Everything that can change what we should be doing (new tasks,
+        # tasks finishing, requests from the frontend) comes in as a
+        # message, so just wait for the next one.
+        self._process_message(self.message_queue.get())
+        while not self.quit_flag:
+            try:
+                msg = self.message_queue.get_nowait()
+            except Queue.Empty:
+                break
+            self._process_message(msg)
+        if self.quit_flag:
+            return
 
         notify_count = False
-        max_concurrent_tasks = int(app.config.get(
-                prefs.MAX_CONCURRENT_CONVERSIONS))
-        if ((self.pending_tasks_count() > 0
-             and self.running_tasks_count() < max_concurrent_tasks)):
-            task = self.pending_tasks.pop()
-            if not self._has_running_task(task.key):
-                self.running_tasks.append(task)
-                task.run()
-                self._notify_task_changed(task)
+        while True:
+            started = self._start_pending_tasks()
+            finished = self._remove_finished_tasks()
+            if started or finished:
                 notify_count = True
+            if not finished:
+                break
+
+        if notify_count:
+            self._notify_tasks_count()
+
+    def _add_pending_task(self, task):
+        if task.device_sync:
+            # device syncs go after the other device syncs, but before
+            # everything else
+            for i, pending in enumerate(self.pending_tasks):
+                if not pending.device_sync:
+                    self.pending_tasks.insert(i, task)
+                    return
+        self.pending_tasks.append(task)
+
+    def _start_pending_tasks(self):
+        """Start pending tasks until all the slots are full.
 
+        Returns True if we started any tasks.
+        """
+        started = False
+        max_concurrent_tasks = get_max_concurrent_conversions()
+        while (self.pending_tasks and
+               self.running_tasks_count() < max_concurrent_tasks):
+            task = self.pending_tasks.pop(0)
+            if self._has_running_task(task.key):
+                continue
+            self.running_tasks.append(task)
+            task.run()
+            self._notify_task_changed(task)
+            started = True
+        return started
+
+    def _remove_finished_tasks(self):
+        """Move tasks that are done running to finished_tasks.
+
+        Returns True if there were any.
+        """
+        finished = False
         for task in list(self.running_tasks):
             if task.done_running():
                 self._notify_task_changed(task)
                 self.running_tasks.remove(task)
                 self.finished_tasks.append(task)
-                notify_count = True
+                finished = True
                 if task.is_finished():
                     self.schedule_staging(task.key)
+        return finished
 
-        if notify_count:
-            self._notify_tasks_count()
+    def _process_message(self, msg):
+        if msg['message'] == 'add_task':
+            self._add_pending_task(msg['task'])
 
-    def _process_message_queue(self):
-        try:
-            msg = self.message_queue.get_nowait()
-        except Queue.Empty:
-            return
+        elif msg['message'] == 'task_done':
+            # nothing to do here, _run_loop_cycle() will see that the task
+            # finished and start the next one.
+            pass
 
-        if msg['message'] == 'get_tasks_list':
+        elif msg['message'] == 'get_tasks_list':
             self._notify_tasks_list()
+            self._notify_tasks_count()
 
         elif msg['message'] == 'cancel':
             try:
@@ -538,13 +853,16 @@ class ConversionManager(signals.SignalEmitter):
                 destination, fp = next_free_filename(task.final_output_path)
                 fp.close()
             except ValueError:
-                logging.warn('_process_message_queue: ' 
+                logging.warn('_process_message: ' 
                              'next_free_filename failed.  Candidate = %r',
                              task.final_output_path)
                 return
             source_info = task.item_info
             conversion_name = task.get_display_name()
             if os.path.exists(source):
+                self._record_stats(task, source)
+                if task.cache_key is not None:
+                    self.cache.add(task.cache_key, source)
                 self._move_finished_file(source, destination)
                 if task.create_item:
                     _create_item_for_conversion(destination,
@@ -558,6 +876,20 @@ class ConversionManager(signals.SignalEmitter):
                 self._notify_tasks_count()
             self.emit('task-staged', task)
 
+    def _record_stats(self, task, output_path):
+        if task.end_time is None:
+            # the output came from the cache or was just copied
+            return
+        media_duration = task.duration or task.item_info.duration
+        try:
+            output_size = os.path.getsize(output_path)
+        except OSError:
+            return
+        if media_duration:
+            self.stats.record(task.converter_info.identifier,
+                              media_duration, output_size,
+                              task.end_time - task.start_time)
+
     def _move_finished_file(self, source, destination):
         try:
             shutil.move(source, destination)
@@ -648,7 +980,7 @@ class ConversionManager(signals.SignalEmitter):
         other_count = (self.failed_tasks_count() + self.pending_tasks_count() +
                 self.finished_tasks_count())
         message = messages.ConversionsCountChanged(running_count,
-                other_count)
+                other_count, self.cache.hits, self.cache.misses)
         message.send_to_frontend()
 
     def _terminate(self):
@@ -800,7 +1132,10 @@ class ConversionTask(object):
         self.create_item = create_item
 
         self.key = "%s->%s" % (self.input_path, self.final_output_path)
-        self.thread = None
+        self.device_sync = False
+        # set by ConversionManager if the output can go in the cache
+        self.cache_key = None
+        self.started = self.done = False
         self.duration = None
         self.progress = 0
         self.log_path = None
@@ -808,6 +1143,12 @@ class ConversionTask(object):
         self.process_handle = None
         self.error = None
         self.start_time = time.time()
+        # set when the conversion process exits
+        self.end_time = None
+        # output that didn't end with a newline yet
+        self.output_buffer = ''
+        # False once we've seen an error or the end of the conversion
+        self.wants_output = True
 
     def get_executable(self):
         raise NotImplementedError()
@@ -816,46 +1157,71 @@ class ConversionTask(object):
         raise NotImplementedError()
 
     def get_output_size_guess(self):
-        if self.item_info.duration and self.converter_info.bit_rate:
-            return self.converter_info.bit_rate * self.item_info.duration / 8
-        return self.item_info.size
+        return conversion_manager.stats.estimate_size(self.converter_info,
+                                                      self.item_info)
 
     def get_display_name(self):
         return self.converter_info.displayname
 
     def run(self):
+        """Start the conversion process.
+
+        conversion_manager.output_reader takes care of the output from
+        there.
+        """
         logging.debug("temp_output_path: [%s] final_output_path: [%s]",
                       self.temp_output_path, self.final_output_path)
 
         self.progress = 0
-        self.thread = threading.Thread(target=utils.thread_body,
-                                       args=[self._loop],
-                                       name="Conversion Task")
-        self.thread.setDaemon(True)
-        self.thread.start()
+        self.started = True
+        self.start_time = time.time()
+        try:
+            self._start_process()
+        except StandardError:
+            logging.exception("Exception starting conversion")
+            self.error = _("Reason unknown--check log")
+        if self.process_handle is None:
+            self._finish()
+        else:
+            conversion_manager.output_reader.add(self)
 
     def get_eta(self):
         """Calculates the eta for this conversion to be completed.
 
-        :returns: None if progress is <= 0, otherwise returns number
+        Early on, the progress of a conversion says little about how long
+        the rest will take, so we go by how fast the converter was in the
+        past and trust the progress more as it grows.
+
+        :returns: None if we can't tell, otherwise returns number
             of seconds until this is complete
         """
+        elapsed = time.time() - self.start_time
+        predicted = None
+        if self.started:
+            total = conversion_manager.stats.estimate_time(
+                self.converter_info, self.duration or self.item_info.duration)
+            if total is not None:
+                predicted = max(total - elapsed, 0)
+
         if self.progress <= 0:
-            return None
+            if predicted is None:
+                return None
+            return int(predicted)
 
-        progress = self.progress * 100
-        duration = time.time() - self.start_time
-        time_per_percent = duration / progress
-        return int(time_per_percent * (100 - progress))
+        extrapolated = elapsed / self.progress * (1 - self.progress)
+        if predicted is None:
+            return int(extrapolated)
+        return int(self.progress * extrapolated +
+                   (1 - self.progress) * predicted)
 
     def is_pending(self):
-        return self.thread is None
+        return not self.started
 
     def is_running(self):
-        return self.thread is not None and self.thread.isAlive()
+        return self.started and not self.done
 
     def done_running(self):
-        return self.thread is not None and not self.thread.isAlive()
+        return self.done
 
     def is_finished(self):
         return self.done_running() and not self.is_failed()
@@ -866,7 +1232,7 @@ class ConversionTask(object):
                  self.process_handle.returncode is not None and
                  self.process_handle.returncode != 0))
 
-    def _loop(self):
+    def _start_process(self):
         executable = self.get_executable()
         args = self.get_parameters()
         self._start_logging(executable, args)
@@ -875,16 +1241,13 @@ class ConversionTask(object):
 
         logging.debug("Conversion: (%s)", " ".join(args))
 
-        kwargs = {"bufsize": 1,
+        kwargs = {"bufsize": 0,
                   "stdout": subprocess.PIPE,
                   "stderr": subprocess.STDOUT,
                   "stdin": subprocess.PIPE,
                   "close_fds": True}
         try:
             self.process_handle = Popen(args, **kwargs)
-            self.process_output(line_reader(self.process_handle.stdout))
-            self.process_handle.wait()
-
         except OSError, ose:
             if ose.errno == errno.ENOENT:
                 self.error = _("%(program)s does not exist.",
@@ -893,34 +1256,70 @@ class ConversionTask(object):
                 logging.exception("Exception in conversion loop: %s %s",
                                   args, kwargs)
 
-        finally:
+    def handle_output(self, data):
+        """Handle a chunk of output from the conversion process.
+
+        An empty string means that the process closed its output.
+        """
+        lines = LINE_SEPARATORS.split(self.output_buffer + data)
+        if data:
+            self.output_buffer = lines.pop()
+        else:
+            self.output_buffer = ''
+        for line in lines:
+            if self.wants_output:
+                self.wants_output = self.process_line(line)
+        if not data:
+            self._finish()
+
+    def _finish(self):
+        if self.process_handle is not None:
+            try:
+                self.process_handle.wait()
+            except OSError:
+                # interrupt() got there first
+                pass
+        self.end_time = time.time()
+        if self.log_file is not None:
             self._stop_logging(self.progress < 1.0)
-            if self.is_failed():
-                conversion_manager._notify_task_failed(self)
-                conversion_manager._notify_tasks_count()
+        if self.is_failed():
+            conversion_manager._notify_task_failed(self)
+            conversion_manager._notify_tasks_count()
+        self.done = True
+        # wake up the conversion manager so it starts the next task
+        conversion_manager._enqueue_message("task_done", key=self.key)
 
     def process_output(self, lines_generator):
         """Takes a function that's a generator of lines, iterates
         through the lines and checks for progress and errors.
         """
         for line in lines_generator():
-            old_progress = self.progress
+            if not self.process_line(line):
+                break
 
-            line = line.strip()
-            self._log_progress(line)
+    def process_line(self, line):
+        """Check a line of output for progress and errors.
 
-            error = self.check_for_errors(line)
-            if error:
-                self.error = error
-                break
+        Returns False once we don't care about the rest of the output.
+        """
+        old_progress = self.progress
 
-            self.progress = self.monitor_progress(line)
-            if self.progress >= 1.0:
-                self.progress = 1.0
-                break
+        line = line.strip()
+        self._log_progress(line)
+
+        error = self.check_for_errors(line)
+        if error:
+            self.error = error
+            return False
 
-            if old_progress != self.progress:
-                self._notify_progress()
+        self.progress = self.monitor_progress(line)
+        if self.progress >= 1.0:
+            self.progress = 1.0
+            return False
+
+        if old_progress != self.progress:
+            self._notify_progress()
+        return True
 
     def _start_logging(self, executable, params):
         log_folder = os.path.dirname(app.config.get(prefs.LOG_PATHNAME))
@@ -972,6 +1371,86 @@ class ConversionTask(object):
                 clean_up(self.temp_output_path, file_and_directory=True)
 
 
+class ProcessOutputReader(object):
+    """Reads the output of the running conversion processes.
+
+    Where select() works on pipes, one thread reads the output for every
+    process.  On windows it doesn't, so each process gets a thread of its
+    own.
+    """
+    CHUNK_SIZE = 4096
+    use_select = (os.name != 'nt')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {} # file descriptor -> ConversionTask
+        self.thread = None
+        # written to when tasks changes so that select() notices
+        self.wake_up_pipe = None
+
+    def add(self, task):
+        fd = task.process_handle.stdout.fileno()
+        if not self.use_select:
+            thread = threading.Thread(target=utils.thread_body,
+                                      args=[self._read_loop, task, fd],
+                                      name="Conversion Output")
+            thread.setDaemon(True)
+            thread.start()
+            return
+        self.lock.acquire()
+        try:
+            self.tasks[fd] = task
+            if self.wake_up_pipe is None:
+                self.wake_up_pipe = os.pipe()
+            if self.thread is None:
+                self.thread = threading.Thread(target=utils.thread_body,
+                                               args=[self._select_loop],
+                                               name="Conversion Output")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            else:
+                os.write(self.wake_up_pipe[1], 'x')
+        finally:
+            self.lock.release()
+
+    def _read_loop(self, task, fd):
+        data = None
+        while data != '':
+            data = os.read(fd, self.CHUNK_SIZE)
+            task.handle_output(data)
+
+    def _select_loop(self):
+        wake_up_fd = self.wake_up_pipe[0]
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.tasks:
+                    self.thread = None
+                    return
+                fds = self.tasks.keys()
+            finally:
+                self.lock.release()
+            try:
+                readable = select.select(fds + [wake_up_fd], [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                if fd == wake_up_fd:
+                    os.read(wake_up_fd, self.CHUNK_SIZE)
+                    continue
+                data = os.read(fd, self.CHUNK_SIZE)
+                if not data:
+                    self.lock.acquire()
+                    try:
+                        task = self.tasks.pop(fd)
+                    finally:
+                        self.lock.release()
+                else:
+                    task = self.tasks[fd]
+                task.handle_output(data)
+
 def line_reader(handle):
     """Builds a line reading generator for the given handle.  This
     generator breaks on empty strings, \\r and \\n.
@@ -1022,6 +1501,34 @@ class CopyConversionTask(ConversionTask):
         return bool(self.progress)
 
 
+class CachedConversionTask(CopyConversionTask):
+    """Gets the output of a conversion from the ConversionCache."""
+    def __init__(self, converter_info, item_info, target_folder, create_item,
+                 cached_path):
+        ConversionTask.__init__(self, converter_info, item_info,
+                                target_folder, create_item)
+        self.cached_path = cached_path
+
+    def get_output_size_guess(self):
+        try:
+            return os.path.getsize(self.cached_path)
+        except OSError:
+            return ConversionTask.get_output_size_guess(self)
+
+    def get_display_name(self):
+        return self.converter_info.displayname
+
+    def run(self):
+        try:
+            link_or_copy(self.cached_path, self.temp_output_path)
+        except (IOError, OSError):
+            logging.exception("error copying %s from the conversion cache",
+                              self.cached_path)
+            self.error = _("Reason unknown--check log")
+            conversion_manager._notify_task_failed(self)
+        self.progress = 1
+
+
 class FFMpegConversionTask(ConversionTask):
     DURATION_RE = re.compile(r'Duration: (\d\d):(\d\d):(\d\d)\.(\d\d)'
                              '(, start:.*)?(, bitrate:.*)?')
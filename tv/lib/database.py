@@ -634,12 +634,13 @@ class DDBObject(signals.SignalEmitter):
 
     @classmethod
     def select(cls, columns, where=None, values=None, convert=True,
-               db_info=None):
+               db_info=None, joins=None):
         if db_info is None:
             db = app.db
         else:
             db = db_info.db
-        return db.select(cls, columns, where, values, convert=convert)
+        return db.select(cls, columns, where, values, joins=joins,
+                         convert=convert)
 
     def setup_new(self):
         """Initialize a newly created object."""
@@ -158,11 +158,20 @@ def alter_table_columns(cursor, table, delete_columns, rename_columns,
 
 def get_object_tables(cursor):
     """Returns a list of tables that store ``DDBObject`` subclasses.
+
+    Tables without an id column, like the device_item and device_data
+    tables on devices, are left out.
     """
     cursor.execute("SELECT name FROM sqlite_master "
             "WHERE type='table' AND name != 'dtv_variables' AND "
             "name NOT LIKE 'sqlite%'")
-    return [row[0] for row in cursor]
+    tables = [row[0] for row in cursor]
+    object_tables = []
+    for table in tables:
+        cursor.execute("PRAGMA table_info('%s')" % table)
+        if 'id' in [row[1] for row in cursor]:
+            object_tables.append(table)
+    return object_tables
 
 def get_next_id(cursor):
     """Calculate the next id to assign to new rows.
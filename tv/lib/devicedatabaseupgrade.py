@@ -33,7 +33,12 @@ import itertools
 import logging
 import os.path
 import shutil
+import sqlite3
 import urllib
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 from miro import app
 from miro import databaseupgrade
@@ -275,3 +280,51 @@ class _do_import_old_items(object):
         self.insert_into_metadata_status(path, file_type, 0, STATUS_NOT_RUN,
                                          STATUS_NOT_RUN, STATUS_NOT_RUN,
                                          False, 0)
+
+def import_json_database(live_storage, json_db, mount):
+    """Move the data from the JSON database into SQLite.
+
+    Device items get a row in the device_item table and the other top-level
+    keys get a row in device_data (see devices.DeviceDatabaseStore).  We only
+    copy the data if both tables are empty, after that the JSON file is just
+    an export for older versions.  This also means that if the SQLite
+    database gets reset we start again from the latest export.
+
+    Returns True if the tables are ready to use.
+    """
+    cursor = live_storage.cursor
+    cursor.execute("BEGIN TRANSACTION")
+    try:
+        cursor.execute("CREATE TABLE IF NOT EXISTS device_item ("
+                       "file_type TEXT NOT NULL, path TEXT NOT NULL, "
+                       "data TEXT NOT NULL, PRIMARY KEY (file_type, path))")
+        cursor.execute("CREATE TABLE IF NOT EXISTS device_data ("
+                       "key TEXT PRIMARY KEY NOT NULL, data TEXT NOT NULL)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS directory_fingerprint ("
+                       "path TEXT PRIMARY KEY NOT NULL, mtime REAL NOT NULL, "
+                       "entries INTEGER NOT NULL)")
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM device_item) OR "
+                       "EXISTS (SELECT 1 FROM device_data)")
+        if not cursor.fetchone()[0]:
+            _do_import_json_database(cursor, json_db)
+        cursor.execute("COMMIT TRANSACTION")
+    except StandardError:
+        logging.exception('exception while moving JSON db from %s to SQLite',
+                          mount)
+        try:
+            cursor.execute("ROLLBACK TRANSACTION")
+        except sqlite3.Error:
+            pass
+        return False
+    return True
+
+def _do_import_json_database(cursor, json_db):
+    for key, value in json_db.iteritems():
+        if key not in (u'audio', u'video', u'other'):
+            cursor.execute("INSERT INTO device_data (key, data) "
+                           "VALUES (?, ?)", (key, json.dumps(value)))
+        elif isinstance(value, dict):
+            cursor.executemany("INSERT INTO device_item "
+                               "(file_type, path, data) VALUES (?, ?, ?)",
+                               [(key, path, json.dumps(data))
+                                for path, data in value.iteritems()])
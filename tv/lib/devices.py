@@ -36,9 +36,12 @@ except ImportError:
 import codecs
 import logging
 import os, os.path
+import random
 import re
+import stat
 import time
-import bisect
+import heapq
+import threading
 try:
     from collections import Counter
 except ImportError:
@@ -64,6 +67,7 @@ from miro import messages
 from miro import schema
 from miro import signals
 from miro import storedatabase
+from miro import syncplanner
 from miro import conversions
 from miro.util import check_u
 
@@ -71,12 +75,16 @@ from miro.download_utils import next_free_filename
 
 from miro.plat import resources
 from miro.plat.utils import (filename_to_unicode, unicode_to_filename,
-                             utf8_to_filename)
+                             utf8_to_filename, thread_body)
 
 
 # how much slower converting a file is, compared to copying
 CONVERSION_SCALE = 500
 
+# how much more we want rated and unwatched items when auto-filling a device
+RATING_WEIGHT = 0.2
+UNWATCHED_WEIGHT = 1.5
+
 def unicode_to_path(path):
     """
     Convert a Unicode string into a file path.  We don't do any of the string
@@ -575,6 +583,151 @@ class DeviceManager(object):
             dsm.set_device(device)
             return dsm
 
+class DeviceCopier(object):
+    """
+    Copies files to a device in a thread of its own, so that syncing doesn't
+    depend on how busy the event loop is.
+
+    Files are copied one at a time, in order of their source path, so that
+    files which are likely to be next to each other on disk are read one
+    after the other.  Each one is written to a .part file which is renamed
+    to the destination once it has been flushed to the device; cancelled or
+    failed copies are removed, along with the (empty) destination file.
+
+    progress_callback(progress) is called in the event loop every
+    PROGRESS_INTERVAL seconds while copying, with a dict of key -> bytes
+    copied so far.  finished_callback(dest, success) is called in the event
+    loop once for each copy() call, including ones that were cancelled.
+    """
+    MIN_BLOCK_SIZE = 256 * 1024
+    MAX_BLOCK_SIZE = 16 * 1024 * 1024
+    # Block size is adjusted so that each block takes about this long.  That
+    # keeps cancelling quick however fast the device is.
+    BLOCK_TIME = 0.25
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, name, progress_callback, finished_callback):
+        self.name = name
+        self.progress_callback = progress_callback
+        self.finished_callback = finished_callback
+        self.lock = threading.Lock()
+        self.queue = [] # heap of (source, dest, key)
+        self.thread = None
+        # set while the copy thread isn't running
+        self.idle = threading.Event()
+        self.idle.set()
+        self.cancelled = False
+        self.progress = {}
+        self.last_progress = 0
+        self.block_size = self.MIN_BLOCK_SIZE
+
+    def copy(self, source, dest, key):
+        with self.lock:
+            if self.cancelled:
+                self._remove(dest)
+                self._copy_finished(dest, False)
+                return
+            heapq.heappush(self.queue, (source, dest, key))
+            if self.thread is None:
+                self.idle.clear()
+                self.thread = threading.Thread(target=thread_body,
+                                               args=[self.thread_loop],
+                                               name='Device Copier (%s)' %
+                                               self.name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def cancel(self):
+        """Stop copying.  The copy in progress and the files which haven't
+        been copied yet are removed by the copy thread.
+        """
+        with self.lock:
+            self.cancelled = True
+
+    def wait(self, timeout=None):
+        """Wait for the copy thread to run out of work.  Returns False if
+        it's still running after timeout seconds.
+        """
+        self.idle.wait(timeout)
+        return self.idle.isSet()
+
+    def thread_loop(self):
+        while True:
+            with self.lock:
+                if self.cancelled or not self.queue:
+                    pending = self.queue
+                    self.queue = []
+                    self.thread = None
+                    break
+                source, dest, key = heapq.heappop(self.queue)
+            success = self._copy(source, dest, key)
+            self._copy_finished(dest, success)
+        for source, dest, key in pending:
+            self._remove(dest)
+            self._copy_finished(dest, False)
+        with self.lock:
+            # copy() may have started another thread in the meantime
+            if self.thread is None:
+                self.idle.set()
+
+    def _copy_finished(self, dest, success):
+        eventloop.add_idle(self.finished_callback, 'device copy finished',
+                           args=(dest, success))
+
+    def _copy(self, source, dest, key):
+        part_path = dest + '.part'
+        self.progress[key] = 0
+        try:
+            with file(source, 'rb') as input:
+                with file(part_path, 'wb') as output:
+                    while not self.cancelled:
+                        start = time.time()
+                        data = input.read(self.block_size)
+                        if not data:
+                            break
+                        self._write(output, data)
+                        self._adjust_block_size(time.time() - start)
+                        self._report_progress(key, len(data))
+                    else:
+                        raise IOError('copy cancelled')
+                    output.flush()
+                    os.fsync(output.fileno())
+            if os.path.exists(dest):
+                os.remove(dest)
+            os.rename(part_path, dest)
+        except EnvironmentError, e:
+            if not self.cancelled:
+                logging.warn('error copying %r to %r: %s', source, dest, e)
+            self._remove(part_path)
+            self._remove(dest)
+            return False
+        finally:
+            del self.progress[key]
+        return True
+
+    def _write(self, output, data):
+        output.write(data)
+
+    def _adjust_block_size(self, elapsed):
+        if elapsed < self.BLOCK_TIME / 2:
+            self.block_size = min(self.block_size * 2, self.MAX_BLOCK_SIZE)
+        elif elapsed > self.BLOCK_TIME * 2:
+            self.block_size = max(self.block_size / 2, self.MIN_BLOCK_SIZE)
+
+    def _report_progress(self, key, count):
+        self.progress[key] += count
+        now = time.time()
+        if now - self.last_progress >= self.PROGRESS_INTERVAL:
+            self.last_progress = now
+            eventloop.add_idle(self.progress_callback, 'device copy progress',
+                               args=(dict(self.progress),))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            pass
+
 class DeviceSyncManager(object):
     """
     Represents a sync to a given device.
@@ -594,7 +747,7 @@ class DeviceSyncManager(object):
         self.waiting = set()
         self.stopping = False
         self._change_timeout = None
-        self._copy_iter_running = False
+        self.copier = None
         self._info_to_conversion = {}
         self.started = False
 
@@ -639,23 +792,16 @@ class DeviceSyncManager(object):
 
         # check for expired items
         if sync[u'podcasts'].get(u'expire', True):
+            feed_urls = {} # feed URL -> URLs of the items still in its view
             for file_type in (u'audio', u'video'):
                 for info in itemsource.DeviceItemSource(self.device,
                                                         file_type).fetch_all():
                     if (info.feed_url and info.file_url and
                         info.feed_url in url_to_view):
-                        view = url_to_view[info.feed_url]
-                        new_view = database.View(
-                            view.fetcher,
-                            view.where + (' AND (rd.origURL=? OR rd.url=? '
-                                          'OR item.url=?)'),
-                            view.values + (info.file_url, info.file_url,
-                                           info.file_url),
-                            view.order_by,
-                            view.joins,
-                            view.limit,
-                            view.db_info)
-                        if not new_view.count():
+                        if info.feed_url not in feed_urls:
+                            feed_urls[info.feed_url] = self._get_view_urls(
+                                url_to_view[info.feed_url])
+                        if info.file_url not in feed_urls[info.feed_url]:
                             expired.add(info)
         if max_size is not None and infos:
             for info in expired:
@@ -670,64 +816,94 @@ class DeviceSyncManager(object):
                     infos.remove(i)
         return infos, expired
 
+    @staticmethod
+    def _get_view_urls(view):
+        """Returns the set of URLs that the items in view were downloaded
+        from, using one query for the whole view.
+        """
+        urls = set()
+        for row in item.Item.select(['rd.origURL', 'rd.url', 'item.url'],
+                                    view.where, view.values,
+                                    joins=view.joins, convert=False,
+                                    db_info=view.db_info):
+            urls.update(url for url in row if url)
+        return urls
+
     def get_auto_items(self, size):
         """
         Returns a list of ItemInfos to be automatically synced to the device.
         The items should be roughly 'size' bytes.
+
+        Each candidate gets a value from the auto-fill settings, its rating
+        and whether it's been watched, and syncplanner picks the items that
+        are worth the most and fit.
         """
         sync = self.device.database[u'sync']
         if not sync.get(u'auto_fill', False):
             return []
 
-        name_to_view = {
-            u'recent_music': item.Item.watchable_audio_view(),
-            u'random_music': item.Item.watchable_audio_view(),
-            u'most_played_music': item.Item.watchable_audio_view(),
-            u'new_playlists': playlist.SavedPlaylist.make_view(),
-            u'recent_podcasts': item.Item.toplevel_view()
-            }
-
-        name_to_view[u'recent_music'].order_by = 'item.id DESC'
-        name_to_view[u'random_music'].order_by = 'RANDOM()'
-        name_to_view[u'most_played_music'].order_by = 'item.play_count DESC'
-        name_to_view[u'new_playlists'].order_by = 'playlist.id DESC'
-        name_to_view[u'recent_podcasts'].where = (
-            '%s AND item.filename NOT IN (NULL, "")' % (
-                name_to_view[u'recent_podcasts'].where,))
-        name_to_view[u'recent_podcasts'].order_by = 'item.id DESC'
-
         scores = sync.get(u'auto_fill_settings', {})
-        total = float(sum(scores.setdefault(name, 0.5)
-                          for name in name_to_view))
-
-        sizes = dict((name, int(size * scores[name] / total))
-                     for name in name_to_view)
-
-        auto_syncs = {}
-        for name, view in name_to_view.items():
-            auto_syncs[name] = syncs = set()
-            remaining = sizes[name]
-            if name == u'new_playlists':
-                for playlist_ in view:
-                    playlist_view = item.Item.playlist_view(playlist_.id)
-                    infos = itemsource.DatabaseItemSource(
-                        playlist_view).fetch_all()
-                    size = self.get_sync_size(infos)[1]
-                    if size and size < remaining:
-                        for info in infos:
-                            info.auto_sync = True
-                        syncs.update(infos)
-                        remaining -= size
-            else:
-                source = itemsource.DatabaseItemSource(view)
-                for info in source.fetch_all():
-                    size = self.get_sync_size([info])[1]
-                    if size and size < remaining:
-                        info.auto_sync = True
-                        syncs.add(info)
-                        remaining -= size
+        weights = dict((name, float(scores.get(name, 0.5)))
+                       for name in (u'recent_music', u'random_music',
+                                    u'most_played_music', u'new_playlists',
+                                    u'recent_podcasts'))
+        total = sum(weights.values())
+        if not total:
+            return []
+
+        source = itemsource.DatabaseItemSource(item.Item.watchable_view())
+        try:
+            infos = [info for info in source.fetch_all()
+                     if not self.device.database.item_exists(info)]
+        finally:
+            source.unlink()
+        if not infos:
+            return []
 
-        return set().union(*auto_syncs.values())
+        # item id -> id of the newest playlist it's in
+        item_playlists = {}
+        for item_id, playlist_id in playlist.PlaylistItemMap.select(
+            ['item_id', 'playlist_id'], convert=False):
+            if playlist_id > item_playlists.get(item_id, -1):
+                item_playlists[item_id] = playlist_id
+        # newest playlist -> 1.0, oldest -> close to 0
+        playlist_ids = sorted(set(item_playlists.values()))
+        playlist_recency = dict(
+            (playlist_id, float(index + 1) / len(playlist_ids))
+            for index, playlist_id in enumerate(playlist_ids))
+        most_plays = max(info.play_count or 0 for info in infos) or 1
+
+        candidates = []
+        infos.sort(key=lambda info: info.id)
+        for index, info in enumerate(infos):
+            # newest item -> 1.0, oldest -> close to 0
+            recency = float(index + 1) / len(infos)
+            podcast = bool(info.feed_url and
+                           not info.feed_url.startswith('dtv:'))
+            value = 0.0
+            if info.file_type == u'audio' and not podcast:
+                value += (weights[u'recent_music'] * recency +
+                          weights[u'random_music'] * random.random() +
+                          weights[u'most_played_music'] *
+                          (info.play_count or 0) / most_plays)
+            elif podcast:
+                value += weights[u'recent_podcasts'] * recency
+                if not info.video_watched:
+                    value *= UNWATCHED_WEIGHT
+            if info.id in item_playlists:
+                value += (weights[u'new_playlists'] *
+                          playlist_recency[item_playlists[info.id]])
+            rating = info.rating or info.auto_rating
+            if rating:
+                value *= 1 + RATING_WEIGHT * (rating - 3)
+            if value > 0:
+                candidates.append((self.get_sync_size([info])[1],
+                                   value / total, info))
+
+        auto_items = syncplanner.plan_fill(candidates, size)[0]
+        for info in auto_items:
+            info.auto_sync = True
+        return auto_items
 
     def get_sync_size(self, items, expired=None):
         """
@@ -749,15 +925,14 @@ class DeviceSyncManager(object):
             items = items_for_converter.pop('copy')
             count += len(items)
             size += sum(info.size for info in items)
+        conversion_manager = conversions.conversion_manager
         for converter, items in items_for_converter.items():
+            if not conversion_manager.can_convert(converter):
+                continue
             for info in items:
-                task = conversions.conversion_manager._make_conversion_task(
-                    converter, info,
-                    target_folder=None,
-                    create_item=False)
-                if task:
-                    count += 1
-                    size += task.get_output_size_guess()
+                count += 1
+                size += conversion_manager.get_output_size_guess(converter,
+                                                                 info)
         if expired:
             count += len(expired)
             size -= sum(i.size for i in expired)
@@ -809,41 +984,18 @@ class DeviceSyncManager(object):
         ``sizes_and_items`` is a list of (size, item) tuples.  This function
         yields the items that need to be removed.
 
-        The algorithm we use is:
-        * Sort all the auto items by their size
-        * While we need more space:
-            * bisect the sorted sizes with the size we've got left
-            * If there's an exact match, remove it and we're done
-            * Otherwise, remove the item around the insertion point which is
-              closest and try again with the new remaining size
+        We keep the items that fill as much as possible of what's left once
+        ``size`` is taken away, so we remove as little as we can.
         """
-        sizes_and_items.sort()
-        keys = [i[0] for i in sizes_and_items]
-        def remove_(index):
-            keys.pop(index)
-            return sizes_and_items.pop(index)
-
-        while size >= 0 and keys:
-            left = bisect.bisect_left(keys, size)
-            if left == size: # perfect fit!
-                s, i = remove_(left)
-                yield i
-                break
-            right = bisect.bisect_right(keys, size)
-            if left == right == len(keys):
-                s, i = remove_(len(keys) - 1)
-                size -= s
+        total = sum(s for s, i in sizes_and_items)
+        keep, kept_size = syncplanner.plan_fill(
+            [(s, s, index) for index, (s, i) in enumerate(sizes_and_items)],
+            total - size)
+        keep = set(keep)
+        for index, (s, i) in enumerate(sizes_and_items):
+            if s > 0 and index not in keep:
                 yield i
-                continue
-            if (abs(left - size) < abs(right - size)): # left is closer
-                s, i = remove_(left)
-                size -= s
-                yield i
-            else:
-                s, i = remove_(right)
-                size -= s
-                yield i
-        
+
     def expire_auto_items(self, size):
         """
         Expires automatically synced items.
@@ -984,60 +1136,42 @@ class DeviceSyncManager(object):
                         signal, callback))
 
         task = start_conversion(conversion, info, target,
-                                create_item=False)
+                                create_item=False, device_sync=True)
         self.total_size[task.key] = (task.get_output_size_guess() *
                                      CONVERSION_SCALE)
         self.waiting.add(task.key)
 
     def copy_file(self, info, final_path):
-        if (info, final_path) in self.copying:
+        if self.stopping:
+            return
+        if final_path in self.copying:
             logging.warn('tried to copy %r twice', info)
             return
         file(final_path, 'w').close() # create the file so that future tries
                                       # will see it
         self.copying[final_path] = info
         self.total_size[info.id] = info.size
-        if not self._copy_iter_running:
-            self._copy_iter_running = True
-            eventloop.idle_iterate(self._copy_as_iter,
-                                   'copying files to device')
-
-    def _copy_as_iter(self):
-        while self.copying:
-            final_path, info = self.copying.popitem()
-            iterable = fileutil.copy_with_progress(info.video_path, final_path,
-                                                   block_size=128 * 1024)
-            try:
-                for count in iterable:
-                    self.progress_size[info.id] += count
-                    if self.stopping:
-                        iterable.close()
-                        eventloop.add_idle(fileutil.delete,
-                                           "deleting canceled sync",
-                                           args=(final_path,))
-                        final_path = None
-                        break
-                    # let other stuff run
-                    self._schedule_sync_changed()
-                    yield
-            except IOError:
-                final_path = None
-            if final_path:
-                self._add_item(final_path, info)
-            # don't throw off the progress bar; we're done so pretend we got
-            # all the bytes
-            self.progress_size[info.id] = self.total_size[info.id]
-            self.finished += 1
-            self._check_finished()
-            if self.stopping:
-                break # no more copies
-            yield
-        for final_path in self.copying:
-            # canceled the sync, so remove the non-synced files
-            eventloop.add_idle(fileutil.delete,
-                               "deleting canceled sync",
-                               args=(final_path,))
-        self._copy_iter_running = False
+        if self.copier is None:
+            self.copier = DeviceCopier(self.device.name,
+                                       self._copy_progress_callback,
+                                       self._copy_finished_callback)
+        self.copier.copy(info.video_path, final_path, info.id)
+
+    def _copy_progress_callback(self, progress):
+        if self.stopping:
+            return
+        self.progress_size.update(progress)
+        self._schedule_sync_changed()
+
+    def _copy_finished_callback(self, final_path, success):
+        info = self.copying.pop(final_path)
+        if success:
+            self._add_item(final_path, info)
+        # don't throw off the progress bar; we're done so pretend we got
+        # all the bytes
+        self.progress_size[info.id] = self.total_size[info.id]
+        self.finished += 1
+        self._check_finished()
 
     def _conversion_changed_callback(self, conversion_manager, task):
         total = self.total_size[task.key]
@@ -1187,41 +1321,205 @@ class DeviceSyncManager(object):
             return
         for key in self.waiting:
             conversions.conversion_manager.cancel(key)
-        self.stopping = True # kill in-progress copies
+        self.stopping = True
+        if self.copier is not None:
+            # kill in-progress copies; the copier removes the files
+            self.copier.cancel()
         self._send_sync_changed()
         self._send_sync_finished()
 
+class DeviceDatabaseView(object):
+    """A dictionary inside a DeviceDatabase.
+
+    Looking up a dictionary in a DeviceDatabase returns one of these instead
+    of the stored dictionary, so that changes made through it get tracked by
+    the database.  Views are created when they're needed and don't hold any
+    data of their own; the database itself only keeps plain dictionaries, so
+    a device with a lot of items doesn't cost us an object per item.
+
+    Like with dicts, the values you get from items() and values() are the
+    stored ones, use [] to change them.
+    """
+    __slots__ = ('root', 'key_path', 'data')
+    __hash__ = None
+
+    def __init__(self, root, key_path, data):
+        self.root = root
+        # keys leading from the root database to this one
+        self.key_path = key_path
+        self.data = data
+
+    def _wrap(self, key, value):
+        if isinstance(value, dict):
+            return DeviceDatabaseView(self.root, self.key_path + (key,),
+                                      value)
+        return value
+
+    def __getitem__(self, key):
+        check_u(key)
+        return self._wrap(key, self.data[key])
+
+    def __setitem__(self, key, value):
+        check_u(key)
+        if isinstance(value, DeviceDatabaseView):
+            value = value.data
+        self.data[key] = value
+        self.root._key_changed(self.key_path + (key,))
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.root._key_changed(self.key_path + (key,))
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, DeviceDatabaseView):
+            other = other.data
+        return self.data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'DeviceDatabaseView(%r, %r)' % (self.key_path, self.data)
+
+    def get(self, key, default=None):
+        if key in self.data:
+            return self._wrap(key, self.data[key])
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self.data:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        had_key = key in self.data
+        value = self.data.pop(key, *args)
+        if had_key:
+            self.root._key_changed(self.key_path + (key,))
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def clear(self):
+        for key in self.data.keys():
+            del self[key]
+
+    def copy(self):
+        return self.data.copy()
+
+    def has_key(self, key):
+        return key in self.data
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
+
+    def iterkeys(self):
+        return self.data.iterkeys()
+
+    def itervalues(self):
+        return self.data.itervalues()
+
+    def iteritems(self):
+        return self.data.iteritems()
+
 class DeviceDatabase(dict, signals.SignalEmitter):
-    def __init__(self, data=None, parent=None):
+    """The data Miro keeps about a device: its items, sync settings, etc.
+
+    Items are kept in plain dictionaries, database[file_type][path].  Nested
+    dictionaries are returned as DeviceDatabaseViews, which report changes
+    back here.  The changed items are kept in dirty_items/dirty_types, so
+    DeviceDatabaseStore can write just those.
+    """
+    def __init__(self, data=None):
         if data:
             dict.__init__(self, data)
             self.created_new = False
         else:
             dict.__init__(self)
             self.created_new = True
+        # path -> [mtime, entry count] for the directories we scanned last
+        # time, see walk_changed_directories().  These are kept out of the
+        # dictionary so that they only get written when a scan finishes.
+        self.directory_fingerprints = dict.pop(
+            self, u'directory_fingerprints', {})
         signals.SignalEmitter.__init__(self, 'changed', 'item-added',
                                        'item-changed', 'item-removed')
-        self.parent = parent
         self.changing = False
         self.bulk_mode = False
         self.did_change = False
+        # Indexes for item_exists(), built the first time it's called.
+        # They are kept up to date by the item-* signals.
+        self._url_index = None          # (file type, url) -> set of paths
+        self._signature_index = None    # (file type, signature) -> paths
+        self._indexed = None            # path -> (file type, url, signature)
+        # What changed since the last write to the SQLite store.
+        self.dirty_items = set()        # (file type, path) pairs
+        self.dirty_types = set()        # file types that were replaced
+        self.store = None
+
+    def _wrap(self, key, value):
+        if isinstance(value, dict):
+            return DeviceDatabaseView(self, (key,), value)
+        return value
 
     def __getitem__(self, key):
         check_u(key)
-        value = super(DeviceDatabase, self).__getitem__(key)
-        if isinstance(value, dict) and not isinstance(value, DeviceDatabase):
-            value = DeviceDatabase(value, self.parent or self)
-             # don't trip the changed signal
-            super(DeviceDatabase, self).__setitem__(key, value)
-        return value
+        return self._wrap(key, dict.__getitem__(self, key))
 
     def __setitem__(self, key, value):
         check_u(key)
-        super(DeviceDatabase, self).__setitem__(key, value)
-        if self.parent:
-            self.parent.notify_changed()
-        else:
-            self.notify_changed()
+        if isinstance(value, DeviceDatabaseView):
+            value = value.data
+        dict.__setitem__(self, key, value)
+        self._key_changed((key,))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._key_changed((key,))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._wrap(key, dict.__getitem__(self, key))
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        had_key = key in self
+        value = dict.pop(self, key, *args)
+        if had_key:
+            self._key_changed((key,))
+        return value
+
+    def _key_changed(self, key_path):
+        if key_path[0] in (u'audio', u'video', u'other'):
+            if len(key_path) == 1:
+                self.dirty_types.add(key_path[0])
+            else:
+                self.dirty_items.add(key_path[:2])
+        # other keys are small, DeviceDatabaseStore compares them all when
+        # it writes
+        self.notify_changed()
 
     def notify_changed(self):
         self.did_change = True
@@ -1238,29 +1536,146 @@ class DeviceDatabase(dict, signals.SignalEmitter):
         if not bulk and self.did_change:
             self.notify_changed()
 
+    def attach_store(self, store):
+        """Use a DeviceDatabaseStore to save this database.
+
+        Our contents are replaced with what's in the store.
+        """
+        dict.clear(self)
+        dict.update(self, store.load())
+        # older versions kept these in device_data, the next write deletes
+        # that row
+        old_fingerprints = dict.pop(self, u'directory_fingerprints', {})
+        self.directory_fingerprints = (store.load_fingerprints() or
+                                       old_fingerprints)
+        self._indexed = None
+        self.dirty_items = set()
+        self.dirty_types = set()
+        self.store = store
+
+    def detach_store(self):
+        self.store = None
+
+    def set_directory_fingerprints(self, fingerprints):
+        """Remember the directory fingerprints from a finished scan.
+
+        They are written to the store straight away.  Without a store they
+        are only kept in memory.
+        """
+        self.directory_fingerprints = fingerprints
+        if self.store is not None:
+            self.store.write_fingerprints(fingerprints)
+
+    def pop_dirty(self):
+        """Get the changes since the last call and forget about them.
+
+        Returns a (dirty_items, dirty_types) tuple.
+        """
+        dirty = (self.dirty_items, self.dirty_types)
+        self.dirty_items = set()
+        self.dirty_types = set()
+        return dirty
+
     # XXX does this belong here?
     def item_exists(self, item_info):
-        """Checks if the given ItemInfo exists in our database.  Should only be
-        called on the parent database.
+        """Checks if the given ItemInfo exists in our database.
+
+        An item exists if a device item has the same URL or, if a bunch of
+        qualities are the same, we'll call it close enough.
         """
-        if self.parent:
-            raise RuntimeError('item_exists() called on sub-dictionary')
         if item_info.file_type not in self:
             return False
-        for existing in self[item_info.file_type].values():
-            if (item_info.file_url and
-                existing.get('url') == item_info.file_url):
-                return True
-            if ((item_info.name, item_info.description, item_info.size,
-                 item_info.duration * 1000 if item_info.duration
-                 else None) ==
-                  (existing.get('title'), existing.get('description'),
-                   existing.get('size'), existing.get('duration'))):
-                # if a bunch of qualities are the same, we'll call it close
-                # enough
+        self._ensure_indexes()
+        if (item_info.file_url and
+            self._index_lookup(self._url_index, item_info.file_type,
+                               item_info.file_url)):
+            return True
+        signature = (item_info.name, item_info.description, item_info.size,
+                     item_info.duration * 1000 if item_info.duration
+                     else None)
+        return self._index_lookup(self._signature_index, item_info.file_type,
+                                  signature)
+
+    @staticmethod
+    def _item_signature(data):
+        return (data.get('title'), data.get('description'), data.get('size'),
+                data.get('duration'))
+
+    def _ensure_indexes(self):
+        if self._indexed is not None:
+            return
+        self._url_index = {}
+        self._signature_index = {}
+        self._indexed = {}
+        for file_type in (u'audio', u'video', u'other'):
+            items = dict.get(self, file_type)
+            if isinstance(items, dict):
+                for path, data in items.iteritems():
+                    self._index_item(file_type, path, data)
+
+    def _index_item(self, file_type, path, data):
+        self._unindex_item(path)
+        if not isinstance(data, dict):
+            return
+        url = data.get('url')
+        signature = self._item_signature(data)
+        if url:
+            self._url_index.setdefault((file_type, url), set()).add(path)
+        self._signature_index.setdefault((file_type, signature),
+                                         set()).add(path)
+        self._indexed[path] = (file_type, url, signature)
+
+    def _unindex_item(self, path):
+        try:
+            file_type, url, signature = self._indexed.pop(path)
+        except KeyError:
+            return
+        for index, key in ((self._url_index, (file_type, url)),
+                           (self._signature_index, (file_type, signature))):
+            paths = index.get(key)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del index[key]
+
+    def _index_lookup(self, index, file_type, key):
+        # Some code deletes items without sending item-removed (for example
+        # clean_database()), so make sure what we find is still there.
+        items = dict.get(self, file_type)
+        if not isinstance(items, dict):
+            return False
+        for path in list(index.get((file_type, key), ())):
+            data = items.get(path)
+            if not isinstance(data, dict):
+                self._unindex_item(path)
+            elif (self._indexed.get(path) ==
+                  (file_type, data.get('url'), self._item_signature(data))):
                 return True
+            else:
+                self._index_item(file_type, path, data)
         return False
 
+    def _reindex_item(self, device_item):
+        if self._indexed is None:
+            return
+        try:
+            data = dict.__getitem__(self,
+                                    device_item.file_type)[device_item.id]
+        except (KeyError, TypeError):
+            self._unindex_item(device_item.id)
+        else:
+            self._index_item(device_item.file_type, device_item.id, data)
+
+    def do_item_added(self, device_item):
+        self._reindex_item(device_item)
+
+    def do_item_changed(self, device_item):
+        self._reindex_item(device_item)
+
+    def do_item_removed(self, device_item):
+        if self._indexed is not None:
+            self._unindex_item(device_item.id)
+
     def _find_item_data(self, path):
         """Find the data for an item in the database
 
@@ -1291,9 +1706,99 @@ class DatabaseWriteManager(object):
                                                      self.write,
                                                      'writing device database')
     def write(self):
-        write_database(self.database, self.mount)
+        if self.database.store is None:
+            write_database(self.database, self.mount)
+        elif os.path.exists(self.mount):
+            self.database.store.write(self.database)
         self.database = self.scheduled_write = None
 
+class DeviceDatabaseStore(object):
+    """
+    Stores a DeviceDatabase in the SQLite database on the device.
+
+    Each device item gets a row in the device_item table, the other top-level
+    keys get a row in device_data.  Values are stored as JSON.  This means we
+    only need to write the rows that changed, rather than the whole database.
+    The directory fingerprints get a row per directory in
+    directory_fingerprint, written when a scan finishes.
+    """
+    def __init__(self, live_storage):
+        self.live_storage = live_storage
+        # key -> JSON for the device_data rows
+        self.written_data = {}
+
+    def load(self):
+        cursor = self.live_storage.cursor
+        # clean_database() creates these anyways
+        data = {u'audio': {}, u'video': {}, u'other': {}}
+        cursor.execute("SELECT key, data FROM device_data")
+        for key, value in cursor.fetchall():
+            data[key] = json.loads(value)
+            self.written_data[key] = value
+        cursor.execute("SELECT file_type, path, data FROM device_item")
+        for file_type, path, value in cursor.fetchall():
+            data.setdefault(file_type, {})[path] = json.loads(value)
+        return data
+
+    def write(self, database):
+        execute = self.live_storage._execute
+        dirty_items, dirty_types = database.pop_dirty()
+        for file_type in dirty_types:
+            execute("DELETE FROM device_item WHERE file_type=?",
+                    (file_type,), is_update=True)
+            items = dict.get(database, file_type)
+            if isinstance(items, dict) and items:
+                execute("INSERT INTO device_item (file_type, path, data) "
+                        "VALUES (?, ?, ?)",
+                        [(file_type, path, json.dumps(data))
+                         for path, data in items.iteritems()],
+                        is_update=True, many=True)
+        for file_type, path in dirty_items:
+            if file_type in dirty_types:
+                continue
+            items = dict.get(database, file_type)
+            if isinstance(items, dict) and path in items:
+                execute("REPLACE INTO device_item (file_type, path, data) "
+                        "VALUES (?, ?, ?)",
+                        (file_type, path, json.dumps(items[path])),
+                        is_update=True)
+            else:
+                execute("DELETE FROM device_item "
+                        "WHERE file_type=? AND path=?", (file_type, path),
+                        is_update=True)
+        # The rest of the keys are small, and sometimes get changed without
+        # going through DeviceDatabase (setdefault(), in-place changes to
+        # lists), so check them all.
+        keys = set(database) - set((u'audio', u'video', u'other'))
+        for key in keys:
+            value = json.dumps(dict.__getitem__(database, key), sort_keys=True)
+            if self.written_data.get(key) != value:
+                execute("REPLACE INTO device_data (key, data) VALUES (?, ?)",
+                        (key, value), is_update=True)
+                self.written_data[key] = value
+        for key in set(self.written_data) - keys:
+            execute("DELETE FROM device_data WHERE key=?", (key,),
+                    is_update=True)
+            del self.written_data[key]
+        self.live_storage.finish_transaction()
+
+    def load_fingerprints(self):
+        cursor = self.live_storage.cursor
+        cursor.execute("SELECT path, mtime, entries "
+                       "FROM directory_fingerprint")
+        return dict((path, [mtime, entries])
+                    for path, mtime, entries in cursor.fetchall())
+
+    def write_fingerprints(self, fingerprints):
+        execute = self.live_storage._execute
+        execute("DELETE FROM directory_fingerprint", (), is_update=True)
+        execute("INSERT INTO directory_fingerprint (path, mtime, entries) "
+                "VALUES (?, ?, ?)",
+                [(path, mtime, entries)
+                 for path, (mtime, entries) in fingerprints.iteritems()],
+                is_update=True, many=True)
+        self.live_storage.finish_transaction()
+
 def load_database(mount, countdown=0):
     """
     Returns a dictionary of the JSON database that lives on the given device.
@@ -1395,6 +1900,10 @@ def load_sqlite_database(mount, json_db, device_size, countdown=0,
                          mount, device_db_version)
 
     devicedatabaseupgrade.import_old_items(live_storage, json_db, mount)
+    if (path != ':memory:' and
+        devicedatabaseupgrade.import_json_database(live_storage, json_db,
+                                                   mount)):
+        json_db.attach_store(DeviceDatabaseStore(live_storage))
     return live_storage
 
 def calc_sqlite_preallocate_size(device_size):
@@ -1437,11 +1946,16 @@ def on_new_metadata(metadata_manager, new_metadata, device_id):
                              path)
                 continue
             # check if we got a new file type
-            if 'file_type' in metadata:
-                file_type = metadata.pop('file_type')
+            new_file_type = metadata.pop('file_type', file_type)
             # combine the old data with the new data for the device item
             all_data = item_data.copy()
             all_data.update(metadata)
+            if new_file_type == file_type and all_data == item_data:
+                # Nothing new.  This happens a lot when a device with many
+                # items gets plugged in, skip the work of updating the item
+                # and sending it to the frontend.
+                continue
+            file_type = new_file_type
             # FIXME: can we avoid building a new DeviceItem here?
             device_item = item.DeviceItem(video_path=path,
                                           device=device,
@@ -1455,12 +1969,17 @@ def write_database(db, mount):
     """
     Writes the given dictionary to the device.
 
-    The database lives at [MOUNT]/.miro/json
+    The database lives at [MOUNT]/.miro/json.  If the database is kept in the
+    SQLite database, this saves any pending changes there and writes the JSON
+    as an export for older versions of Miro.
     """
     database.confirm_db_thread()
     if not os.path.exists(mount):
         # device disappeared, so we can't write to it
         return
+    store = getattr(db, 'store', None)
+    if store is not None:
+        store.write(db)
     try:
         fileutil.makedirs(os.path.join(mount, '.miro'))
     except OSError:
@@ -1474,10 +1993,20 @@ def write_database(db, mount):
         # XXX throw up an error?
         pass
 
-def clean_database(device):
+def clean_database(device, seen=None):
+    """Remove items whose files are gone from the device database.
+
+    :param seen: normcase()d paths that we know exist, for example from
+                 walk_changed_directories().  We only check the disk for
+                 other items.
+
+    Returns the set of normcase()d paths for the remaining items.
+    """
+    if seen is None:
+        seen = set()
     def _exists(item_path):
-        return os.path.exists(os.path.join(device.mount,
-                                           item_path))
+        return (os.path.normcase(item_path) in seen or
+                os.path.exists(os.path.join(device.mount, item_path)))
     known_files = set()
     to_remove = []
     for item_type in (u'video', u'audio', u'other'):
@@ -1508,16 +2037,87 @@ def on_mount(info):
         message.send_to_backend()
     scan_device_for_files(info)
 
+def _skip_file(name):
+    # same rules as fileutil.miro_allfiles()
+    name_lower = name.lower()
+    return (name.startswith('.') or name_lower == 'thumbs.db' or
+            name_lower == "incomplete downloads")
+
+def walk_changed_directories(mount, old_fingerprints, fingerprints, seen):
+    """Find the files in directories that changed since the last scan.
+
+    A directory's fingerprint is a [mtime, entry count] list, stored by its
+    path relative to mount.  If it matches old_fingerprints, the directory
+    has the same files as last time, so we only look at the subdirectories
+    we found last time, without a stat() for each file.
+
+    New fingerprints are added to fingerprints and the normcase()d relative
+    paths of every file and directory we listed are added to seen.
+
+    Yields the relative paths of files in the changed directories.  Also
+    yields None after each directory so that callers can let other stuff
+    run.
+    """
+    subdirectories = {}
+    for upath in old_fingerprints:
+        if upath:
+            subdirectories.setdefault(os.path.dirname(upath), []).append(upath)
+    checked = set()
+    to_scan = [(u'', utf8_to_filename(''))]
+    while to_scan:
+        upath, path = to_scan.pop()
+        if path is None:
+            path = utf8_to_filename(upath.encode('utf8'))
+        full_path = os.path.join(mount, path)
+        real_path = os.path.realpath(full_path)
+        if real_path in checked:
+            continue
+        checked.add(real_path)
+        try:
+            mtime = os.stat(full_path).st_mtime
+            listing = os.listdir(full_path)
+        except OSError:
+            logging.debug('OSError walking directory; continuing', exc_info=1)
+            # make sure we look at the parent directory next time, otherwise
+            # we'd never look at this one again.
+            fingerprints.pop(os.path.dirname(upath), None)
+            continue
+        fingerprint = [mtime, len(listing)]
+        fingerprints[upath] = fingerprint
+        names = [name for name in listing if not _skip_file(name)]
+        for name in names:
+            seen.add(os.path.normcase(os.path.join(path, name)))
+        if old_fingerprints.get(upath) == fingerprint:
+            to_scan.extend((child, None)
+                           for child in subdirectories.get(upath, ()))
+        else:
+            for name in names:
+                child = os.path.join(path, name)
+                try:
+                    # one stat() tells us both if it's a directory or a file
+                    mode = os.stat(os.path.join(mount, child)).st_mode
+                except OSError:
+                    continue
+                if stat.S_ISDIR(mode):
+                    if not fileutil.is_file_bundle(os.path.join(mount,
+                                                                child)):
+                        to_scan.append((filename_to_unicode(child), child))
+                elif stat.S_ISREG(mode):
+                    yield child
+        yield None
+
 @eventloop.idle_iterator
 def scan_device_for_files(device):
     # XXX is this as_idle() safe?
 
     # prepare paths to add
     logging.debug('starting scan on %s', device.mount)
-    known_files = clean_database(device)
     item_data = []
     start = time.time()
-    filenames = []
+    old_fingerprints = device.database.directory_fingerprints
+    fingerprints = {}
+    seen = set()
+    finished = True
     def _stop():
         if not app.device_manager.running: # user quit, so we will too
             logging.debug('stopping scan on %s: user quit', device.mount)
@@ -1531,25 +2131,29 @@ def scan_device_for_files(device):
             return True
         return False
 
-    for filename in fileutil.miro_allfiles(device.mount):
-        short_filename = filename[len(device.mount):]
-        ufilename = filename_to_unicode(short_filename)
-        item_type = None
-        if os.path.normcase(short_filename) in known_files:
-            continue
-        if filetypes.is_video_filename(ufilename):
-            item_type = u'video'
-        elif filetypes.is_audio_filename(ufilename):
-            item_type = u'audio'
-        if item_type is not None:
-            item_data.append((ufilename, item_type))
-            filenames.append(filename)
+    for short_filename in walk_changed_directories(device.mount,
+                                                   old_fingerprints,
+                                                   fingerprints, seen):
+        if short_filename is not None:
+            ufilename = filename_to_unicode(short_filename)
+            item_type = None
+            if filetypes.is_video_filename(ufilename):
+                item_type = u'video'
+            elif filetypes.is_audio_filename(ufilename):
+                item_type = u'audio'
+            if item_type is not None:
+                item_data.append((short_filename, ufilename, item_type))
         if time.time() - start > 0.3:
             yield # let other stuff run
             if _stop():
+                finished = False
                 break
             start = time.time()
-            filenames = []
+
+    known_files = clean_database(device, seen)
+    item_data = [(ufilename, item_type)
+                 for short_filename, ufilename, item_type in item_data
+                 if os.path.normcase(short_filename) not in known_files]
 
     if app.device_manager.running and os.path.exists(device.mount):
         # we don't re-check if the device is hidden because we still want to
@@ -1569,11 +2173,16 @@ def scan_device_for_files(device):
                 device.database.set_bulk_mode(False) # save the database
                 yield # let other idle functions run
                 if _stop():
+                    finished = False
                     break
                 device.database.set_bulk_mode(True)
                 start = time.time()
 
         device.database.set_bulk_mode(False)
+        if finished:
+            # only now do we know that the items for every file in the
+            # unchanged directories are in the database
+            device.database.set_directory_fingerprints(fingerprints)
 
 def create_item_for_file(device, video_path, file_type):
     i = item.DeviceItem(video_path=video_path,
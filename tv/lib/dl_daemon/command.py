@@ -151,6 +151,12 @@ class ShutDownResponseCommand(Command):
     def action(self):
         self.daemon.shutdown_response()
 
+class RestoreDownloadersDone(Command):
+    """The downloader daemon finished handling a RestoreDownloadersCommand.
+    """
+    def action(self):
+        app.download_state_manager.restore_batch_done(*self.args)
+
 #############################################################################
 #  App to Downloader commands                                               #
 #############################################################################
@@ -219,6 +225,19 @@ class DownloaderBatchCommand(Command):
         if mark_reply:
             download.DOWNLOAD_UPDATER.set_cmds_done()
  
+class RestoreDownloadersCommand(Command):
+    """Restore a batch of downloaders.
+
+    DownloadStateManager sends these a few at a time at startup and waits
+    for the RestoreDownloadersDone replies before sending more.
+    """
+    def action(self):
+        from miro.dl_daemon import download
+        batch_id, restores = self.args
+        for dlid, downloader in restores:
+            download.restore_downloader(downloader)
+        RestoreDownloadersDone(self.daemon, batch_id, len(restores)).send()
+
 class MigrateDownloadCommand(Command):
     def action(self):
         from miro.dl_daemon import download
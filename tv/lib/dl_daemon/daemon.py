@@ -324,6 +324,8 @@ class ControllerDaemon(Daemon):
             self.shutdown = True
             self._remove_config_callback()
             self._remove_httpauth_callback()
+            # the daemon will never finish the restores we sent it
+            app.download_state_manager.requeue_restores()
 
     def shutdown_timeout_cb(self):
         logging.warning("killing download daemon")
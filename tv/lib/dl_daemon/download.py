@@ -37,6 +37,12 @@ import datetime
 import logging
 import tempfile
 import base64
+import heapq
+import itertools
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
 
 from miro.gtcache import gettext as _
 
@@ -55,6 +61,7 @@ from miro import prefs
 
 from miro.dl_daemon import command
 from miro.dl_daemon import daemon
+from miro.dl_daemon.trackers import TRACKER_CACHE
 from miro.util import (
     check_f, check_u, stringify, MAX_TORRENT_SIZE, returns_filename,
     info_hash_from_magnet, is_magnet_uri)
@@ -181,6 +188,7 @@ def startup():
     logging.info("Starting downloaders")
     DOWNLOAD_UPDATER.start_updates()
     TORRENT_SESSION.startup()
+    TRACKER_CACHE.startup()
 
 def shutdown():
     logging.info("Shutting down downloaders...")
@@ -188,6 +196,9 @@ def shutdown():
         _downloads[dlid].shutdown()
     logging.info("Shutting down torrent session...")
     TORRENT_SESSION.shutdown()
+    TRACKER_CACHE.shutdown()
+    logging.info("Writing fast resume data...")
+    FAST_RESUME_STORE.close()
     # Flush the status updates.
     logging.info('flushing status updates...')
     DOWNLOAD_UPDATER.flush_update()
@@ -377,21 +388,94 @@ class TorrentSession(object):
         self.torrents.add(downloader)
         info_hash = info_hash_to_long(downloader.torrent.info_hash())
         self.info_hash_to_downloader[info_hash] = downloader
+        TRACKER_CACHE.add_torrent(downloader.info_hash,
+                [t['url'] for t in downloader.torrent.trackers()])
 
     def remove_torrent(self, downloader):
         if downloader in self.torrents:
             self.torrents.remove(downloader)
             info_hash = info_hash_to_long(downloader.torrent.info_hash())
             del self.info_hash_to_downloader[info_hash]
+            TRACKER_CACHE.remove_torrent(downloader.info_hash)
 
     def update_torrents(self):
         # Copy this set into a list in case any of the torrents gets
         # removed during the iteration.
         for torrent in [x for x in self.torrents]:
             torrent.update_status()
+        RECHECK_QUEUE.update()
 
 TORRENT_SESSION = TorrentSession()
 
+class RecheckQueue(object):
+    """Limits how many torrents check their existing files at once.
+
+    Restored torrents whose fast resume data doesn't match the files on
+    disk have to be rechecked by libtorrent.  Doing all of them at once
+    thrashes the disk, so those torrents get added paused and we resume
+    them here, CHECKS_PER_DISK at a time for each device.  Torrents that
+    were active most recently get checked first.
+    """
+
+    CHECKS_PER_DISK = 1
+
+    def __init__(self):
+        # maps disks to heaps of (priority, counter, downloader) tuples.
+        # Entries for downloaders that were removed stay in the heap until
+        # they get popped.
+        self.waiting_by_disk = {}
+        # maps waiting downloaders to (counter, disk)
+        self.waiting = {}
+        # maps downloaders being checked to the disk they are on
+        self.checking = {}
+        self.counter = itertools.count()
+
+    def add(self, downloader):
+        counter = self.counter.next()
+        disk = downloader.get_disk()
+        self.waiting[downloader] = (counter, disk)
+        heapq.heappush(self.waiting_by_disk.setdefault(disk, []),
+                       (downloader.get_recheck_priority(), counter,
+                        downloader))
+        self.update()
+
+    def remove(self, downloader):
+        if downloader in self.checking:
+            del self.checking[downloader]
+        else:
+            self.waiting.pop(downloader, None)
+        self.update()
+
+    def is_waiting(self, downloader):
+        return downloader in self.waiting
+
+    def is_queued(self, downloader):
+        return downloader in self.checking or downloader in self.waiting
+
+    def update(self):
+        for downloader in self.checking.keys():
+            if not downloader.is_checking_files():
+                del self.checking[downloader]
+
+        checks_per_disk = {}
+        for disk in self.checking.values():
+            checks_per_disk[disk] = checks_per_disk.get(disk, 0) + 1
+        for disk, heap in self.waiting_by_disk.items():
+            while heap and (checks_per_disk.get(disk, 0) <
+                            self.CHECKS_PER_DISK):
+                priority, counter, downloader = heapq.heappop(heap)
+                if self.waiting.get(downloader, (None,))[0] != counter:
+                    # removed, or added again later
+                    continue
+                del self.waiting[downloader]
+                checks_per_disk[disk] = checks_per_disk.get(disk, 0) + 1
+                self.checking[downloader] = disk
+                downloader.start_recheck()
+            if not heap:
+                del self.waiting_by_disk[disk]
+
+RECHECK_QUEUE = RecheckQueue()
+
 class DownloadStatusUpdater(object):
     """Handles updating status for all in progress downloaders.
 
@@ -958,6 +1042,11 @@ class HTTPDownloader(BGDownloader):
 
 @returns_filename
 def generate_fast_resume_filename(info_hash):
+    """Get the path of the old-style per-torrent fast resume file.
+
+    Fast resume data now lives in the FastResumeStore, but we still
+    read these files so that data saved by older versions isn't lost.
+    """
     filename = PlatformFilenameType(clean_filename(info_hash) + ".fastresume")
 
     support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
@@ -965,9 +1054,156 @@ def generate_fast_resume_filename(info_hash):
 
     return fast_resume_file
 
+@returns_filename
+def generate_fast_resume_db_filename():
+    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+    return os.path.join(support_dir, 'fastresume.sqlite')
+
+class FastResumeStore(object):
+    """Stores fast resume data for all torrents in a single sqlite file.
+
+    Writes are queued up and committed together in a single transaction
+    every FLUSH_INTERVAL seconds, so seeding hundreds of torrents doesn't
+    cost hundreds of small writes.  Since each flush is an sqlite
+    transaction, a crash can never leave truncated data behind.
+
+    The first lookup reads the data for every torrent with a single query,
+    which makes restoring lots of torrents at startup cheap.
+    """
+
+    FLUSH_INTERVAL = 10
+
+    def __init__(self):
+        self.lock = RLock()
+        self.connection = None
+        self.path = None
+        # info_hash -> data waiting to be written.  None means delete.
+        self.pending = {}
+        # info_hash -> data for everything in the database
+        self.cache = None
+        self.flush_dc = None
+
+    def _ensure_connection(self):
+        path = generate_fast_resume_db_filename()
+        if self.connection is not None and path == self.path:
+            return
+        self._disconnect()
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            fileutil.makedirs(directory)
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fast_resume "
+                                "(info_hash TEXT PRIMARY KEY, data BLOB)")
+
+    def _ensure_cache(self):
+        self._ensure_connection()
+        if self.cache is None:
+            cursor = self.connection.execute(
+                "SELECT info_hash, data FROM fast_resume")
+            self.cache = dict((info_hash, str(data))
+                              for info_hash, data in cursor)
+
+    def save(self, info_hash, data):
+        with self.lock:
+            self.pending[info_hash] = data
+            self._schedule_flush()
+
+    def remove(self, info_hash):
+        with self.lock:
+            self.pending[info_hash] = None
+            self._schedule_flush()
+
+    def load(self, info_hash):
+        with self.lock:
+            if info_hash in self.pending:
+                return self.pending[info_hash]
+            self._ensure_cache()
+            return self.cache.get(info_hash)
+
+    def _schedule_flush(self):
+        if self.flush_dc is None:
+            self.flush_dc = eventloop.add_timeout(self.FLUSH_INTERVAL,
+                    self._flush_timeout, "Flush fast resume data")
+
+    def _flush_timeout(self):
+        self.flush_dc = None
+        self.flush()
+
+    def flush(self):
+        """Write all pending changes in a single transaction."""
+        with self.lock:
+            if self.flush_dc is not None:
+                self.flush_dc.cancel()
+                self.flush_dc = None
+            if not self.pending:
+                return
+            to_write = [(info_hash, sqlite3.Binary(data))
+                        for info_hash, data in self.pending.items()
+                        if data is not None]
+            to_delete = [(info_hash,)
+                         for info_hash, data in self.pending.items()
+                         if data is None]
+            try:
+                self._ensure_cache()
+                self.connection.execute("BEGIN")
+                self.connection.executemany("INSERT OR REPLACE INTO "
+                        "fast_resume (info_hash, data) VALUES (?, ?)",
+                        to_write)
+                self.connection.executemany("DELETE FROM fast_resume "
+                        "WHERE info_hash=?", to_delete)
+                self.connection.execute("COMMIT")
+            except (sqlite3.Error, OSError):
+                logging.exception("Error writing fast resume data")
+                try:
+                    self.connection.execute("ROLLBACK")
+                except (sqlite3.Error, AttributeError):
+                    pass
+                # keep the changes pending and try again later
+                self._schedule_flush()
+                return
+            for info_hash, data in self.pending.items():
+                if data is None:
+                    self.cache.pop(info_hash, None)
+                else:
+                    self.cache[info_hash] = data
+                # the store has the newest data now, so an old-style file
+                # would just be stale.
+                _remove_old_fast_resume_file(info_hash)
+            self.pending = {}
+
+    def _disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.path = None
+        self.cache = None
+
+    def close(self):
+        """Write out pending changes and close the database."""
+        with self.lock:
+            self.flush()
+            self._disconnect()
+
+FAST_RESUME_STORE = FastResumeStore()
+
+def _remove_old_fast_resume_file(info_hash):
+    fast_resume_file = generate_fast_resume_filename(info_hash)
+    if os.path.exists(fast_resume_file):
+        try:
+            fileutil.remove(fast_resume_file)
+        except OSError:
+            logging.exception("error removing old fast resume file")
+
 def save_fast_resume_data(info_hash, fast_resume_data):
     """Saves fast_resume_data to disk.
 
+    The data is queued in FAST_RESUME_STORE and written out with the
+    data for other torrents on the next flush.  Any old-style fast resume
+    file is removed once that flush commits.
+
     If it encounters problems, then it prints something to the log
     and otherwise eats the exceptions.
 
@@ -976,28 +1212,10 @@ def save_fast_resume_data(info_hash, fast_resume_data):
     :param fast_resume_data: the bencoded fast resume data to save to
         disk
     """
-    fast_resume_file = generate_fast_resume_filename(info_hash)
-    fast_resume_dir = os.path.dirname(fast_resume_file)
-
-    if not os.path.exists(fast_resume_dir):
-        try:
-            fileutil.makedirs(fast_resume_dir)
-        except OSError:
-            logging.exception("can't save fast_resume_data")
-            return
-
-    try:
-        with open(fast_resume_file, 'wb') as f:
-            f.write(fast_resume_data)
-    except (OSError, IOError):
-        logging.exception("Error occured trying to write fast_resume_data")
-        try:
-            os.unlink(fast_resume_file)
-        except (OSError, IOError):
-            pass
+    FAST_RESUME_STORE.save(info_hash, fast_resume_data)
 
 def load_fast_resume_data(info_hash):
-    """Loads fast_resume_data from file on disk.
+    """Loads fast_resume_data from disk.
 
     :param info_hash: the torrent handle info hash--this is unique to
         a torrent.
@@ -1005,6 +1223,16 @@ def load_fast_resume_data(info_hash):
     :returns: None if there are errors or it doesn't exist, or
         the bencoded fast resume data
     """
+    try:
+        fast_resume_data = FAST_RESUME_STORE.load(info_hash)
+    except (sqlite3.Error, OSError):
+        logging.exception("exception kicked up when loading fast "
+                          "resume data")
+        fast_resume_data = None
+    if fast_resume_data is not None:
+        return fast_resume_data
+
+    # fall back to the file written by older versions
     fast_resume_file = generate_fast_resume_filename(info_hash)
     if not os.path.exists(fast_resume_file):
         return None
@@ -1020,20 +1248,52 @@ def load_fast_resume_data(info_hash):
     return None
 
 def remove_fast_resume_data(info_hash):
-    """Removes fast_resume_data from file on disk.
+    """Removes fast_resume_data from disk.
 
     :param info_hash: the torrent handle info hash--this is unique to
         a torrent.
     """
-    fast_resume_file = generate_fast_resume_filename(info_hash)
-    if os.path.exists(fast_resume_file):
+    FAST_RESUME_STORE.remove(info_hash)
+    _remove_old_fast_resume_file(info_hash)
+
+def fast_resume_data_matches_files(fast_resume_data, torrent_info,
+                                   save_path):
+    """Check if the files for a torrent are the way the fast resume data
+    says they should be.
+
+    If the size and mtime of every file match, libtorrent can trust the
+    fast resume data and we don't need to recheck the torrent.
+    """
+    if not fast_resume_data:
+        return False
+    try:
+        resume = lt.bdecode(fast_resume_data)
+        file_sizes = resume['file sizes']
+        entries = list(torrent_info.files())
+    except (KeyError, TypeError, RuntimeError):
+        return False
+    if len(file_sizes) != len(entries):
+        return False
+    for (size, mtime), entry in zip(file_sizes, entries):
         try:
-            fileutil.remove(fast_resume_file)
+            stat_info = os.stat(os.path.join(save_path, entry.path))
         except OSError:
-            logging.exception("remove_fast_resume_data kicked up exception")
+            if size != 0:
+                return False
+            continue
+        if (stat_info.st_size != size or
+                int(stat_info.st_mtime) != mtime):
+            return False
+    return True
 
-# update fast resume data every 5 seconds
+# update fast resume data at most every 5 seconds
 FRD_UPDATE_LIMIT = 5
+# ... and only once at least this many bytes have been downloaded since the
+# last update
+FRD_CHANGE_THRESHOLD = 4 * (2 ** 20)
+# torrents that don't change much (for example seeds, which only update
+# their upload stats) get updated this often
+FRD_MAX_INTERVAL = 5 * 60
 
 class BTDownloader(BGDownloader):
     # reannounce at most every 30 seconds
@@ -1069,6 +1329,8 @@ class BTDownloader(BGDownloader):
         self.item = item
         self._last_reannounce_time = time.time()
         self._last_frd_update = time.time()
+        self._last_frd_size = getattr(self, 'currentSize', 0)
+        self._last_frd_uploaded = self.uploaded
 
     def _start_torrent(self):
         try:
@@ -1129,7 +1391,18 @@ class BTDownloader(BGDownloader):
             if self.info_hash:
                 self.fast_resume_data = load_fast_resume_data(self.info_hash)
                 if self.fast_resume_data:
-                    params["resume_data"] = lt.bencode(self.fast_resume_data)
+                    # fast_resume_data is already bencoded
+                    params["resume_data"] = self.fast_resume_data
+
+            # If the files on disk don't match our fast resume data,
+            # libtorrent will have to recheck them.  Add the torrent
+            # paused and let RECHECK_QUEUE decide when it can start.
+            needs_recheck = (not self.firstTime and not self.magnet and
+                             not fast_resume_data_matches_files(
+                                 self.fast_resume_data, torrent_info,
+                                 params["save_path"]))
+            if needs_recheck:
+                params["paused"] = True
 
             if self.magnet:
                 self.torrent = lt.add_magnet_uri(TORRENT_SESSION.session,
@@ -1138,7 +1411,7 @@ class BTDownloader(BGDownloader):
             else:
                 self.torrent = TORRENT_SESSION.session.add_torrent(params)
 
-            if not self.firstTime:
+            if not self.firstTime and not needs_recheck:
                 self.torrent.resume()
 
             self.info_hash = str(self.torrent.info_hash())
@@ -1151,6 +1424,41 @@ class BTDownloader(BGDownloader):
             logging.exception("Exception thrown in _start_torrent")
         else:
             TORRENT_SESSION.add_torrent(self)
+            if needs_recheck:
+                RECHECK_QUEUE.add(self)
+
+    def get_recheck_priority(self):
+        """Get the order to recheck this torrent in RECHECK_QUEUE.
+
+        Downloads come before seeds, then torrents that were active most
+        recently come first.
+        """
+        last_active = max(self.startTime, self.endTime)
+        return (self.state != u'downloading', -last_active)
+
+    def get_disk(self):
+        """Get the device that the torrent files are on."""
+        path = self.calc_save_path()
+        while path:
+            try:
+                return os.stat(path).st_dev
+            except OSError:
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+        return None
+
+    def start_recheck(self):
+        if self.torrent is not None:
+            self.torrent.resume()
+
+    def is_checking_files(self):
+        if self.torrent is None:
+            return False
+        state = self.torrent.status().state
+        return state in (lt.torrent_status.states.queued_for_checking,
+                         lt.torrent_status.states.checking_files)
 
     def calc_save_path(self):
         """Get save_path to pass to libtorrent."""
@@ -1171,7 +1479,12 @@ class BTDownloader(BGDownloader):
     def scrape_tracker(self):
         logging.debug("%s: no metainfo--rescraping", self.item)
 
-        # if we have no metainfo, then try rescraping
+        # if we have no metainfo, then try rescraping.  TRACKER_CACHE
+        # scrapes HTTP trackers together with our other torrents,
+        # libtorrent handles the rest.
+        if TRACKER_CACHE.torrent_trackers.get(self.info_hash):
+            TRACKER_CACHE.request_scrape(self.info_hash)
+            return
         try:
             self.torrent.scrape_tracker()
         except StandardError:
@@ -1207,6 +1520,7 @@ class BTDownloader(BGDownloader):
             if self.torrent is not None:
                 self.torrent.pause()
                 self.update_fast_resume_data(force=True)
+                RECHECK_QUEUE.remove(self)
                 TORRENT_SESSION.session.remove_torrent(self.torrent, 0)
                 self.torrent = None
         except StandardError:
@@ -1217,6 +1531,7 @@ class BTDownloader(BGDownloader):
             TORRENT_SESSION.remove_torrent(self)
             if self.torrent is not None:
                 self.torrent.pause()
+                RECHECK_QUEUE.remove(self)
         except StandardError:
             logging.exception("Error pausing torrent")
 
@@ -1274,8 +1589,19 @@ class BTDownloader(BGDownloader):
         self.rate = status.download_payload_rate
         self.upRate = status.upload_payload_rate
         self.uploaded = status.total_payload_upload + self.uploadedStart
-        self.seeders = status.num_complete
-        self.leechers = status.num_incomplete
+        if status.num_complete >= 0 and status.num_incomplete >= 0:
+            self.seeders = status.num_complete
+            self.leechers = status.num_incomplete
+            TRACKER_CACHE.update_counts(self.info_hash, self.seeders,
+                                        self.leechers)
+        else:
+            # libtorrent hasn't heard from the tracker yet, use the last
+            # counts we know about.
+            counts = TRACKER_CACHE.get_counts(self.info_hash)
+            if counts is not None:
+                self.seeders, self.leechers = counts
+            else:
+                self.seeders = self.leechers = -1
         self.connections = status.num_connections
         try:
             self.eta = ((status.total_wanted - status.total_wanted_done) /
@@ -1288,10 +1614,12 @@ class BTDownloader(BGDownloader):
         # if self.rate == 0:
         #     self.reannounce_to_peers()
 
-        if status.state == lt.torrent_status.states.queued_for_checking:
+        if ((status.state == lt.torrent_status.states.queued_for_checking
+             or RECHECK_QUEUE.is_waiting(self))):
             self.activity = _("waiting to check existing files")
         elif status.state == lt.torrent_status.states.checking_files:
-            self.activity = _("checking existing files")
+            self.activity = _("checking existing files (%(percent)d%%)",
+                              {"percent": status.progress * 100})
         elif status.state == lt.torrent_status.states.allocating:
             self.activity = _("allocating disk space")
         else:
@@ -1330,15 +1658,21 @@ class BTDownloader(BGDownloader):
              not self.info_hash)):
             return
 
+        if RECHECK_QUEUE.is_queued(self):
+            # until the check is done, libtorrent doesn't know which
+            # pieces we have.  Don't overwrite the old data.
+            return
+
         if BTDownloader.FRD_PROBLEMS >= 5:
             # if we've hit 5 problems, we don't keep trying
             return
 
         time_now = time.time()
-        if ((not force and
-             time_now < (self._last_frd_update + FRD_UPDATE_LIMIT))):
+        if not force and not self._fast_resume_data_changed(time_now):
             return
         self._last_frd_update = time_now
+        self._last_frd_size = self.currentSize
+        self._last_frd_uploaded = self.uploaded
 
         try:
             # FIXME - we should switch to save_resume_data which uses
@@ -1358,6 +1692,19 @@ class BTDownloader(BGDownloader):
 
         save_fast_resume_data(self.info_hash, self.fast_resume_data)
 
+    def _fast_resume_data_changed(self, time_now):
+        """Decide if our fast resume data has changed enough to be worth
+        saving again.
+        """
+        elapsed = time_now - self._last_frd_update
+        if elapsed < FRD_UPDATE_LIMIT:
+            return False
+        downloaded = self.currentSize - self._last_frd_size
+        if downloaded >= FRD_CHANGE_THRESHOLD:
+            return True
+        return (elapsed >= FRD_MAX_INTERVAL and
+                (downloaded != 0 or self.uploaded != self._last_frd_uploaded))
+
     def handle_error(self, short_reason, reason):
         self._shutdown_torrent()
         BGDownloader.handle_error(self, short_reason, reason)
@@ -1432,6 +1779,7 @@ class BTDownloader(BGDownloader):
 
             if self.info_hash:
                 remove_fast_resume_data(self.info_hash)
+                TRACKER_CACHE.forget_torrent(self.info_hash)
 
     def stop_upload(self):
         self.state = u"finished"
@@ -0,0 +1,400 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+
+"""``miro.dl_daemon.trackers`` -- Scrape trackers for all torrents at once.
+
+When we seed lots of torrents, most of them share a few trackers.  Rather
+than scraping each torrent separately, TrackerCache groups torrents by
+tracker and asks for up to MAX_HASHES_PER_SCRAPE info hashes in a single
+scrape request.  The results are kept for SCRAPE_TTL seconds and saved to
+disk together with the tracker IP addresses, so after a restart we can show
+seeders/leechers right away and don't need to look the trackers up again.
+
+Only HTTP trackers support multi-hash scrapes.  libtorrent still handles
+UDP trackers itself.
+"""
+
+import binascii
+import logging
+import os
+import socket
+import time
+import urllib
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+import libtorrent as lt
+
+from miro import app
+from miro import eventloop
+from miro import fileutil
+from miro import httpclient
+from miro import prefs
+from miro.util import returns_filename
+
+@returns_filename
+def generate_tracker_db_filename():
+    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+    return os.path.join(support_dir, 'trackers.sqlite')
+
+def scrape_url(announce_url):
+    """Get the scrape URL for a tracker announce URL.
+
+    By convention, the scrape URL replaces "announce" in the last path
+    component with "scrape".  Trackers that don't follow that convention
+    don't support scraping.
+
+    :returns: the scrape URL, or None if the tracker can't be scraped
+    """
+    if not announce_url.startswith(('http://', 'https://')):
+        return None
+    index = announce_url.rfind('/') + 1
+    if not announce_url.startswith('announce', index):
+        return None
+    return (announce_url[:index] + 'scrape' +
+            announce_url[index + len('announce'):])
+
+def build_scrape_request(url, info_hashes):
+    """Build the URL to scrape several info hashes at once.
+
+    :param url: scrape URL for the tracker
+    :param info_hashes: list of hex encoded info hashes
+    """
+    query = '&'.join('info_hash=%s' % urllib.quote(binascii.unhexlify(h))
+                     for h in info_hashes)
+    if '?' in url:
+        return url + '&' + query
+    else:
+        return url + '?' + query
+
+def parse_scrape_response(body):
+    """Parse a tracker scrape response.
+
+    :returns: dict mapping hex encoded info hashes to (seeders, leechers)
+        tuples
+    """
+    try:
+        files = lt.bdecode(body)['files']
+    except (KeyError, TypeError, RuntimeError):
+        return {}
+    counts = {}
+    for raw_hash, stats in files.items():
+        try:
+            counts[binascii.hexlify(raw_hash)] = (stats['complete'],
+                                                  stats['incomplete'])
+        except (KeyError, TypeError):
+            continue
+    return counts
+
+class TrackerCache(object):
+    """Keeps track of seeders/leechers for all our torrents."""
+
+    # how long scrape results stay valid
+    SCRAPE_TTL = 30 * 60
+    # how often to scrape torrents with expired results
+    SCRAPE_INTERVAL = 5 * 60
+    # wait this long after a scrape is requested, so that requests for
+    # other torrents on the same tracker can be sent together
+    SCRAPE_DELAY = 5
+    # how long to use a tracker IP address before looking it up again
+    ADDRESS_TTL = 24 * 60 * 60
+    MAX_HASHES_PER_SCRAPE = 50
+
+    def __init__(self):
+        self.connection = None
+        self.path = None
+        # scrape URL -> set of info hashes
+        self.trackers = {}
+        # info hash -> set of scrape URLs
+        self.torrent_trackers = {}
+        # info hash -> (seeders, leechers, time)
+        self.counts = {}
+        # host -> (address, time)
+        self.addresses = {}
+        # scrape URLs that should be scraped soon
+        self.to_scrape = set()
+        # scrape URLs with a request in progress
+        self.scraping = set()
+        # info hashes with counts that haven't been saved yet
+        self.unsaved = set()
+        self.scrape_dc = None
+        self.periodic_dc = None
+
+    def _ensure_connection(self):
+        path = generate_tracker_db_filename()
+        if self.connection is not None and path == self.path:
+            return
+        self._disconnect()
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            fileutil.makedirs(directory)
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scrape "
+                                "(info_hash TEXT PRIMARY KEY, "
+                                "seeders INTEGER, leechers INTEGER, "
+                                "scrape_time REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS address "
+                                "(host TEXT PRIMARY KEY, address TEXT, "
+                                "lookup_time REAL)")
+        now = time.time()
+        for row in self.connection.execute("SELECT info_hash, seeders, "
+                                           "leechers, scrape_time "
+                                           "FROM scrape"):
+            info_hash, seeders, leechers, scrape_time = row
+            self.counts[str(info_hash)] = (seeders, leechers, scrape_time)
+        for host, address, lookup_time in self.connection.execute(
+                "SELECT host, address, lookup_time FROM address"):
+            if now < lookup_time + self.ADDRESS_TTL:
+                self.addresses[str(host)] = (str(address), lookup_time)
+
+    def _disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.path = None
+
+    def startup(self):
+        try:
+            self._ensure_connection()
+        except (sqlite3.Error, OSError):
+            logging.exception("error loading tracker cache")
+        # Do the first scrape soon, so that torrents without saved results
+        # get them shortly after startup.
+        self.periodic_dc = eventloop.add_timeout(self.SCRAPE_DELAY,
+                self._scrape_expired, "Scrape trackers")
+
+    def shutdown(self):
+        for dc in (self.scrape_dc, self.periodic_dc):
+            if dc is not None:
+                dc.cancel()
+        self.scrape_dc = self.periodic_dc = None
+        self._save_counts()
+        self._disconnect()
+
+    def add_torrent(self, info_hash, announce_urls):
+        """Start tracking seeders/leechers for a torrent."""
+        urls = set(scrape_url(url) for url in announce_urls)
+        urls.discard(None)
+        self.torrent_trackers[info_hash] = urls
+        for url in urls:
+            self.trackers.setdefault(url, set()).add(info_hash)
+
+    def remove_torrent(self, info_hash):
+        for url in self.torrent_trackers.pop(info_hash, ()):
+            info_hashes = self.trackers[url]
+            info_hashes.discard(info_hash)
+            if not info_hashes:
+                del self.trackers[url]
+                self.to_scrape.discard(url)
+
+    def forget_torrent(self, info_hash):
+        """Remove saved results for a torrent that was deleted."""
+        self.remove_torrent(info_hash)
+        self.counts.pop(info_hash, None)
+        self.unsaved.discard(info_hash)
+        try:
+            self._ensure_connection()
+            self.connection.execute("DELETE FROM scrape WHERE info_hash=?",
+                                    (info_hash,))
+        except (sqlite3.Error, OSError):
+            logging.exception("error removing tracker scrape results")
+
+    def get_counts(self, info_hash):
+        """Get the last known seeders/leechers for a torrent.
+
+        :returns: (seeders, leechers) or None if we don't know them.
+        """
+        try:
+            seeders, leechers, scrape_time = self.counts[info_hash]
+        except KeyError:
+            return None
+        return (seeders, leechers)
+
+    def update_counts(self, info_hash, seeders, leechers):
+        """Store seeders/leechers that we got some other way.
+
+        libtorrent learns them when it announces to the tracker.  Keeping
+        them here means we won't scrape the torrent until they expire.
+        """
+        if seeders < 0 or leechers < 0:
+            return
+        old = self.counts.get(info_hash)
+        now = time.time()
+        if ((old is not None and old[:2] == (seeders, leechers) and
+             now < old[2] + self.SCRAPE_TTL / 2)):
+            return
+        self.counts[info_hash] = (seeders, leechers, now)
+        self.unsaved.add(info_hash)
+
+    def request_scrape(self, info_hash):
+        """Scrape a torrent soon.
+
+        Requests are delayed for a few seconds so that torrents using the
+        same tracker can be scraped together.
+        """
+        self.to_scrape.update(self.torrent_trackers.get(info_hash, ()))
+        if self.to_scrape and self.scrape_dc is None:
+            self.scrape_dc = eventloop.add_timeout(self.SCRAPE_DELAY,
+                    self._do_scrapes, "Scrape trackers")
+
+    def _is_expired(self, info_hash, now):
+        try:
+            scrape_time = self.counts[info_hash][2]
+        except KeyError:
+            return True
+        return now >= scrape_time + self.SCRAPE_TTL
+
+    def _scrape_expired(self):
+        self.periodic_dc = eventloop.add_timeout(self.SCRAPE_INTERVAL,
+                self._scrape_expired, "Scrape trackers")
+        self._save_counts()
+        now = time.time()
+        for url, info_hashes in self.trackers.items():
+            if any(self._is_expired(h, now) for h in info_hashes):
+                self.to_scrape.add(url)
+        self._do_scrapes()
+
+    def _do_scrapes(self):
+        self.scrape_dc = None
+        now = time.time()
+        to_scrape, self.to_scrape = self.to_scrape, set()
+        for url in to_scrape:
+            if url in self.scraping or url not in self.trackers:
+                continue
+            info_hashes = sorted(h for h in self.trackers[url]
+                                 if self._is_expired(h, now))
+            if info_hashes:
+                self.scraping.add(url)
+                self._lookup_address(url, info_hashes)
+
+    def _lookup_address(self, url, info_hashes):
+        host = httpclient.TransferOptions(url).host
+        if host in self.addresses:
+            self._start_scrapes(url, info_hashes, self.addresses[host][0])
+            return
+
+        def callback(address):
+            now = time.time()
+            self.addresses[host] = (address, now)
+            try:
+                self._ensure_connection()
+                self.connection.execute("INSERT OR REPLACE INTO address "
+                                        "(host, address, lookup_time) "
+                                        "VALUES (?, ?, ?)",
+                                        (host, address, now))
+            except (sqlite3.Error, OSError):
+                logging.exception("error saving tracker address")
+            self._start_scrapes(url, info_hashes, address)
+
+        def errback(error):
+            logging.debug("error looking up %s: %s", host, error)
+            self.scraping.discard(url)
+            self._forget_address(host)
+
+        eventloop.call_in_thread(callback, errback, socket.gethostbyname,
+                                 "Look up tracker address", host)
+
+    def _forget_address(self, host):
+        """Drop a tracker address so that we look it up again next time."""
+        self.addresses.pop(host, None)
+        try:
+            self._ensure_connection()
+            self.connection.execute("DELETE FROM address WHERE host=?",
+                                    (host,))
+        except (sqlite3.Error, OSError):
+            logging.exception("error removing tracker address")
+
+    def _start_scrapes(self, url, info_hashes, address):
+        host = httpclient.TransferOptions(url).host
+        pending = []
+        for i in xrange(0, len(info_hashes), self.MAX_HASHES_PER_SCRAPE):
+            chunk = info_hashes[i:i+self.MAX_HASHES_PER_SCRAPE]
+            options = httpclient.TransferOptions(
+                build_scrape_request(url, chunk))
+            options.resolve_address = address
+            pending.append(options)
+
+        def on_finished():
+            pending.pop()
+            if not pending:
+                self.scraping.discard(url)
+
+        def callback(info):
+            on_finished()
+            if info['status'] != 200:
+                return
+            now = time.time()
+            counts = parse_scrape_response(info['body'])
+            for info_hash, (seeders, leechers) in counts.items():
+                if info_hash in self.torrent_trackers:
+                    self.counts[info_hash] = (seeders, leechers, now)
+                    self.unsaved.add(info_hash)
+            self._save_counts()
+
+        def errback(error):
+            on_finished()
+            logging.debug("error scraping %s: %s", url, error)
+            if isinstance(error, (httpclient.ConnectionError,
+                                  httpclient.ConnectionTimeout,
+                                  httpclient.UnknownHostError)):
+                # the tracker may have moved to a new address
+                self._forget_address(host)
+
+        for options in list(pending):
+            httpclient.CurlTransfer(options, callback, errback).start()
+
+    def _save_counts(self):
+        """Write all unsaved counts in a single transaction."""
+        if not self.unsaved:
+            return
+        rows = [(info_hash,) + self.counts[info_hash]
+                for info_hash in self.unsaved]
+        try:
+            self._ensure_connection()
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT OR REPLACE INTO scrape "
+                                        "(info_hash, seeders, leechers, "
+                                        "scrape_time) VALUES (?, ?, ?, ?)",
+                                        rows)
+            self.connection.execute("COMMIT")
+        except (sqlite3.Error, OSError):
+            logging.exception("error saving tracker scrape results")
+            try:
+                self.connection.execute("ROLLBACK")
+            except (sqlite3.Error, AttributeError):
+                pass
+        else:
+            self.unsaved = set()
+
+TRACKER_CACHE = TrackerCache()
@@ -28,6 +28,8 @@
 # statement from all source files in the program, then also delete it here.
 
 import datetime
+import heapq
+import itertools
 import os
 import random
 import logging
@@ -65,6 +67,16 @@ class DownloadStateManager(object):
     to this rule is the pause/resume pair which acts like matter and
     anti-matter, which will nuke itself when they come into contact
     (but dies with not even a whimper instead of a gorgeous display).
+
+    Restore commands queued before the downloader daemon starts are
+    handled differently.  There can be thousands of them, so rather than
+    sending them all in one huge command, we send RESTORE_BATCH_SIZE at a
+    time and wait for the daemon to finish a batch before sending more
+    than RESTORE_WINDOW batches.  Active downloads get restored first and
+    seeds last.  Batches that the daemon hasn't acknowledged after
+    RESTORE_TIMEOUT seconds, or when the daemon is (re)started, get queued
+    up again.  Restoring a downloader twice is harmless, the daemon just
+    ignores the second one.
     """
     STOP    = command.DownloaderBatchCommand.STOP
     RESUME  = command.DownloaderBatchCommand.RESUME
@@ -73,30 +85,148 @@ class DownloadStateManager(object):
 
     UPDATE_INTERVAL = 1
 
+    RESTORE_BATCH_SIZE = 50
+    RESTORE_WINDOW = 2
+    RESTORE_TIMEOUT = 60
+
     def __init__(self):
         self.total_up_rate = 0
         self.total_down_rate = 0
         # a hash of download ids that the server knows about.
         self.downloads = {}
         self.daemon_starter = None
-        self.startup_commands = dict()
         self.commands = dict()
         self.bulk_mode = False
+        # maps download ids to (priority, args) for restores that we
+        # haven't sent yet
+        self.pending_restores = {}
+        # heap of (priority, counter, dlid) for pending_restores
+        self.restore_queue = []
+        self.restore_counter = itertools.count()
+        # maps batch ids to lists of (priority, counter, dlid, args) for
+        # the batches that the daemon hasn't finished yet
+        self.unacked_restores = {}
+        self.restore_batch_counter = itertools.count()
+        self.restore_timeout_dc = None
+        self.restore_total = 0
+        self.restored_count = 0
 
     def set_bulk_mode(self):
         self.bulk_mode = True
 
     def send_initial_updates(self):
-        commands = self.startup_commands
-        self.startup_commands = None
-        if commands:
-            c = command.DownloaderBatchCommand(RemoteDownloader.dldaemon,
-                                               commands)
-            c.send()
+        # the daemon was just started, so it won't reply for batches sent
+        # to an earlier one.
+        self.requeue_restores()
+        self.restore_total = (len(self.pending_restores) +
+                              self.restored_count)
+        self.send_restores()
+
+    def send_restores(self):
+        """Send batches of pending restores, until RESTORE_WINDOW batches
+        are waiting for a reply.
+        """
+        while (self.restore_queue and
+               len(self.unacked_restores) < self.RESTORE_WINDOW):
+            batch = []
+            while self.restore_queue and len(batch) < self.RESTORE_BATCH_SIZE:
+                priority, counter, dlid = heapq.heappop(self.restore_queue)
+                if self.pending_restores.get(dlid, (None,))[0] != priority:
+                    # removed, or there's another entry with a better
+                    # priority
+                    continue
+                unused, args = self.pending_restores.pop(dlid)
+                batch.append((priority, counter, dlid, args))
+            if batch:
+                batch_id = self.restore_batch_counter.next()
+                self.unacked_restores[batch_id] = batch
+                c = command.RestoreDownloadersCommand(
+                    RemoteDownloader.dldaemon, batch_id,
+                    [(dlid, args['downloader'])
+                     for priority, counter, dlid, args in batch])
+                c.send()
+                self._schedule_restore_timeout()
+
+    def restore_batch_done(self, batch_id, count):
+        """Called when the daemon replies to a RestoreDownloadersCommand."""
+        if self.unacked_restores.pop(batch_id, None) is None:
+            # we already gave up on this batch and queued it again
+            return
+        self.restored_count += count
+        self._schedule_restore_timeout()
+        if not self.pending_restores and not self.unacked_restores:
+            logging.info("restored %s downloaders", self.restored_count)
+        self.send_restore_progress()
+        self.send_restores()
+
+    def send_restore_progress(self):
+        from miro.messages import DownloaderRestoreProgress
+        DownloaderRestoreProgress(self.restored_count,
+                                  self.restore_total).send_to_frontend()
+
+    def requeue_restores(self):
+        """Queue up the batches that the daemon hasn't finished again.
+
+        This is called when the daemon is (re)started or stops replying.
+        """
+        for batch in self.unacked_restores.values():
+            for priority, counter, dlid, args in batch:
+                if dlid not in self.pending_restores:
+                    # keep the old counter so these go out before anything
+                    # queued after them
+                    self.pending_restores[dlid] = (priority, args)
+                    heapq.heappush(self.restore_queue,
+                                   (priority, counter, dlid))
+        self.unacked_restores = {}
+        self._cancel_restore_timeout()
+
+    def _schedule_restore_timeout(self):
+        self._cancel_restore_timeout()
+        if self.unacked_restores:
+            self.restore_timeout_dc = eventloop.add_timeout(
+                self.RESTORE_TIMEOUT, self._on_restore_timeout,
+                "Restore downloaders timeout")
+
+    def _cancel_restore_timeout(self):
+        if self.restore_timeout_dc is not None:
+            self.restore_timeout_dc.cancel()
+            self.restore_timeout_dc = None
+
+    def _on_restore_timeout(self):
+        self.restore_timeout_dc = None
+        logging.warn("downloader daemon didn't finish %s restore batches, "
+                     "sending them again", len(self.unacked_restores))
+        self.requeue_restores()
+        self.send_restores()
+
+    def _restore_priority(self, args):
+        state = args['downloader'].get('state')
+        if state in (u'downloading', u'offline'):
+            return 0
+        elif state == u'uploading':
+            return 2
+        else:
+            return 1
+
+    def _queue_restore(self, identifier, args, priority):
+        self.pending_restores[identifier] = (priority, args)
+        heapq.heappush(self.restore_queue,
+                       (priority, self.restore_counter.next(), identifier))
 
     def send_updates(self):
         commands = self.commands
         self.commands = dict()
+        for dlid in [dlid for dlid in commands
+                     if dlid in self.pending_restores]:
+            # The daemon doesn't know about this download yet.  Hold onto
+            # the command until we've sent the restore and restore it
+            # before anything else.
+            self.commands[dlid] = commands.pop(dlid)
+            priority, args = self.pending_restores[dlid]
+            if priority != -1:
+                self._queue_restore(dlid, args, -1)
+        if self.commands:
+            self.send_restores()
         if commands:
             c = command.DownloaderBatchCommand(RemoteDownloader.dldaemon,
                                                commands)
@@ -143,7 +273,8 @@ class DownloadStateManager(object):
         # Catch restores first, we will flush them when the downloader's
         # started.
         if cmd == self.RESTORE and not self.daemon_started():
-            self.startup_commands[identifier] = (cmd, args)
+            self._queue_restore(identifier, args,
+                                self._restore_priority(args))
             return
 
         exists = self.commands.has_key(identifier)
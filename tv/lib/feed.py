@@ -647,28 +647,6 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         for item in available_items:
             item.signal_change(needs_save=False)
 
-    def start_manual_download(self):
-        next_ = None
-        for item in self.items:
-            if item.is_pending_manual_download():
-                if next_ is None:
-                    next_ = item
-                elif item.get_pub_date_parsed() > next_.get_pub_date_parsed():
-                    next_ = item
-        if next_ is not None:
-            next_.download(autodl=False)
-
-    def start_auto_download(self):
-        next = None
-        for item in self.items:
-            if item.is_eligible_for_auto_download():
-                if next is None:
-                    next = item
-                elif item.get_pub_date_parsed() > next.get_pub_date_parsed():
-                    next = item
-        if next is not None:
-            next.download(autodl = True)
-
     def expiring_items(self):
         # items in watched folders never expire
         if self.is_watched_folder():
@@ -795,7 +773,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.maxNew = max_new
         self.signal_change()
         if self.maxNew >= oldMaxNew or self.maxNew < 0:
-            autodler.AUTO_DOWNLOADER.start_downloads()
+            autodler.AUTO_DOWNLOADER.feed_changed(self)
 
     def set_max_old_items(self, maxOldItems):
         self.confirm_db_thread()
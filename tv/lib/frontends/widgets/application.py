@@ -1345,6 +1345,12 @@ class WidgetsMessageHandler(messages.MessageHandler):
                 d.controller.item_list.set_resort_on_update(True)
         logging.debug('DownloaderSyncCommandComplete')
 
+    def handle_downloader_restore_progress(self, message):
+        for d in app.display_manager.display_stack:
+            if hasattr(d, 'type') and d.type == 'downloading':
+                d.controller.status_toolbar.update_restore_progress(
+                    message.restored, message.total)
+
     def handle_jettison_tabs(self, message):
         typ = message.type
         item_ids = message.ids
@@ -1601,6 +1607,10 @@ class WidgetsMessageHandler(messages.MessageHandler):
         library_tab_list = app.tabs['library']
         library_tab_list.update_converting_count(message.running_count,
                 message.other_count)
+        current_display = app.display_manager.get_current_display()
+        if isinstance(current_display, displays.ConvertingDisplay):
+            current_display.controller.handle_cache_stats(message.cache_hits,
+                    message.cache_misses)
 
     def handle_conversion_tasks_list(self, message):
         current_display = app.display_manager.get_current_display()
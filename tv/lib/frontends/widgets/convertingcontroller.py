@@ -143,6 +143,9 @@ class ConvertingController(object):
             self.table.model_changed()
             self._update_buttons_state()
     
+    def handle_cache_stats(self, hits, misses):
+        self.titlebar.set_cache_stats(hits, misses)
+
     def _update_buttons_state(self):
         finished_count = not_finished_count = 0
         for info in self.model.info_list():
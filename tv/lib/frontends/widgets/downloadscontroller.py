@@ -56,6 +56,7 @@ class DownloadsController(itemlistcontroller.ItemListController):
         self.widget.statusbar_vbox.pack_start(self.status_toolbar)
 
         self._update_free_space()
+        messages.QueryDownloaderRestoreProgress().send_to_backend()
 
     def on_config_change(self, obj, key, value):
         itemlistcontroller.ItemListController.on_config_change(self, obj, key,
@@ -691,13 +691,25 @@ class ConvertingTitlebar(ItemListTitlebar):
                 self._on_clear_finished_clicked)
         self.clear_finished_button = clear_finished_button
 
+        self.cache_stats_label = widgetset.Label()
+        self.cache_stats_label.set_size(widgetconst.SIZE_SMALL)
+
         h = widgetset.HBox(spacing=20)
         h.pack_start(widgetutil.align_middle(stop_all_button, left_pad=25))
         h.pack_start(widgetutil.align_middle(reveal_button))
         h.pack_start(widgetutil.align_middle(clear_finished_button))
+        h.pack_start(widgetutil.align_middle(self.cache_stats_label))
 
         return h
 
+    def set_cache_stats(self, hits, misses):
+        if hits + misses == 0:
+            self.cache_stats_label.set_text('')
+        else:
+            self.cache_stats_label.set_text(
+                _('%(hits)d reused, %(misses)d converted',
+                  {'hits': hits, 'misses': misses}))
+
     # Don't build anything special.
     def _build_titlebar_extra(self):
         return None
@@ -1170,6 +1182,11 @@ class DownloadStatusToolbar(Toolbar):
         h.pack_start(widgetutil.align_left(self._free_disk_label,
                      top_pad=10, bottom_pad=10, left_pad=3), expand=True)
 
+        self._restore_label = widgetset.Label("")
+        self._restore_label.set_size(widgetconst.SIZE_SMALL)
+
+        h.pack_start(widgetutil.align_middle(widgetutil.align_right(
+                     self._restore_label, right_pad=20)))
 
         # Sigh.  We want to fix these sizes so they don't jump about
         # so reserve the maximum size for these things.  The upload
@@ -1251,6 +1268,17 @@ class DownloadStatusToolbar(Toolbar):
                      {"amount": displaytext.size_string(amount)})
         self._free_disk_label.set_text(text)
 
+    def update_restore_progress(self, restored, total):
+        """Updates the text showing how many downloads have been
+        restored at startup.
+        """
+        if restored < total:
+            text = _("Restoring downloads: %(restored)s of %(total)s",
+                     {"restored": restored, "total": total})
+        else:
+            text = ""
+        self._restore_label.set_text(text)
+
     def update_rates(self, down_bps, up_bps):
         text_up = text_down = ''
         if up_bps >= 10:
@@ -376,7 +376,8 @@ def attach_text(widget, descriptor, error_widget=None, check_function=None,
         widget.connect('changed', check_value)
     widget.connect('focus-out', save_value)
 
-def attach_combo(widget, descriptor, values, manualconfig=None):
+def attach_combo(widget, descriptor, values, manualconfig=None,
+                 default_index=1):
     """This is for preferences implemented as an option menu where there
     is a set of possible values of which only one can be chosen.
 
@@ -386,6 +387,7 @@ def attach_combo(widget, descriptor, values, manualconfig=None):
     manualconfig - Callback to deal with configuration changes manually.
          Disables listening for changes witin the config system and auto
          enable and disable of dependent widgets.
+    default_index - the entry to select if the value isn't in values
     """
     def combo_changed(widget, index):
         app.config.set(descriptor, values[index])
@@ -397,7 +399,7 @@ def attach_combo(widget, descriptor, values, manualconfig=None):
             try:
                 widget.set_selected(values.index(value))
             except ValueError:
-                widget.set_selected(1)
+                widget.set_selected(default_index)
             widget.thaw_signals()
 
     if not manualconfig:
@@ -407,7 +409,7 @@ def attach_combo(widget, descriptor, values, manualconfig=None):
     try:
         widget.set_selected(values.index(value))
     except ValueError:
-        widget.set_selected(1)
+        widget.set_selected(default_index)
     widget.connect('changed', combo_changed)
 
 def note_label(text):
@@ -1219,8 +1221,13 @@ class ConversionsPanel(PanelBuilder):
             max_concurrent.append((i+1, str(i+1)))
         max_concurrent_menu = widgetset.OptionMenu(
             [op[1] for op in max_concurrent])
+        # the default (None) uses every core, so it's the last option.  So
+        # do values from before that, which stored the number of cores, or
+        # more than this computer has.
+        max_concurrent[-1] = (None, max_concurrent[-1][1])
         attach_combo(max_concurrent_menu, prefs.MAX_CONCURRENT_CONVERSIONS,
-            [op[0] for op in max_concurrent])
+            [op[0] for op in max_concurrent],
+            default_index=len(max_concurrent) - 1)
 
         if count == 1:
             max_concurrent_menu.disable()
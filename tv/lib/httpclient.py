@@ -69,6 +69,7 @@ REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
 
 _logged_noproxy_error = False
+_logged_resolve_error = False
 
 def user_agent():
     return "%s/%s (%s; %s)" % (app.config.get(prefs.SHORT_APP_NAME),
@@ -213,6 +214,8 @@ class TransferOptions(object):
         self.write_file = write_file
         self.requires_cookies = False
         self.head_request = False
+        # IP address to connect to instead of looking up the host
+        self.resolve_address = None
         self.invalid_url = False
         # _cancel_on_body_data is an internal attribute used for grab_headers.
         self._cancel_on_body_data = False
@@ -221,6 +224,7 @@ class TransferOptions(object):
 
     def parse_url(self):
         self.scheme = self.host = _('Unknown')
+        self.port = None
         if self.url is None:
             self.invalid_url = True
             return 
@@ -232,6 +236,7 @@ class TransferOptions(object):
         scheme, host, port, path = download_utils.parse_url(self.url)
         self.scheme = scheme
         self.host = host
+        self.port = port
         self.path = path
         if scheme not in ['http', 'https'] or host == '' or path == '':
             self.invalid_url = True
@@ -271,9 +276,21 @@ class TransferOptions(object):
         handle.setopt(pycurl.URL, self.url)
         if self.head_request:
             handle.setopt(pycurl.NOBODY, 1)
+        if self.resolve_address is not None:
+            self._setup_resolve(handle)
         self._setup_proxy(handle)
         return handle
 
+    def _setup_resolve(self, handle):
+        try:
+            handle.setopt(pycurl.RESOLVE, ['%s:%s:%s' % (
+                str(self.host), self.port, self.resolve_address)])
+        except AttributeError:
+            global _logged_resolve_error
+            if not _logged_resolve_error:
+                logging.warn("pycurl.RESOLVE doesn't exist")
+                _logged_resolve_error = True
+
     def _setup_proxy(self, handle):
         if not app.config.get(prefs.HTTP_PROXY_ACTIVE):
             return
@@ -33,6 +33,9 @@ import errno
 import os
 import sys
 import itertools
+import select
+import time
+import Queue
 import socket
 import random
 import traceback
@@ -57,13 +60,17 @@ import mdns
 from const import *
 from subr import (encode_response, decode_response, split_url_path, atoi,
                   atol, StreamObj, ChunkedStreamObj, find_daap_tag,
-                  find_daap_listitems)
+                  find_daap_listitems, find_update_type, EncodedTag,
+                  encode_tags, make_item_listing, encode_item)
 
 # Configurable options (or do via command line).
 DEFAULT_PORT = 3689
 DAAP_TIMEOUT = 1800    # timeout (in seconds)
+DAAP_REQUEST_TIMEOUT = 60  # socket timeout for reading/writing a request
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
+DAAP_WORKERS = 12      # Number of threads serving requests.
+DAAP_CONNS_PER_SESSION = 4  # Control, update, stream and artwork.
 
 # !!! No user servicable parts below. !!!
 
@@ -100,19 +107,63 @@ DEFAULT_DAAP_PLAYLIST_META = ('dmap.itemid,dmap.itemname,dmap.persistentid,' +
                               'dmap.parentcontainerid,dmap.persistentid,' + 
                               'com.apple.itunes.is-podcast-playlist')
 
+class ServiceUnavailable(Exception):
+    """Raised by the backend's get_file() when it can't send the file right
+    now.  The client gets a 503 and is told to try again in retry_after
+    seconds.
+    """
+    def __init__(self, retry_after):
+        Exception.__init__(self, retry_after)
+        self.retry_after = retry_after
+
 class SessionObject(object):
     # Container object for a daap session.  Basically a heartbeat timeout
-    # timer object and a generation counter so we can impose some ordering
-    # on the requests which come in.
+    # and a generation counter so we can impose some ordering on the
+    # requests which come in.
     pass
 
-class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+def make_wakeup_pair():
+    """make_wakeup_pair() -> (reader, writer)
+
+    A pair of connected sockets, used to wake up a thread sitting in
+    select().  Sockets rather than a pipe so this works on Windows too.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        writer.connect(listener.getsockname())
+        reader, address = listener.accept()
+    finally:
+        listener.close()
+    writer.setblocking(False)
+    reader.setblocking(False)
+    return reader, writer
+
+def has_buffered_input(rfile):
+    # socket._fileobject keeps what it has read ahead in _rbuf.  A pipelined
+    # request sitting there won't make the socket readable.
+    rbuf = getattr(rfile, '_rbuf', None)
+    return bool(rbuf and rbuf.tell())
+
+class DaapTCPServer(SocketServer.TCPServer):
+    """The DAAP server.
+
+    Connections are not given a thread each.  A single poll thread watches
+    the idle connections and hands each incoming request to a fixed pool of
+    DAAP_WORKERS worker threads, which give the connection back once the
+    reply is written.  /update requests that have to wait for the next
+    revision are parked in a wait list watched by the poll thread and
+    answered when the backend reports a new revision, so waiting clients
+    don't hold on to a worker.
+    """
     # GRRR!  Stupid Windows!  When bind() is called twice on a socket
     # it should return EADDRINUSE on the second one - Windows doesn't!
     # Use robust=True (default) in make_daap_server() and it will pick 
     # a new port.
     # allow_reuse_address = True    # setsockopt(... SO_REUSEADDR, 1)
-    daemon_threads = True
+    request_queue_size = 32
 
     def __init__(self, server_address, RequestHandlerClass,
                  bind_and_activate=True):
@@ -123,11 +174,33 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
+        self.backend = None
+        self.persistent_id = 1
+        self.nworkers = DAAP_WORKERS
+        self.set_maxconn(DAAP_MAXCONN)
+        # Latest revision reported by the backend, or None if the backend
+        # can't tell us about new revisions; /update then blocks in
+        # backend.get_revision().
+        self.revision = None
+        self.jobs = Queue.Queue()
+        self.workers = []
+        self.poll_thread = None
+        # Commands for the poll thread, see poll_command().
+        self.poll_lock = threading.Lock()
+        self.poll_commands = []
+        self.wakeup_r, self.wakeup_w = make_wakeup_pair()
+        # Only touched by the poll thread.
+        self.idle = dict()        # socket -> handler
+        self.waiting = dict()     # socket -> (handler, old_revision)
+        self.connection_count = 0
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
     def set_backend(self, backend):
         self.backend = backend
+        add_listener = getattr(backend, 'add_revision_listener', None)
+        if add_listener:
+            add_listener(self.revision_changed)
 
     def set_finished_callback(self, callback):
         self.finished_callback = callback
@@ -141,12 +214,28 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     def set_name(self, name):
         self.name = name
 
+    def set_persistent_id(self, persistent_id):
+        # Sent as the database persistent id, so clients can tell this
+        # library apart from others and keep what they know about it.
+        self.persistent_id = persistent_id
+
     def set_maxconn(self, maxconn):
         self.maxconn = maxconn
         self.activeconn = dict()
 
+    def set_workers(self, nworkers):
+        self.nworkers = nworkers
+
+    def log_message(self, format, *args):
+        if self.log_message_callback:
+            self.log_message_callback(format, *args)
+
     def daap_timeout_callback(self, s):
         self.del_session(s)
+        # The client went away without logging out, so whatever the backend
+        # is doing for it (e.g. transcoding) is no longer wanted.
+        if self.finished_callback:
+            self.finished_callback(s)
 
     def session_count(self):
         return len(self.activeconn)
@@ -162,31 +251,43 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
                     break
             session_obj = SessionObject()
             self.activeconn[s] = session_obj
-            session_obj.timer = threading.Timer(DAAP_TIMEOUT,
-                                                self.daap_timeout_callback,
-                                                [s])
+            session_obj.expires = time.time() + DAAP_TIMEOUT
             session_obj.counter = itertools.count()
             current_thread = threading.current_thread()
             current_thread.generation = session_obj.counter.next()
-            self.activeconn[s].timer.start()
+        # Let the poll thread know when to time it out.
+        self.wakeup()
         return s
 
     def renew_session(self, s):
         with self.session_lock:
             try:
-                self.activeconn[s].timer.cancel()
+                session_obj = self.activeconn[s]
             except KeyError:
                 return False
-            # Pants...  we need to create a new timer object.
-            self.activeconn[s].timer = threading.Timer(DAAP_TIMEOUT,
-                                                   self.daap_timeout_callback,
-                                                   [s])
+            session_obj.expires = time.time() + DAAP_TIMEOUT
             current_thread = threading.current_thread()
-            current_thread.generation = self.activeconn[s].counter.next()
-            self.activeconn[s].timer.start()
+            current_thread.generation = session_obj.counter.next()
             # OK, thank the caller for telling us the guy's alive
             return True
 
+    def expire_sessions(self):
+        """Time out idle sessions.  Returns the number of seconds until the
+        next session expires, or None if there are none.
+        """
+        now = time.time()
+        with self.session_lock:
+            expired = [s for s, session_obj in self.activeconn.iteritems()
+                       if session_obj.expires <= now]
+            expires = [session_obj.expires
+                       for session_obj in self.activeconn.itervalues()
+                       if session_obj.expires > now]
+        for s in expired:
+            self.daap_timeout_callback(s)
+        if expires:
+            return max(min(expires) - now, 0)
+        return None
+
     def handle_error(self, request, client_address):
         pass
 
@@ -195,22 +296,211 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         # conn.
         with self.session_lock:
             try:
-                self.activeconn[s].timer.cancel()
                 # XXX can't just delete? - need to keep a reference count 
                 # for the connection, we can have data/control connection?
                 del self.activeconn[s]
             except KeyError:
                 pass
 
+    def revision_changed(self, revision):
+        # Called by the backend, from any thread, whenever its revision
+        # changes.
+        with self.poll_lock:
+            self.revision = revision
+            self.poll_commands.append(('revision', revision))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send('x')
+        except socket.error:
+            # Full: the poll thread has a wakeup pending anyway.
+            pass
+
+    def poll_command(self, *command):
+        with self.poll_lock:
+            self.poll_commands.append(command)
+        self.wakeup()
+
+    def start_threads(self):
+        if self.poll_thread:
+            return
+        for i in xrange(self.nworkers):
+            t = threading.Thread(target=self.worker_loop,
+                                 name='DAAP Worker %d' % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        self.poll_thread = threading.Thread(target=self.poll_loop,
+                                            name='DAAP Poll Thread')
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def process_request(self, request, client_address):
+        # Called in the accepting thread instead of spawning a thread like
+        # ThreadingMixIn.
+        self.start_threads()
+        with self.poll_lock:
+            full = (self.connection_count >=
+                    self.maxconn * DAAP_CONNS_PER_SESSION)
+            if not full:
+                self.connection_count += 1
+        if full:
+            self.log_message('daap server: too many connections from %s',
+                             client_address)
+            self.shutdown_request(request)
+            return
+        handler = self.RequestHandlerClass(request, client_address, self)
+        self.poll_command('read', handler)
+
+    def close_connection(self, handler):
+        try:
+            handler.finish()
+        finally:
+            self.shutdown_request(handler.request)
+            with self.poll_lock:
+                self.connection_count -= 1
+
+    def return_connection(self, handler):
+        # Done with a request: wait for the next one, or park the connection
+        # if it is an /update which has to wait for a new revision.
+        if handler.close_connection:
+            self.close_connection(handler)
+        elif handler.update_wait is not None:
+            with self.poll_lock:
+                revision = self.revision
+                if revision == handler.update_wait:
+                    self.poll_commands.append(('wait', handler,
+                                               handler.update_wait))
+            if revision == handler.update_wait:
+                self.wakeup()
+            else:
+                self.finish_update(handler, revision)
+        elif has_buffered_input(handler.rfile):
+            self.jobs.put((self.serve_request, handler))
+        else:
+            self.poll_command('read', handler)
+
+    def serve_request(self, handler):
+        try:
+            handler.handle_one_request()
+        except socket.timeout:
+            self.log_message('daap server: timed out serving %s',
+                             handler.client_address)
+            handler.close_connection = 1
+        except Exception:
+            handler.close_connection = 1
+        self.return_connection(handler)
+
+    def finish_update(self, handler, revision):
+        handler.update_wait = None
+        try:
+            handler.send_update(revision)
+        except Exception:
+            handler.close_connection = 1
+        self.return_connection(handler)
+
+    def worker_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, handler = job
+            try:
+                func(handler)
+            except Exception, e:
+                self.log_message('daap server: worker error %s', e)
+
+    def poll_loop(self):
+        while True:
+            with self.poll_lock:
+                commands = self.poll_commands
+                self.poll_commands = []
+            for command in commands:
+                if command[0] == 'quit':
+                    for handler in self.idle.values():
+                        self.close_connection(handler)
+                    for handler, old_revision in self.waiting.values():
+                        self.close_connection(handler)
+                    self.idle = dict()
+                    self.waiting = dict()
+                    return
+                elif command[0] == 'read':
+                    handler = command[1]
+                    self.idle[handler.request] = handler
+                elif command[0] == 'wait':
+                    handler, old_revision = command[1:]
+                    self.waiting[handler.request] = (handler, old_revision)
+                elif command[0] == 'revision':
+                    revision = command[1]
+                    for sock, (handler, old_revision) in self.waiting.items():
+                        if old_revision != revision:
+                            del self.waiting[sock]
+                            self.jobs.put((lambda h, r=revision:
+                                           self.finish_update(h, r), handler))
+            timeout = self.expire_sessions()
+            rset = [self.wakeup_r] + self.idle.keys() + self.waiting.keys()
+            try:
+                r, w, x = select.select(rset, [], [], timeout)
+            except select.error, (err, errstring):
+                if err == errno.EINTR:
+                    continue
+                raise
+            for sock in r:
+                if sock is self.wakeup_r:
+                    try:
+                        while self.wakeup_r.recv(1024):
+                            pass
+                    except socket.error:
+                        pass
+                elif sock in self.idle:
+                    handler = self.idle.pop(sock)
+                    self.jobs.put((self.serve_request, handler))
+                elif sock in self.waiting:
+                    # The client went away, or it wants something else
+                    # while its update is still waiting.  Like a directed
+                    # wakeup: answer with the revision we have now.
+                    handler, old_revision = self.waiting.pop(sock)
+                    revision = self.revision
+                    self.jobs.put((lambda h, r=revision:
+                                   self.finish_update(h, r), handler))
+
+    def server_close(self):
+        remove_listener = getattr(self.backend, 'remove_revision_listener',
+                                  None)
+        if remove_listener:
+            remove_listener(self.revision_changed)
+        if self.poll_thread:
+            self.poll_command('quit')
+            self.poll_thread.join()
+            self.poll_thread = None
+            # Workers in the middle of a request will quit when done.
+            for worker in self.workers:
+                self.jobs.put(None)
+            self.workers = []
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+        SocketServer.TCPServer.server_close(self)
+
 class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     server_version = 'daap.py' + ' ' + VERSION
-
-    # Not used at the moment.
-    # def __init__(self, request, client_address, server):
-    #    super(BaseHTTPRequestHandler, self).__init__(self, request,
-    #                                                   client_address,
-    #                                                   server)
+    # setup() sets this on the socket, so that a client which stops halfway
+    # through a request can't hold onto a worker thread forever.
+    timeout = DAAP_REQUEST_TIMEOUT
+
+    def __init__(self, request, client_address, server):
+        # Unlike the BaseRequestHandler, don't handle the connection here.
+        # The server calls handle_one_request() for each request as it
+        # comes in and finish() when the connection is closed.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.close_connection = 1
+        # Old revision the client is waiting to change, while its /update
+        # is parked by the server.
+        self.update_wait = None
+        self.setup()
     def log_message(self, format, *args):
         if self.server.log_message_callback:
             self.server.log_message_callback(format, *args)
@@ -247,11 +537,17 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            send_to = getattr(blob, 'send_to', None)
+            if send_to:
+                # Files go straight to the socket, skipping wfile.
+                self.wfile.flush()
+                send_to(self.connection)
+            else:
+                for chunk in blob:
+                    self.wfile.write(chunk)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
-        except IOError:
+        except (IOError, OSError):
             session = getattr(self, 'session', 0)
             if session:
                 self.server.del_session(session)
@@ -357,11 +653,21 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             return (DAAP_BADREQUEST, [], [])
         if not session:
             return (DAAP_FORBIDDEN, [], [])
+        if self.server.revision is not None:
+            # Let the server park the request until the revision changes.
+            self.update_wait = old_revision
+            return (None, [], [])
         revision = self.server.backend.get_revision(session, old_revision,
                                                     self.request)
-        reply = []
-        reply.append(('mupd', [('mstt', DAAP_OK), ('musr', revision)]))
-        return (DAAP_OK, reply, [])
+        return (DAAP_OK, self.make_update_reply(revision), [])
+
+    def make_update_reply(self, revision):
+        return [('mupd', [('mstt', DAAP_OK), ('musr', revision)])]
+
+    def send_update(self, revision):
+        self.do_send_reply(DAAP_OK, self.make_update_reply(revision),
+                           content_encoding=self.reply_encoding())
+        self.wfile.flush()
 
     def do_stream_file(self, db_id, item_id, ext, chunk):
         rc = DAAP_OK
@@ -381,10 +687,14 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     seekend = 0
                 rc = DAAP_PARTIAL_CONTENT
         generation = threading.current_thread().generation
-        file_obj, hint = self.server.backend.get_file(item_id, generation, ext,
-                                                self.get_session(),
+        try:
+            file_obj, hint = self.server.backend.get_file(item_id, generation,
+                                                ext, self.get_session(),
                                                 self.get_request_path,
                                                 offset=seekpos, chunk=chunk)
+        except ServiceUnavailable, e:
+            extra_headers.append(('Retry-After', str(e.retry_after)))
+            return (DAAP_UNAVAILABLE, [], extra_headers)
         if not file_obj:
             return (DAAP_FILENOTFOUND, [], extra_headers)
         self.log_message('daap server: streaming with filobj %s', file_obj)
@@ -416,7 +726,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             npl = 1 + len([p for p in playlists.values() if p['valid']])
             db.append(('mlit', [
                                 ('miid', 1),    # Item ID
-                                ('mper', 1),    # Persistent ID
+                                ('mper', self.server.persistent_id),
                                 ('minm', name), # Name
                                 ('mimc', count),# Total count
                                 # Playlist is always non-zero because of
@@ -457,6 +767,11 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             delta = int(query['delta'])
         except (KeyError, ValueError):
             pass
+        # If the backend can't give changes since that revision (e.g. it is
+        # from before the server restarted), send everything instead.
+        valid_delta = getattr(self.server.backend, 'valid_delta', None)
+        if delta and valid_delta and not valid_delta(delta):
+            delta = 0
         return revision, delta
     
     # do_database_xxx(self, path, query): helper functions.  Session already
@@ -545,38 +860,35 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         backend_id = playlist_id
         if backend_id == 2:
             backend_id = None
-        items = self.server.backend.get_items(playlist_id=backend_id)
+        revision, delta = self.get_revision(query) 
+        # Backends which keep track of their changes can hand us just the
+        # items changed since delta.
+        get_changed_items = getattr(self.server.backend, 'get_changed_items',
+                                    None)
+        if get_changed_items:
+            items = get_changed_items(playlist_id=backend_id, revision=delta)
+        else:
+            items = self.server.backend.get_items(playlist_id=backend_id)
         itemlist = []
         deleted = []
         try:
             meta = query['meta']
         except KeyError:
             meta = DEFAULT_DAAP_META
-        revision, delta = self.get_revision(query) 
-        meta_list = [m.strip() for m in meta.split(',')]
-        # NB: mikd must be the first guy in the listing.
-        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
-        # it doesn't work!
+        meta_list = tuple([m.strip() for m in meta.split(',')])
+        # Backends may keep already encoded items around, keyed by the
+        # meta list and invalidated by the item revision.
+        get_encoded_item = getattr(self.server.backend, 'get_encoded_item',
+                                   None)
         for k in items.keys():
             itemprop = items[k]
-            if itemprop['revision'] <= delta:
+            if not get_changed_items and itemprop['revision'] <= delta:
                 continue
             if itemprop['valid']:
-                item = []
-                for m in meta_list:
-                    if m in itemprop.keys():
-                        try:
-                            code = dmap_consts_rmap[m]
-                        except KeyError:
-                            continue
-                        if itemprop[m] is not None:
-                            attribute = (code, itemprop[m])
-                            item.append(attribute)
-                itemlist.append(('mlit', [       # Listing item
-                                      # item kind - seems OK to hardcode this.
-                                          ('mikd', DAAP_ITEMKIND_AUDIO),
-                                         ] + item
-                           )) 
+                if get_encoded_item:
+                    itemlist.append(get_encoded_item(k, itemprop, meta_list))
+                else:
+                    itemlist.append(make_item_listing(itemprop, meta_list))
             else:
                 deleted.append(('miid', k))
 
@@ -679,6 +991,9 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             rcode = DAAP_BADREQUEST
             reply = []
             extra_headers = []
+        if rcode is None:
+            # Deferred: the server sends the reply later.
+            return
         try:
             content_encoding = self.reply_encoding()
             self.do_send_reply(rcode, reply, extra_headers=extra_headers,
@@ -795,7 +1110,8 @@ def runloop(daapserver):
     daapserver.serve_forever()
 
 def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
-                     max_conn=DAAP_MAXCONN, robust=True):
+                     max_conn=DAAP_MAXCONN, robust=True,
+                     workers=DAAP_WORKERS):
     handler = DaapHttpRequestHandler
     failed = False
     while True:
@@ -815,6 +1131,7 @@ def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
     httpd.set_name(name)
     httpd.set_backend(backend)
     httpd.set_maxconn(max_conn)
+    httpd.set_workers(workers)
     return httpd
 
 ###############################################################################
@@ -835,15 +1152,21 @@ def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
 # HTTP/1.1.
 class DaapClient(object):
     HEARTBEAT = 60    # seconds
-    def __init__(self, host, port, gzip=False):
+    def __init__(self, host, port, gzip=False, timeout=None):
         self.conn = None
         self.host = host
         self.port = port
         self.gzip = gzip
+        # Socket timeout for the control connection (None: system default)
+        self.timeout = timeout
         self.session = None
         self.headers = dict()
         self.old_revision = self.revision = 1
         self.supports_update = False
+        self.db_persistent_id = None
+        # Whether the last playlist or item listing was a full one, even if
+        # we asked only for the changes.
+        self.full_listing = True
         if self.gzip:
            self.headers['Accept-encoding'] = 'gzip, identity'
 
@@ -901,6 +1224,7 @@ class DaapClient(object):
         db = find_daap_tag('mlit', db_list)
         self.db_id = find_daap_tag('miid', db)
         self.db_name = find_daap_tag('minm', db)
+        self.db_persistent_id = find_daap_tag('mper', db)
 
     def handle_update(self, data):
         revision = find_daap_tag('musr', decode_response(data))
@@ -927,7 +1251,7 @@ class DaapClient(object):
         if deleted is not None:
             for item_id in find_daap_listitems(deleted):
                 deleted_list.append(item_id)
-
+        self.full_listing = find_update_type(r) == 0
         self.daap_playlists = (playlist_dict, deleted_list)
 
     def handle_items(self, data, playlist_id, meta):
@@ -950,6 +1274,7 @@ class DaapClient(object):
         if deleted is not None:
             for item_id in find_daap_listitems(deleted):
                 deleted_list.append(item_id)
+        self.full_listing = find_update_type(r) == 0
         self.daap_items = itemdict, deleted_list
 
     def sessionize(self, request, query):
@@ -964,7 +1289,11 @@ class DaapClient(object):
 
     def connect(self):
         try:
-            self.conn = httplib.HTTPConnection(self.host, self.port)
+            if self.timeout is None:
+                self.conn = httplib.HTTPConnection(self.host, self.port)
+            else:
+                self.conn = httplib.HTTPConnection(self.host, self.port,
+                                                   timeout=self.timeout)
             self.conn.request('GET', '/server-info', headers=self.headers)
             self.check_reply(self.conn.getresponse(),
                              callback=self.handle_server_info)
@@ -1124,8 +1453,8 @@ class DaapClient(object):
         fn += '?session-id=%s' % self.session
         return fn
 
-def make_daap_client(host, port=DEFAULT_PORT, gzip=True):
-    return DaapClient(host, port, gzip=gzip)
+def make_daap_client(host, port=DEFAULT_PORT, gzip=True, timeout=None):
+    return DaapClient(host, port, gzip=gzip, timeout=timeout)
 
 def register_meta(meta, code, typ):
     dmap_consts[code] = (meta, typ)
@@ -28,6 +28,8 @@
 
 # subr.py
 
+import errno
+import mmap
 import os
 import stat
 import struct
@@ -40,6 +42,21 @@ except ImportError:
     from StringIO import StringIO
 from const import *
 
+# Zero-copy file transmission: os.sendfile where Python has it, otherwise
+# the pysendfile module, which has the same interface.
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+# sendfile() errors meaning it can't be used with this file or socket.
+SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                        getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+                        getattr(errno, 'ENOTSUP', errno.EINVAL))
+
 # XXX calcsize()?  We need to do some overriding however.
 fmts = {
     DMAP_TYPE_LIST: ('0s', 0),
@@ -102,6 +119,15 @@ class ChunkedStreamObj(object):
            write(chunk)
     """
     DEFAULT_CHUNK_SIZE = 128 * 1024
+    SEND_WINDOW = 16 * 1024 * 1024
+
+    # send_to() methods, in order of preference.  Turn them off to force the
+    # fallbacks.  Memory maps are off by default: if the file gets truncated
+    # or replaced while it's mapped, touching the missing pages raises
+    # SIGBUS, which kills the process instead of raising an exception.  Only
+    # turn them on for complete files that nothing else writes to.
+    use_sendfile = True
+    use_mmap = False
 
     def __init__(self, file_obj, hint, start=0, end=0,
                  chunksize=DEFAULT_CHUNK_SIZE):
@@ -153,6 +179,71 @@ class ChunkedStreamObj(object):
     def __len__(self):
         return self.streamsize
 
+    def send_to(self, sock):
+        """
+           Write the stream to sock.  Uses sendfile() where possible, so the
+           data isn't copied into Python strings, and buffered reads of
+           chunksize bytes otherwise.  See use_mmap for memory maps.
+        """
+        # Anything sent is taken off self.unread, so a fallback carries on
+        # from start + self.streamsize - self.unread.
+        start = self.file_obj.tell()
+        if self.use_sendfile and sendfile is not None:
+            try:
+                self._send_with_sendfile(sock, start)
+                return
+            except OSError, e:
+                # sendfile() fails straight away for files or sockets it
+                # can't handle.
+                if e.errno not in SENDFILE_UNSUPPORTED:
+                    raise
+        if self.use_mmap:
+            try:
+                self._send_with_mmap(sock,
+                                     start + self.streamsize - self.unread)
+                return
+            except (mmap.error, ValueError, OverflowError):
+                # Can't map this file.
+                pass
+        self.file_obj.seek(start + self.streamsize - self.unread,
+                           os.SEEK_SET)
+        for chunk in self:
+            sock.sendall(chunk)
+
+    def _send_with_sendfile(self, sock, offset):
+        fileno = self.file_obj.fileno()
+        sock_fileno = sock.fileno()
+        while self.unread:
+            sent = sendfile(sock_fileno, fileno, offset,
+                            min(self.unread, self.SEND_WINDOW))
+            if not sent:
+                # Maybe file got truncated
+                break
+            offset += sent
+            self.unread -= sent
+        self.file_obj.seek(offset, os.SEEK_SET)
+
+    def _send_with_mmap(self, sock, offset):
+        fileno = self.file_obj.fileno()
+        filesize = os.fstat(fileno)[stat.ST_SIZE]
+        while self.unread and offset < filesize:
+            # Map a window at a time, so this works for files larger than
+            # the address space.  The mapping must start at a multiple of
+            # the allocation granularity.
+            base = offset - offset % mmap.ALLOCATIONGRANULARITY
+            length = min(offset - base + self.unread, self.SEND_WINDOW,
+                         filesize - base)
+            data = mmap.mmap(fileno, length, access=mmap.ACCESS_READ,
+                             offset=base)
+            try:
+                size = length - (offset - base)
+                sock.sendall(buffer(data, offset - base, size))
+            finally:
+                data.close()
+            offset += size
+            self.unread -= size
+        self.file_obj.seek(offset, os.SEEK_SET)
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -232,6 +323,42 @@ def find_daap_tag(searchtag, data):
     except (RuntimeError, ValueError):
         return None
 
+def find_update_type(data):
+    """find_update_type(data) -> update type
+
+    Returns the 'muty' tag of a decoded reply: 0 if it is a full listing, 1 if
+    it only has the changes.  Unlike find_daap_tag() this can tell a zero
+    value from a missing one (None).
+    """
+    try:
+        for tag, value in data:
+            if type(value) == list:
+                for subtag, subvalue in value:
+                    if subtag == 'muty':
+                        return subvalue
+    except ValueError:
+        pass
+    return None
+
+# Precompiled packers: the tag header, and header plus value for each of the
+# fixed size types.  Strings and lists are written as a header followed by
+# the payload.
+_header = struct.Struct('!4sI')
+_packers = dict()
+_unpackers = dict()
+for _typ, (_fmt, _size) in fmts.items():
+    if _typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING):
+        _packers[_typ] = struct.Struct('!4sI' + _fmt)
+        _unpackers[_typ] = struct.Struct('!' + _fmt)
+
+class EncodedTag(str):
+    """
+       A tag which has already been through encode_tags().  It may be
+       placed in a reply list instead of a (code, value) tuple and is
+       copied to the output unchanged.
+    """
+    pass
+
 def decode_response(reply):
     """
        decode_response(reply) -> reply
@@ -242,40 +369,124 @@ def decode_response(reply):
        Things in a DMAP_TYPE_LIST container will contain a list with other
        response codes.
     """
+    return _decode_tags(reply, 0, len(reply))
+
+def _decode_tags(reply, offset, end):
     # This must be wrapped around a try ... except block in case the other
-    # end lies to us about the size of the individual items.
+    # end lies to us about the size of the individual items.  The buffer is
+    # never sliced: we walk it with offsets, bounded by end for containers.
     decoded = []
+    headersize = _header.size
     try:
-        while reply:
-            headerfmt = '!4sI'
-            headersize = struct.calcsize(headerfmt)
-            code, size = struct.unpack(headerfmt, reply[:headersize])
-            reply = reply[headersize:]
+        while offset < end:
+            if offset + headersize > end:
+                raise struct.error('truncated header')
+            code, size = _header.unpack_from(reply, offset)
+            offset += headersize
             realname, realtype = dmap_consts[code]
             realfmt, realsize = fmts[realtype]
-            # XXX check size == realsize
             if realtype == DMAP_TYPE_LIST:
                 decoded.append((code,
-                                decode_response(reply[:size])))
+                                _decode_tags(reply, offset,
+                                             min(offset + size, end))))
                 # next guy
-                reply = reply[size:]
+                offset += size
                 continue
+            if realtype != DMAP_TYPE_STRING and realsize != size:
+                raise ValueError
+            if offset + size > end:
+                raise struct.error('truncated value')
             if realtype == DMAP_TYPE_STRING:
-                # overwrite the size for string with the size specified
-                # by the server.
-                realfmt = str(size) + realfmt 
+                # the size for string is the size specified by the server.
+                value = reply[offset:offset + size]
             else:
-                if realsize != size:
-                    raise ValueError
-                realfmt = '!' + realfmt
-            realfmtsize = struct.calcsize(realfmt)
-            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
+                (value, ) = _unpackers[realtype].unpack_from(reply, offset)
             decoded.append((code, value))
-            reply = reply[realfmtsize:]
+            offset += size
         return decoded
     except (struct.error, KeyError, ValueError), e:
         return [(-1, [])]
 
+def _encode_tags(reply, parts):
+    # Append the encoded reply to parts, returning the number of bytes
+    # added.  A container header is reserved in parts before its children
+    # are written and filled in once their total length is known, so the
+    # whole response is built in one pass and joined once at the end.
+    total = 0
+    for tag in reply:
+        if isinstance(tag, EncodedTag):
+            parts.append(tag)
+            total += len(tag)
+            continue
+        code, value = tag
+        nam, typ = dmap_consts[code]
+        if typ == DMAP_TYPE_LIST:
+            index = len(parts)
+            parts.append(None)
+            size = _encode_tags(value, parts)
+            parts[index] = _header.pack(code, size)
+            total += _header.size + size
+        elif typ == DMAP_TYPE_STRING:
+            size = len(value)
+            if not isinstance(value, str):
+                # This ensures we always get a string type even if we are
+                # lame and passed a unicode in.
+                value = str(buffer(value))[:size].ljust(size, '\0')
+            parts.append(_header.pack(code, size))
+            parts.append(value)
+            total += _header.size + size
+        else:
+            # code (4 bytes), length (4 bytes), data, network byte order
+            try:
+                data = _packers[typ].pack(code, fmts[typ][1], value)
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                continue
+            parts.append(data)
+            total += len(data)
+    return total
+
+def encode_tags(reply):
+    """
+       encode_tags(reply) -> str
+
+       Encode a list of (code, value) tuples into its wire representation.
+    """
+    parts = []
+    _encode_tags(reply, parts)
+    return ''.join(parts)
+
+def make_item_listing(itemprop, meta_list):
+    """
+       make_item_listing(itemprop, meta_list) -> (code, value)
+
+       Build the mlit listing of an item, containing the attributes in
+       meta_list in order.
+    """
+    # NB: mikd must be the first guy in the listing.
+    # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
+    # it doesn't work!
+    item = [('mikd', DAAP_ITEMKIND_AUDIO)]  # item kind - OK to hardcode this.
+    for m in meta_list:
+        value = itemprop.get(m)
+        if value is None:
+            continue
+        try:
+            code = dmap_consts_rmap[m]
+        except KeyError:
+            continue
+        item.append((code, value))
+    return ('mlit', item)
+
+def encode_item(itemprop, meta_list):
+    """
+       encode_item(itemprop, meta_list) -> EncodedTag
+
+       Like make_item_listing() but returns the listing already encoded, so
+       that it can be cached by a backend and reused across replies.
+    """
+    return EncodedTag(encode_tags([make_item_listing(itemprop, meta_list)]))
+
 def encode_response(reply, content_encoding=None):
     """
        encode_response(reply) -> StreamObj/ChunkedStreamObj
@@ -285,41 +496,15 @@ def encode_response(reply, content_encoding=None):
        to send over the wire.
 
        DMAP_TYPE_LIST should have a value of list containing other response
-       codes.
+       codes.  Pre-encoded EncodedTag objects may appear anywhere a (code,
+       value) tuple can.
 
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        blob = StreamObj(encode_tags(reply),
+                         content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
@@ -0,0 +1,174 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.mediainfocache`` -- Cache what ffmpeg has to say about media files.
+
+transcode.needs_transcode() and conversions.get_media_info() both run
+``ffmpeg -i`` on a file and parse what it prints.  Launching ffmpeg takes a
+good fraction of a second, and both get called again and again for the same
+files: each time an item is streamed (including seeks) and each time the
+conversion dialog or a device sync looks at it.
+
+MediaInfoCache keeps ffmpeg's output in an sqlite file, keyed by path, size
+and mtime.  A file that changes gets a new entry the next time it's asked
+about; entries that haven't been used for a while are thrown out when the
+cache grows past MAX_ENTRIES.
+"""
+
+import logging
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from miro import app
+from miro import fileutil
+from miro import prefs
+from miro import util
+from miro.util import returns_filename
+from miro.plat.utils import get_ffmpeg_executable_path
+
+def run_ffmpeg(path):
+    """Run ``ffmpeg -i`` on path and return what it prints."""
+    retcode, stdout, stderr = util.call_command(
+        get_ffmpeg_executable_path(), "-i", "%s" % path,
+        return_everything=True, close_fds=True)
+    # ffmpeg complains that we didn't give it an output file, so the
+    # return code doesn't tell us anything.
+    if stdout:
+        return stdout
+    return stderr
+
+def get_ffmpeg_output(path):
+    """Get the output of ``ffmpeg -i`` for path, from the cache if we have
+    one.
+    """
+    if app.media_info_cache is not None:
+        return app.media_info_cache.get_ffmpeg_output(path)
+    return run_ffmpeg(path)
+
+@returns_filename
+def generate_media_info_cache_filename():
+    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+    return os.path.join(support_dir, 'mediainfo.sqlite')
+
+class MediaInfoCache(object):
+    """Stores the output of ``ffmpeg -i`` for media files.  Can be used from
+    any thread.
+    """
+
+    MAX_ENTRIES = 20000
+    # Check whether we are over MAX_ENTRIES after this many new entries.
+    PRUNE_INTERVAL = 500
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+        self.added = 0
+
+    def _ensure_connection(self):
+        if self.connection is not None:
+            return
+        path = generate_media_info_cache_filename()
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            fileutil.makedirs(directory)
+        self.connection = sqlite3.connect(path, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS media_info "
+                                "(path TEXT PRIMARY KEY, size INTEGER, "
+                                "mtime REAL, last_used REAL, output BLOB)")
+
+    def get_ffmpeg_output(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Let ffmpeg complain about it.
+            return run_ffmpeg(path)
+        output = self._lookup(path, st.st_size, st.st_mtime)
+        if output is None:
+            output = run_ffmpeg(path)
+            # Don't hang on to failed runs (ffmpeg missing, file still
+            # being written, ...), only output that describes the file.
+            if "Input #" in output:
+                self._store(path, st.st_size, st.st_mtime, output)
+        return output
+
+    def _lookup(self, path, size, mtime):
+        with self.lock:
+            try:
+                self._ensure_connection()
+                row = self.connection.execute("SELECT size, mtime, output "
+                                              "FROM media_info WHERE path=?",
+                                              (path,)).fetchone()
+                if row is None or row[0] != size or row[1] != mtime:
+                    return None
+                self.connection.execute("UPDATE media_info SET last_used=? "
+                                        "WHERE path=?", (time.time(), path))
+                return str(row[2])
+            except (sqlite3.Error, OSError):
+                logging.exception("Error reading media info cache")
+                return None
+
+    def _store(self, path, size, mtime, output):
+        with self.lock:
+            try:
+                self._ensure_connection()
+                self.connection.execute("INSERT OR REPLACE INTO media_info "
+                                        "(path, size, mtime, last_used, "
+                                        "output) VALUES (?, ?, ?, ?, ?)",
+                                        (path, size, mtime, time.time(),
+                                         sqlite3.Binary(output)))
+                self.added += 1
+                if self.added % self.PRUNE_INTERVAL == 0:
+                    self._prune()
+            except (sqlite3.Error, OSError):
+                logging.exception("Error writing media info cache")
+
+    # At this point: lock acquired
+    def _prune(self):
+        count = self.connection.execute("SELECT COUNT(*) "
+                                        "FROM media_info").fetchone()[0]
+        if count <= self.MAX_ENTRIES:
+            return
+        self.connection.execute("DELETE FROM media_info WHERE path IN "
+                                "(SELECT path FROM media_info "
+                                "ORDER BY last_used LIMIT ?)",
+                                (count - self.MAX_ENTRIES,))
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = None
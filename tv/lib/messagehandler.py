@@ -1775,6 +1775,9 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         m = messages.CurrentGlobalState(info)
         m.send_to_frontend()
 
+    def handle_query_downloader_restore_progress(self, message):
+        app.download_state_manager.send_restore_progress()
+
     def handle_set_device_type(self, message):
         message.device.database[u'device_name'] = message.name
         app.device_manager.device_changed(message.device.id,
@@ -1828,6 +1831,7 @@ New ids: %s""", playlist_item_ids, message.item_ids)
                                       args=(message,))
                 return
         devices.write_database(message.device.database, message.device.mount)
+        message.device.database.detach_store()
         message.device.metadata_manager.close()
         message.device.sqlite_database.close()
         app.device_tracker.eject(message.device)
@@ -797,6 +797,11 @@ class QueryGlobalState(BackendMessage):
     """
     pass
 
+class QueryDownloaderRestoreProgress(BackendMessage):
+    """Ask for a DownloaderRestoreProgress message to be sent back.
+    """
+    pass
+
 class SetDeviceType(BackendMessage):
     """
     Tell the backend which specific type of device we're dealing with.
@@ -1558,10 +1563,16 @@ class ConversionTasksList(FrontendMessage):
 
 class ConversionsCountChanged(FrontendMessage):
     """Informs the frontend that number of running conversions has changed.
+
+    Also includes how many conversions we got from the conversion cache
+    (cache_hits) and how many we couldn't (cache_misses).
     """
-    def __init__(self, running_count, other_count):
+    def __init__(self, running_count, other_count, cache_hits=0,
+                 cache_misses=0):
         self.running_count = running_count
         self.other_count = other_count
+        self.cache_hits = cache_hits
+        self.cache_misses = cache_misses
 
 class ConversionTaskCreated(FrontendMessage):
     """Informs the frontend that a conversion task has been created.
@@ -1826,6 +1837,14 @@ class ProgressDialog(FrontendMessage):
 class ProgressDialogFinished(FrontendMessage):
     pass
 
+class DownloaderRestoreProgress(FrontendMessage):
+    """Inform the frontend of how many downloads have been restored at
+    startup.
+    """
+    def __init__(self, restored, total):
+        self.restored = restored
+        self.total = total
+
 class FeedlessDownloadStarted(FrontendMessage):
     """Inform the frontend that a new video started downloading because a
     subscribe link was clicked.
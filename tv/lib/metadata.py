@@ -1057,6 +1057,10 @@ class MetadataManagerBase(signals.SignalEmitter):
     # items at once.
     UPDATE_INTERVAL = 1.0
     RETRY_TEMPORARY_INTERVAL = 3600
+    # How many extractor results to handle each time the update timer fires.
+    # The rest wait for the next idle callback, so that a big batch doesn't
+    # hold up the event loop.  None means handle them all at once.
+    MAX_UPDATES_PER_RUN = None
 
     def __init__(self, cover_art_dir, screenshot_dir, db_info=None):
         signals.SignalEmitter.__init__(self)
@@ -1094,7 +1098,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.metadata_errors = []
         self._reset_new_metadata()
         self._run_update_caller = eventloop.DelayedFunctionCaller(
-            self.run_updates)
+            self._run_scheduled_updates)
         self._retry_temporary_failure_caller = \
                 eventloop.DelayedFunctionCaller(self.retry_temporary_failures)
         self._calc_incomplete()
@@ -1587,12 +1591,21 @@ class MetadataManagerBase(signals.SignalEmitter):
             'file_type': filetypes.item_file_type_for_filename(path),
         }
 
-    def run_updates(self):
+    def _run_scheduled_updates(self):
+        self.run_updates(self.MAX_UPDATES_PER_RUN)
+        if self.metadata_finished or self.metadata_errors:
+            self._run_update_caller.call_when_idle()
+
+    def run_updates(self, limit=None):
         """Run any pending metadata updates.
 
         As we get metadata in from extractors, we store it up and send one big
         update at a time.  Normally this is scheduled using a timeout, we also
         need to call it at shutdown to flush the pending updates.
+
+        :param limit: handle at most this many results and errors from the
+                      extractors, the rest stay queued.  None means handle
+                      them all.
         """
         # Should this be inside an idle iterator?  It definitely runs slowly
         # when we're running mutagen on a music library, but I think that's to
@@ -1600,8 +1613,8 @@ class MetadataManagerBase(signals.SignalEmitter):
         new_metadata_copy = self.new_metadata
         app.bulk_sql_manager.start()
         try:
-            self._process_metadata_finished()
-            self._process_metadata_errors()
+            self._process_metadata_finished(limit)
+            self._process_metadata_errors(limit)
             self.emit('new-metadata', self.new_metadata)
         finally:
             self._reset_new_metadata()
@@ -1614,8 +1627,12 @@ class MetadataManagerBase(signals.SignalEmitter):
                 raise
         self._send_progress_updates()
 
-    def _process_metadata_finished(self):
-        for (processor, path, result) in self.metadata_finished:
+    def _process_metadata_finished(self, limit=None):
+        if limit is None:
+            limit = len(self.metadata_finished)
+        finished = self.metadata_finished[:limit]
+        self.metadata_finished = self.metadata_finished[limit:]
+        for (processor, path, result) in finished:
             try:
                 status = MetadataStatus.get_by_path(path, self.db_info)
             except database.ObjectNotFoundError:
@@ -1632,7 +1649,6 @@ class MetadataManagerBase(signals.SignalEmitter):
             self.run_next_processor(status)
             if status.current_processor == u'echonest':
                 self.count_tracker.file_finished_local_processing(status.path)
-        self.metadata_finished = []
 
     def _make_new_metadata_entry(self, status, processor, path, result):
         # pop off created_cover_art, that's for us not the MetadataEntry
@@ -1658,8 +1674,12 @@ class MetadataManagerBase(signals.SignalEmitter):
             for path in MetadataStatus.paths_for_album(album, self.db_info):
                 self.new_metadata[path]['cover_art'] = cover_art
 
-    def _process_metadata_errors(self):
-        for (processor, path, error) in self.metadata_errors:
+    def _process_metadata_errors(self, limit=None):
+        if limit is None:
+            limit = len(self.metadata_errors)
+        errors = self.metadata_errors[:limit]
+        self.metadata_errors = self.metadata_errors[limit:]
+        for (processor, path, error) in errors:
             try:
                 status = MetadataStatus.get_by_path(path, self.db_info)
             except database.ObjectNotFoundError:
@@ -1679,7 +1699,6 @@ class MetadataManagerBase(signals.SignalEmitter):
             if processor_status == status.STATUS_TEMPORARY_FAILURE:
                 self._retry_temporary_failure_caller.call_after_timeout(
                     self.RETRY_TEMPORARY_INTERVAL)
-        self.metadata_errors = []
 
     def run_next_processor(self, status):
         """Called after both success and failure of a metadata processor
@@ -1713,6 +1732,10 @@ class LibraryMetadataManager(MetadataManagerBase):
 class DeviceMetadataManager(MetadataManagerBase):
     """MetadataManager for devices."""
 
+    # Plugging in a big device means thousands of results.  Applying them in
+    # small batches keeps the library UI responsive meanwhile.
+    MAX_UPDATES_PER_RUN = 100
+
     def __init__(self, db_info, device_id, mount):
         cover_art_dir = os.path.join(mount, '.miro', 'cover-art')
         screenshot_dir = os.path.join(mount, '.miro', 'screenshots')
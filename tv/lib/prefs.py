@@ -117,7 +117,8 @@ SUBTITLE_ENCODING           = Pref(key='subtitleEncoding',      default=None,  p
 SUBTITLE_FONT               = Pref(key='subtitleFont',          default=None,  platformSpecific=False)
 # language setting: "system" uses system default; all other languages are overrides
 LANGUAGE                    = Pref(key='language',              default="system", platformSpecific=False)
-MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=1, platformSpecific=False)
+# None means one conversion per CPU core
+MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=None, platformSpecific=False)
 SHOW_UNKNOWN_DEVICES        = Pref(key='showUnknownDevices',    default=False, platformSpecific=False)
 SHARE_MEDIA                 = Pref(key='ShareMedia',            default=False, platformSpecific=False)
 SHARE_DISCOVERABLE          = Pref(key='ShareDiscoverable',     default=True, platformSpecific=False)
@@ -126,6 +127,8 @@ SHARE_WARN_ON_QUIT          = Pref(key='ShareWarnOnQuit',       default=True, pl
 SHARE_VIDEO                 = Pref(key='ShareVideo',            default=True, platformSpecific=False)
 SHARE_AUDIO                 = Pref(key='ShareAudio',            default=True, platformSpecific=False)
 SHARE_FEED                  = Pref(key='ShareFeed',             default=True, platformSpecific=False)
+# Hex, as it doesn't fit in the 32-bit ints some config backends use.
+SHARE_PERSISTENT_ID         = Pref(key='SharePersistentID',     default=u'', platformSpecific=False)
 # the musicTabClicked key was used before miro 5.0.  It's been changed because
 # we want to pop up the dialog for users who ran 4.0.x and let them know about
 # internet lookups
@@ -26,9 +26,12 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import bisect
+import cPickle
 import errno
 import logging
 import os
+import Queue
 import sys
 import socket
 import select
@@ -67,6 +70,11 @@ try:
 except ImportError:
     from miro import libdaap
 
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
 DAAP_META = ('dmap.itemkind,dmap.itemid,dmap.itemname,' +
              'dmap.containeritemid,dmap.parentcontainerid,' +
              'daap.songtime,daap.songsize,daap.songformat,' +
@@ -145,6 +153,45 @@ daap_rmapping = {
     'episode_number': 'com.apple.itunes.episode-sort'
 }
 
+# Fields make_item_dict() works out itself rather than copying them over.
+daap_derived_attrs = ('file_format', 'file_type', 'kind')
+
+# Values that repeat across a lot of items.  They are interned so that each
+# artist etc. is only kept in memory once, however many items share it.
+daap_interned_fields = frozenset([
+    'daap.songformat',
+    'daap.songartist',
+    'daap.songalbumartist',
+    'daap.songalbum',
+    'daap.songgenre',
+    'com.apple.itunes.series-name',
+    'org.participatoryculture.miro.itemkind'
+])
+
+def daap_value(daap_string, value):
+    """Convert an ItemInfo attribute into the value we serve for a DAAP
+    field.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+        if daap_string in daap_interned_fields:
+            value = intern(value)
+    # Fixup the year, etc being -1.  XXX should read the daap
+    # type then determine what to do.
+    if value == -1:
+        value = 0
+    # Fixup: these are stored as string?
+    if daap_string in ('daap.songtracknumber', 'daap.songyear'):
+        if value is not None:
+            value = int(value)
+    # Fixup the duration: need to convert to millisecond.
+    if daap_string == 'daap.songtime':
+        if value:
+            value *= DURATION_SCALE
+        else:
+            value = 0
+    return value
+
 # Windows Python does not have inet_ntop().  Sigh.  Fallback to this one,
 # which isn't as good, if we do not have access to it.
 def inet_ntop(af, ip):
@@ -261,6 +308,162 @@ class SharingItem(object):
         # database. Yet.
         pass
 
+class ShareProber(object):
+    """Checks that shares found by mDNS can actually be connected to.
+
+    Probes run in a few threads of their own, so that a handful of
+    unreachable hosts doesn't hold up the rest of discovery (or the
+    eventloop's thread pool).  The connect timeout follows how long probes
+    have been taking on this network, much like TCP's retransmission timer.
+    A probe that times out gets one more try, with MAX_TIMEOUT, at the back
+    of the queue.
+    """
+    THREADS = 4
+    INITIAL_TIMEOUT = 3.0
+    MIN_TIMEOUT = 1.0
+    MAX_TIMEOUT = 10.0
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.srtt = None
+        self.rttvar = None
+
+    def get_timeout(self):
+        with self.lock:
+            if self.srtt is None:
+                return self.INITIAL_TIMEOUT
+            timeout = self.srtt + 4 * self.rttvar
+        return min(max(timeout, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+
+    def record_time(self, elapsed):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = elapsed
+                self.rttvar = elapsed / 2
+            else:
+                self.rttvar = (0.75 * self.rttvar +
+                               0.25 * abs(self.srtt - elapsed))
+                self.srtt = 0.875 * self.srtt + 0.125 * elapsed
+
+    def probe(self, host, port, success, failure):
+        """Test connect to a share.  success or failure is called in the
+        eventloop once we know.
+        """
+        while len(self.threads) < self.THREADS:
+            t = threading.Thread(name='Share Prober - %d' % len(self.threads),
+                                 target=thread_body,
+                                 args=[self.thread_loop])
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+        self.queue.put((host, port, success, failure, None))
+
+    def testconnect(self, host, port, timeout):
+        client = libdaap.make_daap_client(host, port, timeout=timeout)
+        if not client.connect():
+            return False
+        try:
+            return client.databases() is not None
+        finally:
+            client.disconnect()
+
+    def thread_loop(self):
+        while True:
+            job = self.queue.get()
+            if job == "QUIT":
+                break
+            self.run_probe(*job)
+
+    def run_probe(self, host, port, success, failure, timeout):
+        if timeout is None:
+            timeout = self.get_timeout()
+        start = time.time()
+        try:
+            connected = self.testconnect(host, port, timeout)
+        except StandardError:
+            logging.exception('sharing: error probing %s:%s', host, port)
+            connected = False
+        elapsed = time.time() - start
+        if connected:
+            self.record_time(elapsed)
+            callback = success
+        elif elapsed >= timeout and timeout < self.MAX_TIMEOUT:
+            logging.debug('sharing: probe of %s:%s timed out after %.1fs',
+                          host, port, elapsed)
+            self.queue.put((host, port, success, failure, self.MAX_TIMEOUT))
+            return
+        else:
+            callback = failure
+        eventloop.add_idle(callback, 'DAAP test connect', args=(None,))
+
+    def shutdown(self):
+        for t in self.threads:
+            self.queue.put("QUIT")
+        self.threads = []
+
+class KnownShareCache(object):
+    """Remembers the shares we managed to connect to recently, so that they
+    can go in the sidebar at startup without waiting for mDNS to find them
+    again.  Only used from the eventloop.
+    """
+    TTL = 24 * 60 * 60
+
+    def __init__(self):
+        self.connection = None
+
+    def _ensure_connection(self):
+        if self.connection is not None:
+            return
+        path = generate_share_cache_filename()
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            fileutil.makedirs(directory)
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS known_share "
+                                "(host TEXT, port INTEGER, name TEXT, "
+                                "verified REAL, PRIMARY KEY (host, port))")
+
+    def load(self):
+        """Get the shares verified in the last TTL seconds, as a list of
+        (name, host, port) tuples.
+        """
+        try:
+            self._ensure_connection()
+            self.connection.execute("DELETE FROM known_share "
+                                    "WHERE verified < ?",
+                                    (time.time() - self.TTL,))
+            return self.connection.execute("SELECT name, host, port "
+                                           "FROM known_share").fetchall()
+        except (sqlite3.Error, OSError):
+            logging.exception("Error reading known shares")
+            return []
+
+    def add(self, name, host, port):
+        try:
+            self._ensure_connection()
+            self.connection.execute("INSERT OR REPLACE INTO known_share "
+                                    "(host, port, name, verified) "
+                                    "VALUES (?, ?, ?, ?)",
+                                    (host, port, name, time.time()))
+        except (sqlite3.Error, OSError):
+            logging.exception("Error writing known shares")
+
+    def remove(self, host, port):
+        try:
+            self._ensure_connection()
+            self.connection.execute("DELETE FROM known_share "
+                                    "WHERE host=? AND port=?", (host, port))
+        except (sqlite3.Error, OSError):
+            logging.exception("Error writing known shares")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+
 class SharingTracker(object):
     """The sharing tracker is responsible for listening for available music
     shares and the main client connection code.  For each connected share,
@@ -272,11 +475,19 @@ class SharingTracker(object):
     CMD_QUIT = 'quit'
     CMD_PAUSE = 'paus'
     CMD_RESUME = 'resm'
+    # How long a share can be missing from mDNS before we take it away.
+    # Announcements flap, so don't act on a removal straight away.
+    FLAP_DELAY = 2
+    # How long shares remembered from last time stay in the sidebar
+    # without being found by mDNS.
+    DISCOVERY_GRACE = 10
 
     def __init__(self):
         self.name_to_id_map = dict()
         self.trackers = dict()
         self.available_shares = dict()
+        self.prober = ShareProber()
+        self.known_shares = KnownShareCache()
         self.r, self.w = util.make_dummy_socket_pair()
         self.paused = True
         self.event = threading.Event()
@@ -299,6 +510,7 @@ class SharingTracker(object):
                 return
             info.connect_uuid = None
             info.share_available = True
+            self.known_shares.add(info.name, host, port)
             messages.TabsChanged('connect', [info], [], []).send_to_frontend()
 
         def failure(unused):
@@ -310,17 +522,9 @@ class SharingTracker(object):
             if not info or info.connect_uuid != uuid:
                 return
             info.connect_uuid = None
+            self.known_shares.remove(host, port)
 
-        def testconnect():
-            client = libdaap.make_daap_client(host, port)
-            if not client.connect() or client.databases() is None:
-                raise IOError('test connect failed')
-            client.disconnect()
-
-        eventloop.call_in_thread(success,
-                                 failure,
-                                 testconnect,
-                                 'DAAP test connect')
+        self.prober.probe(host, port, success, failure)
 
     def mdns_callback_backend(self, added, fullname, host, port):
         # SAFE: the shared name should be unique.  (Or else you could not
@@ -390,15 +594,20 @@ class SharingTracker(object):
                 if share_id in self.available_shares.keys():
                     info = self.available_shares[share_id]
                     info.name = fullname
+                    if info.stale_callback:
+                        info.stale_callback.cancel()
+                        info.stale_callback = None
                     if info.share_available:
                         logging.debug('Share already registered and '
                                       'available, sending TabsChanged only')
-                        if info.stale_callback:
-                            info.stale_callback.cancel()
-                            info.stale_callback = None
                         message = messages.TabsChanged('connect', [],
                                                        [info], [])
                         message.send_to_frontend()
+                    elif info.connect_uuid is None:
+                        # The last probe failed, maybe it's back up now.
+                        info.connect_uuid = uuid.uuid4()
+                        self.try_to_add(share_id, fullname, host, port,
+                                        info.connect_uuid)
                     return
                 info = messages.SharingInfo(share_id, share_id,
                                             fullname, host, port)
@@ -407,36 +616,57 @@ class SharingTracker(object):
                 self.try_to_add(share_id, fullname, host, port,
                                     info.connect_uuid)
         else:
-            # The mDNS publish is going away.  Are we connected?  If we
-            # are connected, keep it around.  If not, make it disappear.
+            # The mDNS publish is going away.  We don't know if the share's
+            # alive or not: announcements flap, and a connected share may
+            # just be getting renamed.  Give it FLAP_DELAY seconds, if no
+            # added message comes in, assume it's gone bye...
             # SharingDisappeared() kicks off the necessary bits in the 
             # frontend for us.
-            if not share_id in self.trackers.keys():
-                victim = self.available_shares[share_id]
-                del self.available_shares[share_id]
-                # Only tell the frontend if the share's been tested because
-                # otherwise the TabsChanged() message wouldn't have arrived.
-                if victim.connect_uuid is None:
-                    messages.SharingDisappeared(victim).send_to_frontend()
-            else:
-                # We don't know if the share's alive or not... what to do
-                # here?  Let's add a timeout of 2 secs, if no added message
-                # comes in, assume it's gone bye...
-                share_info = self.available_shares[share_id]
+            share_info = self.available_shares[share_id]
+            if share_id in self.trackers.keys():
                 share = self.trackers[share_id]
                 if share.share != share_info:
                     logging.error('Share disconn error: share info != share')
-                dc = eventloop.add_timeout(2, self.remove_timeout_callback,
-                                      "share tab removal timeout callback",
-                                      args=(share_id, share_info))
-                # Cancel pending callback is there is one.
-                if share.share.stale_callback:
-                    share.share.stale_callback.cancel()
-                share.share.stale_callback = dc
+            dc = eventloop.add_timeout(self.FLAP_DELAY,
+                                       self.remove_timeout_callback,
+                                       "share tab removal timeout callback",
+                                       args=(share_id, share_info))
+            # Cancel pending callback is there is one.
+            if share_info.stale_callback:
+                share_info.stale_callback.cancel()
+            share_info.stale_callback = dc
 
     def remove_timeout_callback(self, share_id, share_info):
+        if self.available_shares.get(share_id) is not share_info:
+            return
         del self.available_shares[share_id]
-        messages.SharingDisappeared(share_info).send_to_frontend()
+        self.known_shares.remove(share_info.host, share_info.port)
+        # Only tell the frontend if the share's been shown, otherwise the
+        # TabsChanged() message wouldn't have arrived.
+        if share_info.share_available:
+            messages.SharingDisappeared(share_info).send_to_frontend()
+
+    def show_known_shares(self):
+        """Put the shares we connected to recently in the sidebar.  They
+        are taken away again if mDNS doesn't find them within
+        DISCOVERY_GRACE seconds.
+        """
+        infos = []
+        for name, host, port in self.known_shares.load():
+            share_id = (host, port)
+            if share_id in self.available_shares:
+                continue
+            info = messages.SharingInfo(share_id, share_id, name, host, port)
+            info.connect_uuid = None
+            info.share_available = True
+            info.stale_callback = eventloop.add_timeout(self.DISCOVERY_GRACE,
+                                          self.remove_timeout_callback,
+                                          "known share timeout callback",
+                                          args=(share_id, info))
+            self.available_shares[share_id] = info
+            infos.append(info)
+        if infos:
+            messages.TabsChanged('connect', infos, [], []).send_to_frontend()
 
     def server_thread(self):
         # Wait for the resume message from the sharing manager as 
@@ -499,6 +729,8 @@ class SharingTracker(object):
                 pass
 
     def start_tracking(self):
+        if app.sharing_manager.mdns_present:
+            self.show_known_shares()
         # sigh.  New thread.  Unfortunately it's kind of hard to integrate
         # it into the application runloop at this moment ...
         self.thread = threading.Thread(target=thread_body,
@@ -527,6 +759,8 @@ class SharingTracker(object):
     def stop_tracking(self):
         # What to do in case of socket error here?
         self.w.send(SharingTracker.CMD_QUIT)
+        self.prober.shutdown()
+        self.known_shares.close()
 
     # pause/resume is only meant to be used by the sharing manager.
     # Pause needs to be synchronous because we want to make sure this module
@@ -541,6 +775,176 @@ class SharingTracker(object):
         # What to do in case of socket error here?
         self.w.send(SharingTracker.CMD_RESUME)
 
+@returns_filename
+def generate_share_cache_filename():
+    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+    return os.path.join(support_dir, 'sharecache.sqlite')
+
+class ShareListingCache(object):
+    """Keeps the listing of a remote share on disk, so that the next time
+    we connect it can be shown straight away and only the changes since
+    then need to be fetched.
+
+    Listings are kept as the raw DAAP dicts, under a key made of the server's
+    persistent id and database id.  Each instance belongs to one
+    SharingItemTrackerImpl and is only used from its thread.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.connection = None
+        self.revision = None
+        self.base_playlist = None
+        self.playlists = dict()     # Playlist id -> raw playlist
+        self.item_ids = set()       # Items in the base playlist
+        self.members = dict()       # Playlist id -> set of item ids
+
+    def _ensure_connection(self):
+        if self.connection is not None:
+            return
+        path = generate_share_cache_filename()
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            fileutil.makedirs(directory)
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS share "
+                                "(key TEXT PRIMARY KEY, revision INTEGER, "
+                                "base_playlist INTEGER, playlists BLOB)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS item "
+                                "(share TEXT, item_id INTEGER, data BLOB, "
+                                "PRIMARY KEY (share, item_id))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS playlist_item "
+                                "(share TEXT, playlist_id INTEGER, "
+                                "item_id INTEGER, "
+                                "PRIMARY KEY (share, playlist_id, item_id))")
+
+    def load(self):
+        """Read the cached listing.
+
+        Returns (items, members): the raw items by id, and the ids of the
+        items in each playlist.  Returns None if there is nothing cached.
+        """
+        try:
+            self._ensure_connection()
+            row = self.connection.execute("SELECT revision, base_playlist, "
+                                          "playlists FROM share WHERE key=?",
+                                          (self.key,)).fetchone()
+            if row is None:
+                return None
+            cursor = self.connection.execute("SELECT item_id, data FROM item "
+                                             "WHERE share=?", (self.key,))
+            items = dict((item_id, cPickle.loads(str(data)))
+                         for item_id, data in cursor)
+            cursor = self.connection.execute("SELECT playlist_id, item_id "
+                                             "FROM playlist_item "
+                                             "WHERE share=?", (self.key,))
+            members = dict()
+            for playlist_id, item_id in cursor:
+                members.setdefault(playlist_id, set()).add(item_id)
+            playlists = cPickle.loads(str(row[2]))
+        except (sqlite3.Error, OSError, cPickle.UnpicklingError, EOFError):
+            logging.exception("Error loading share listing cache")
+            return None
+        self.revision, self.base_playlist = row[0], row[1]
+        self.playlists = playlists
+        self.item_ids = set(items)
+        for playlist_id in playlists:
+            members.setdefault(playlist_id, set())
+        members.pop(self.base_playlist, None)
+        self.members = members
+        return items, members
+
+    def get_item(self, item_id):
+        """Get a cached raw item, or None if we don't have it."""
+        try:
+            self._ensure_connection()
+            row = self.connection.execute("SELECT data FROM item "
+                                          "WHERE share=? AND item_id=?",
+                                          (self.key, item_id)).fetchone()
+            if row is not None:
+                return cPickle.loads(str(row[0]))
+        except (sqlite3.Error, OSError, cPickle.UnpicklingError, EOFError):
+            logging.exception("Error reading share listing cache")
+        return None
+
+    def save(self, revision, base_playlist, playlists, deleted_playlists,
+             items, deleted_items, members, deleted_members, full):
+        """Record a listing fetched from the server.
+
+        playlists and items are raw dicts by id; members and deleted_members
+        map playlist ids to the item ids added to and removed from them.  If
+        full is True the listing replaces what we had, otherwise it is
+        applied as changes to it.
+        """
+        if full:
+            new_playlists = dict(playlists)
+        else:
+            new_playlists = dict(self.playlists)
+            new_playlists.update(playlists)
+            for playlist_id in deleted_playlists:
+                new_playlists.pop(playlist_id, None)
+        def pickle(obj):
+            return sqlite3.Binary(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+        try:
+            self._ensure_connection()
+            self.connection.execute("BEGIN")
+            if full:
+                self.connection.execute("DELETE FROM item WHERE share=?",
+                                        (self.key,))
+                self.connection.execute("DELETE FROM playlist_item "
+                                        "WHERE share=?", (self.key,))
+            else:
+                self.connection.executemany("DELETE FROM playlist_item "
+                        "WHERE share=? AND playlist_id=?",
+                        [(self.key, p) for p in deleted_playlists])
+            self.connection.executemany("INSERT OR REPLACE INTO item "
+                    "(share, item_id, data) VALUES (?, ?, ?)",
+                    [(self.key, k, pickle(v)) for k, v in items.iteritems()])
+            self.connection.executemany("DELETE FROM item "
+                    "WHERE share=? AND item_id=?",
+                    [(self.key, k) for k in deleted_items])
+            for playlist_id, item_ids in members.iteritems():
+                self.connection.executemany("INSERT OR IGNORE INTO "
+                        "playlist_item (share, playlist_id, item_id) "
+                        "VALUES (?, ?, ?)",
+                        [(self.key, playlist_id, k) for k in item_ids])
+            for playlist_id, item_ids in deleted_members.iteritems():
+                self.connection.executemany("DELETE FROM playlist_item "
+                        "WHERE share=? AND playlist_id=? AND item_id=?",
+                        [(self.key, playlist_id, k) for k in item_ids])
+            self.connection.execute("INSERT OR REPLACE INTO share "
+                    "(key, revision, base_playlist, playlists) "
+                    "VALUES (?, ?, ?, ?)",
+                    (self.key, revision, base_playlist,
+                     pickle(new_playlists)))
+            self.connection.execute("COMMIT")
+        except (sqlite3.Error, OSError):
+            logging.exception("Error writing share listing cache")
+            try:
+                self.connection.execute("ROLLBACK")
+            except (sqlite3.Error, AttributeError):
+                pass
+            return
+        if full:
+            self.item_ids = set()
+            self.members = dict()
+        self.item_ids.update(items)
+        self.item_ids.difference_update(deleted_items)
+        for playlist_id in deleted_playlists:
+            self.members.pop(playlist_id, None)
+        for playlist_id, item_ids in members.iteritems():
+            self.members.setdefault(playlist_id, set()).update(item_ids)
+        for playlist_id, item_ids in deleted_members.iteritems():
+            self.members.get(playlist_id, set()).difference_update(item_ids)
+        self.playlists = new_playlists
+        self.revision = revision
+        self.base_playlist = base_playlist
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+
 # Synchronization issues: this code is a bit sneaky, so here is an explanation
 # of how it works.  When you click on a share tab in the frontend, the 
 # display (the item list controller) starts tracking the items.  It does
@@ -580,6 +984,9 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         self.info_cache = dict()
         self.playlists = dict()
         self.base_playlist = None    # Temporary
+        self.cache = None
+        # Whether the listing shown on connect came from the cache.
+        self.showing_cache = False
         self.share.is_updating = True
         message = messages.TabsChanged('connect', [], [self.share], [])
         message.send_to_frontend()
@@ -613,18 +1020,25 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         return succeeded
 
     def runloop(self):
-        success = self.run(self.client_connect, self.client_connect_callback,
-                           self.client_connect_error_callback)
-        # If server does not support update, then we short circuit since
-        # the loop becomes useless.  There is nothing wait for being updated.
-        logging.debug('UPDATE SUPPORTED = %s', self.client.supports_update)
-        if not success or not self.client.supports_update:
-            return
-        while True:
-            success = self.run(self.client_update, self.client_update_callback,
-                               self.client_update_error_callback)
-            if not success:
-                break
+        try:
+            success = self.run(self.client_connect, self.client_connect_done,
+                               self.client_connect_error_callback)
+            # If server does not support update, then we short circuit since
+            # the loop becomes useless.  There is nothing wait for being
+            # updated.
+            logging.debug('UPDATE SUPPORTED = %s',
+                          self.client.supports_update)
+            if not success or not self.client.supports_update:
+                return
+            while True:
+                success = self.run(self.client_update,
+                                   self.client_update_callback,
+                                   self.client_update_error_callback)
+                if not success:
+                    break
+        finally:
+            if self.cache:
+                self.cache.close()
 
     def sharing_item(self, rawitem):
         kwargs = dict()
@@ -710,13 +1124,39 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         # Lousy Windows and Python API.
         address, port = self.client.conn.sock.getpeername()
         self.address = address
+        self.cache = self.open_cache()
+        cached = self.cache.load() if self.cache else None
+        if cached:
+            # Show what we had last time straight away, then fetch only what
+            # changed since.
+            items, members = cached
+            self.base_playlist = self.cache.base_playlist
+            deleted_items = {self.base_playlist: []}
+            listing = self.make_listing(dict(self.cache.playlists), [],
+                                        items, members, deleted_items, False)
+            self.showing_cache = True
+            eventloop.add_idle(self.client_connect_callback,
+                               'cached listing (%s)' % self.thread.name,
+                               args=(listing,))
+            self.client.old_revision = self.cache.revision
+            return self.setup_items(update=True)
         return self.setup_items()
 
+    def open_cache(self):
+        client = self.client
+        # Without /update we can't ask for changes, so a cache is no use.
+        if not client.supports_update:
+            return None
+        if not client.databases():
+            raise IOError('Cannot get database')
+        # Older Miro servers send 1 for everyone.
+        if client.db_persistent_id in (None, 0, 1):
+            return None
+        return ShareListingCache('%x:%s' % (client.db_persistent_id,
+                                            client.db_id))
+
     # See use of self.client in client_update().
     def setup_items(self, update=False):
-        name = self.share.name
-        host = self.share.host
-        port = self.share.port
         try:
             client = self.client
         except AttributeError:
@@ -729,10 +1169,84 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         # out that way, and call the error callback.
         if not client.databases(update=update):
             raise IOError('Cannot get database')
-        deleted_items = dict()
+        cache = self.cache
         playlists, deleted_playlists = client.playlists(update=update)
         if playlists is None:
             raise IOError('Cannot get playlist')
+        # We asked for the changes but the server sent everything (e.g. it
+        # restarted since our cached revision).  Then anything we have that
+        # isn't in there is gone.
+        if update and client.full_listing and cache:
+            deleted_playlists = list(set(cache.playlists) - set(playlists))
+        for k in playlists.keys():
+            # Clean the playlist: remove NUL characters.
+            self.clean_nul(playlists[k])
+            is_base_playlist = None
+            if playlists[k].has_key('daap.baseplaylist'):
+                is_base_playlist = playlists[k]['daap.baseplaylist']
+            if is_base_playlist:
+                if not update and self.base_playlist:
+                    logging.debug('WARNING: more than one base playlist found')
+                if update and self.base_playlist != k:
+                    logging.debug('WARNING: base playlistid changed in update')
+                self.base_playlist = k
+
+        # Maybe we have looped through here without a base playlist.  Then
+        # the server is broken?
+        if not self.base_playlist:
+            raise ValueError('Cannot find base playlist')
+
+        items, deleted = client.items(playlist_id=self.base_playlist,
+                                  meta=DAAP_META, update=update)
+        if items is None:
+            raise ValueError('Cannot find items in base playlist')
+        if update and client.full_listing and cache:
+            deleted = list(cache.item_ids - set(items))
+        for item in items.itervalues():
+            self.clean_nul(item)
+
+        deleted_items = dict()
+        deleted_items[self.base_playlist] = deleted
+        # Have to save the items from the base playlist first, because
+        # Rhythmbox will get lazy and only send the ids around (expecting
+        # us to already to have the data, I guess). 
+        playlist_items = dict()
+        for k in playlists.keys():
+            if k == self.base_playlist:
+                continue
+            members, deleted = client.items(playlist_id=k, meta=DAAP_META,
+                                            update=update)
+            if members is None:
+                raise ValueError('Cannot find items for playlist %d' % k)
+            if update and client.full_listing and cache:
+                deleted = list(cache.members.get(k, set()) - set(members))
+            playlist_items[k] = members.keys()
+            deleted_items[k] = deleted
+
+        if cache:
+            cache.save(client.revision, self.base_playlist, playlists,
+                       deleted_playlists, items,
+                       deleted_items[self.base_playlist], playlist_items,
+                       dict((k, deleted_items[k]) for k in playlist_items),
+                       full=not update)
+        return self.make_listing(playlists, deleted_playlists, items,
+                                 playlist_items, deleted_items, update)
+
+    def clean_nul(self, rawdict):
+        # Remove NUL characters.
+        for k in rawdict:
+            if isinstance(rawdict[k], str):
+                rawdict[k] = rawdict[k].replace('\x00', '')
+
+    def make_listing(self, playlists, deleted_playlists, items, members,
+                     deleted_items, update):
+        """Turn raw playlists and items into what the connect and update
+        callbacks expect.  members has the ids of the items in each playlist
+        other than the base one.
+        """
+        name = self.share.name
+        host = self.share.host
+        port = self.share.port
         returned_playlists = dict()
         video_tab_id = unicode(md5(repr((name,
                                          host,
@@ -747,25 +1261,10 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
                                            host,
                                            port, u'podcast'))).hexdigest())
         for k in playlists.keys():
-            # Clean the playlist: remove NUL characters.
-            for k_ in playlists[k]:
-                if isinstance(playlists[k][k_], str):
-                    tmp = playlists[k][k_]
-                    playlists[k][k_] = tmp.replace('\x00', '')
-
-            is_base_playlist = None
-            if playlists[k].has_key('daap.baseplaylist'):
-                is_base_playlist = playlists[k]['daap.baseplaylist']
-            if is_base_playlist:
-                if not update and self.base_playlist:
-                    logging.debug('WARNING: more than one base playlist found')
-                if update and self.base_playlist != k:
-                    logging.debug('WARNING: base playlistid changed in update')
-                self.base_playlist = k
             # This isn't the playlist id of the remote share, this is the
             # playlist id we use internally.
             # XXX is there anything better we can do than repr()?
-            if not is_base_playlist:
+            if not playlists[k].get('daap.baseplaylist'):
                 # XXX only add playlist if it not base playlist.  We don't
                 # explicitly show base playlist.
                 tab_id = unicode(md5(repr((name,
@@ -826,17 +1325,6 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
             returned_playlists['playlist'] = playlist_folder_info
             returned_playlists['podcast'] = podcast_folder_info
 
-        # Maybe we have looped through here without a base playlist.  Then
-        # the server is broken?
-        if not self.base_playlist:
-            raise ValueError('Cannot find base playlist')
-
-        items, deleted = client.items(playlist_id=self.base_playlist,
-                                  meta=DAAP_META, update=update)
-        if items is None:
-            raise ValueError('Cannot find items in base playlist')
-
-        deleted_items[self.base_playlist] = deleted
         # Make sure that we ditch stuff from the in-house video, music,
         # playlist and podcast tabs too.
         #
@@ -844,7 +1332,7 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         # add these as we please, it's easier that way to than figure out
         # the exact set.
         for p in SharingItemTrackerImpl.fake_playlists:
-            deleted_items[p] = deleted
+            deleted_items[p] = deleted_items[self.base_playlist]
 
         itemdict = dict()
         returned_playlist_items = dict()
@@ -853,11 +1341,6 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         audio_items = dict()
         sharing_item_meth = self.sharing_item
         for itemkey in items.keys():
-            # Clean it of NUL
-            for k in items[itemkey]:
-                if isinstance(items[itemkey][k], str):
-                    tmp = items[itemkey][k]
-                    items[itemkey][k] = tmp.replace('\x00', '')
             item = sharing_item_meth(items[itemkey])
             itemdict[itemkey] = item
             returned_items[itemkey] = item
@@ -871,23 +1354,25 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         returned_playlist_items[u'audio'] = audio_items
         returned_playlist_items[self.base_playlist] = returned_items
 
-        # Have to save the items from the base playlist first, because
-        # Rhythmbox will get lazy and only send the ids around (expecting
-        # us to already to have the data, I guess). 
         playlist_items = dict()
         podcast_items = dict()
         for k in playlists.keys():
             if k == self.base_playlist:
                 continue
             returned_items = dict()
-            items, deleted = client.items(playlist_id=k, meta=DAAP_META,
-                                               update=update)
-            if items is None:
-                raise ValueError('Cannot find items for playlist %d' % k)
-            deleted_items[k] = deleted
-            for itemkey in items.keys():
-                item = itemdict[itemkey]
-                returned_items[itemkey] = itemdict[itemkey]
+            for itemkey in members[k]:
+                try:
+                    item = itemdict[itemkey]
+                except KeyError:
+                    # Unchanged item that was only just added to the
+                    # playlist: the server doesn't have to send it again.
+                    item = self.cached_item(itemkey)
+                    if item is None:
+                        logging.debug('item %s of playlist %s not found',
+                                      itemkey, k)
+                        continue
+                    itemdict[itemkey] = item
+                returned_items[itemkey] = item
                 try:
                     key = 'com.apple.itunes.is-podcast-playlist'
                     if playlists[k].has_key(key) and playlists[k][key]:
@@ -906,6 +1391,13 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
         return (returned_playlist_items, returned_playlists,
                 deleted_playlists, deleted_items)
 
+    def cached_item(self, itemkey):
+        if self.cache:
+            rawitem = self.cache.get_item(itemkey)
+            if rawitem is not None:
+                return self.sharing_item(rawitem)
+        return None
+
     # If we are disconnecting, then, disconnect() sets the self.client
     # to None before actually running the client.disconnect() routine.
     # So, usage of self.client should be:
@@ -1059,6 +1551,12 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
                                        set(deleted))
         message.send_to_frontend()
 
+    def client_connect_done(self, args):
+        if self.showing_cache:
+            self.client_update_callback(args)
+        else:
+            self.client_connect_callback(args)
+
     def client_update_error_callback(self, unused):
         self.client_connect_update_error_callback(unused, update=True)
 
@@ -1122,6 +1620,33 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
                           playlist_id)
             return []
 
+class RevisionLog(object):
+    """Ids stamped with the revision they last changed in.
+
+    Finding the ids changed since some revision only looks at the entries
+    after it, so serving a delta costs the number of changes rather than the
+    number of items.  Stamps must be added in revision order.
+    """
+    def __init__(self, entries=()):
+        self.entries = sorted(entries)
+        self.compacted_size = len(self.entries)
+
+    def stamp(self, revision, id_):
+        self.entries.append((revision, id_))
+        if len(self.entries) > 2 * self.compacted_size + 1000:
+            self.compact()
+
+    def compact(self):
+        # Only the latest stamp of each id matters.
+        latest = dict((id_, revision) for revision, id_ in self.entries)
+        self.entries = sorted((revision, id_)
+                              for id_, revision in latest.iteritems())
+        self.compacted_size = len(self.entries)
+
+    def changed_since(self, revision):
+        start = bisect.bisect_left(self.entries, (revision + 1,))
+        return set(id_ for r, id_ in self.entries[start:])
+
 class SharingManagerBackend(object):
     """SharingManagerBackend is the bridge between pydaap and Miro.  It
     pushes Miro media items to pydaap so pydaap can serve them to the outside
@@ -1134,8 +1659,15 @@ class SharingManagerBackend(object):
     SHARE_VIDEO = libdaap.DAAP_MEDIAKIND_VIDEO
     SHARE_FEED  = 0x4    # XXX
 
+    # Once an item has been transcoded this many times, transcode all of it
+    # into the segment cache when nobody is watching it.
+    PRESEGMENT_COUNT = 3
+
     def __init__(self):
-        self.revision = 1
+        # Start from the clock rather than 1, so revisions keep going up
+        # across restarts and a client can't mistake one of our old
+        # revisions for a current one.  See valid_delta().
+        self.revision = self.base_revision = int(time.time())
         self.share_types = []
         if app.config.get(prefs.SHARE_AUDIO):
             self.share_types += [SharingManagerBackend.SHARE_AUDIO]
@@ -1145,14 +1677,35 @@ class SharingManagerBackend(object):
             self.share_types += [SharingManagerBackend.SHARE_FEED]
         
         self.item_lock = threading.Lock()
-        self.revision_cv = threading.Condition(self.item_lock)
+        # Called with the new revision whenever it changes.
+        self.revision_listeners = []
         self.transcode_lock = threading.Lock()
         self.transcode = dict()
+        support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+        self.segment_cache = transcode.SegmentCache(
+            os.path.join(support_dir, 'transcode-cache'))
+        self.transcode_counts = dict()  # Item id -> transcodes started
+        self.presegment_job = None
         # XXX daapplaylist should be hidden from view. 
+        # Item and playlist dicts are never modified once they are in here,
+        # only replaced, so that get_items() can hand out snapshots which
+        # stay valid after the lock is released.
         self.daapitems = dict()         # DAAP format XXX - index via the items
+        # Item id -> the ItemInfo its entry in daapitems was made from.  These
+        # are the objects app.item_info_cache holds, so this costs little,
+        # and a new ItemInfo means the item changed.
+        self.daapitem_infos = dict()
+        self.default_thumbnails = (
+            resources.path('images/thumb-default-audio.png'),
+            resources.path('images/thumb-default-video.png'))
+        self.item_log = RevisionLog()   # Item changes, by revision
+        # Item id -> {meta list: (revision, encoded mlit)}
+        self.encoded_items = dict()
+        self.encoded_lock = threading.Lock()
         self.daap_playlists = dict()    # Playlist, in daap format
-        self.playlist_item_map = dict() # Playlist -> item mapping
-        self.deleted_item_map = dict()  # Playlist -> deleted item mapping
+        self.playlist_item_map = dict() # Playlist -> set of item ids
+        self.playlist_logs = dict()     # Playlist -> membership changes
+        self.snapshots = dict()         # Playlist -> (revision, items)
         self.in_shutdown = False
         self.config_handle = app.backend_config_watcher.connect('changed',
                              self.on_config_changed)
@@ -1170,30 +1723,31 @@ class SharingManagerBackend(object):
     def handle_item_list(self, message):
         with self.item_lock:
             self.update_revision()
-            item_ids = [item.id for item in message.items]
+            item_ids = set(item.id for item in message.items)
             if message.id is not None:
-                self.daap_playlists[message.id]['revision'] = self.revision
+                # XXX Non-downloaded podcast items are not in daapitems.  I
+                # think what we want to do here is set it as a podcast item
+                # but disable the items that are not yet available.
+                #
+                # Requires work to update the watchable view to include
+                # stuff from the individual feeds.
+                try:
+                    old_ids = self.playlist_item_map[message.id]
+                except KeyError:
+                    return
+                self.touch_playlist(message.id)
                 self.playlist_item_map[message.id] = item_ids
-                self.deleted_item_map[message.id] = []
-                # Update the revision of these items, so they will match
-                # when the playlist items are fetched.
-                for item_id in item_ids:
-                    try:
-                        self.daapitems[item_id]['revision'] = self.revision
-                    except KeyError:
-                        # This non-downloaded podcast item?  I think what
-                        # we want to do here is set it as a podcast item
-                        # but disable the items that are not yet available.
-                        #
-                        # Requires work to update the watchable view to include
-                        # stuff from the individual feeds.
-                        pass
+                for item_id in old_ids ^ item_ids:
+                    self.playlist_logs[message.id].stamp(self.revision,
+                                                         item_id)
+                for item_id in item_ids - old_ids:
+                    self.stamp_new_member(item_id)
             else:
                 deleted = [item_id for item_id in self.daapitems if
                            item_id not in item_ids]
                 self.make_item_dict(message.items)
                 for d in deleted:
-                    self.daapitems[d] = self.deleted_item()
+                    self.remove_item(d)
 
     def handle_items_changed(self, message):
         # If items are changed, overwrite with a recreated entry.  This
@@ -1202,63 +1756,120 @@ class SharingManagerBackend(object):
         # message.id, change the playlists accordingly.
         with self.item_lock:
             self.update_revision()
-            for itemid in message.removed:
-                try:
-                    if message.id is not None:
-                        revision = self.revision
-                        self.daap_playlists[message.id]['revision'] = revision
-                        self.playlist_item_map[message.id].remove(itemid)
-                        self.deleted_item_map[message.id].append(itemid)
-                except KeyError:
-                    pass
-                try:
-                    if message.id is None:
-                        self.daapitems[itemid] = self.deleted_item()
-                except KeyError:
-                    pass
-            if message.id is not None:
-                item_ids = [item.id for item in message.added]
-                self.daap_playlists[message.id]['revision'] = self.revision
-                # If they have been previously removed, unmark deleted.
-                for i in item_ids:
-                    try:
-                        self.deleted_item_map[message.id].remove(i)
-                    except ValueError:
-                        pass
-                self.playlist_item_map[message.id] += item_ids
-
-            # Only make or modify an item if it is for main library.
-            # Otherwise, we just re-create an item when all that's changed
-            # is the contents of the playlist.
             if message.id is None:
+                for itemid in message.removed:
+                    self.remove_item(itemid)
+                # Only make or modify an item if it is for main library.
+                # Otherwise, all that's changed is the contents of the
+                # playlist.
                 self.make_item_dict(message.added)
                 self.make_item_dict(message.changed)
             else:
-                # Simply update the item's revision.
-                # XXX Feed sharing: catch KeyError because item may not
-                # be downloaded (and hence not in watchable list).
-                # Catch changed as when feed items get added they
-                # do not get added to the main list.  Catch added, when newly
-                # available podcasts come into view.
+                try:
+                    members = self.playlist_item_map[message.id]
+                    log = self.playlist_logs[message.id]
+                except KeyError:
+                    return
+                self.touch_playlist(message.id)
+                for itemid in message.removed:
+                    members.discard(itemid)
+                    log.stamp(self.revision, itemid)
+                # XXX Feed sharing: item may not be downloaded (and hence
+                # not in watchable list) so it is not in daapitems.  When it
+                # is, it is picked up by get_changed_items().
                 for x in message.added:
-                    try:
-                        self.daapitems[x.id]['revision'] = self.revision
-                    except KeyError:
-                        pass
-                for x in message.changed:
-                    try:
-                        self.daapitems[x.id]['revision'] = self.revision
-                    except KeyError: 
-                        pass
+                    members.add(x.id)
+                    log.stamp(self.revision, x.id)
+                    self.stamp_new_member(x.id)
 
     def deleted_item(self):
         return dict(revision=self.revision, valid=False)
 
     # At this point: item_lock acquired
-    def update_revision(self, directed=None):
+    def stamp_new_member(self, itemid):
+        # Clients fetch the library before the playlists and expect every
+        # playlist member they are sent to be in it, so send the item along
+        # with the library changes too.
+        if itemid in self.daapitems:
+            self.item_log.stamp(self.revision, itemid)
+
+    # At this point: item_lock acquired
+    def remove_item(self, itemid):
+        self.set_item(itemid, self.deleted_item())
+        self.daapitem_infos.pop(itemid, None)
+        self.forget_encoded_item(itemid)
+        with self.transcode_lock:
+            self.transcode_counts.pop(itemid, None)
+
+    # At this point: item_lock acquired
+    def set_item(self, itemid, itemprop):
+        self.daapitems[itemid] = itemprop
+        self.item_log.stamp(self.revision, itemid)
+
+    # At this point: item_lock acquired
+    def touch_playlist(self, playlist_id):
+        try:
+            playlist = dict(self.daap_playlists[playlist_id])
+        except KeyError:
+            return
+        playlist['revision'] = self.revision
+        self.daap_playlists[playlist_id] = playlist
+
+    def get_encoded_item(self, itemid, itemprop, meta_list):
+        """Return the encoded DAAP listing of an item for a meta list.
+
+        Encoding is done once per item revision and meta list, and the result
+        reused for every client that asks for the same thing.
+        """
+        revision = itemprop['revision']
+        with self.encoded_lock:
+            try:
+                cached_revision, blob = self.encoded_items[itemid][meta_list]
+                if cached_revision == revision:
+                    return blob
+            except KeyError:
+                pass
+        blob = libdaap.encode_item(itemprop, meta_list)
+        with self.encoded_lock:
+            self.encoded_items.setdefault(itemid, {})[meta_list] = (revision,
+                                                                    blob)
+        return blob
+
+    def forget_encoded_item(self, itemid):
+        with self.encoded_lock:
+            try:
+                del self.encoded_items[itemid]
+            except KeyError:
+                pass
+
+    def valid_delta(self, revision):
+        """Whether we can send the changes since revision.  Revisions from
+        before we started can't be answered from the change logs, the client
+        gets a full listing instead.
+        """
+        return self.base_revision <= revision <= self.revision
+
+    # At this point: item_lock acquired
+    def update_revision(self):
         self.revision += 1
-        self.directed = directed
-        self.revision_cv.notify_all()
+        for listener in self.revision_listeners:
+            listener(self.revision)
+
+    def add_revision_listener(self, listener):
+        """Call listener with the current revision, and with the new one
+        each time it changes.  This is how the DAAP server knows when to
+        answer the /update requests it has waiting.
+        """
+        with self.item_lock:
+            self.revision_listeners.append(listener)
+            listener(self.revision)
+
+    def remove_revision_listener(self, listener):
+        with self.item_lock:
+            try:
+                self.revision_listeners.remove(listener)
+            except ValueError:
+                pass
 
     def make_daap_playlists(self, items, typ):
         for item in items:
@@ -1343,8 +1954,8 @@ class SharingManagerBackend(object):
                 for p in playlists:
                     # no need to update the revision here: already done in
                     # make_daap_playlists.
-                    self.playlist_item_map[p.id] = []
-                    self.deleted_item_map[p.id] = []
+                    self.playlist_item_map[p.id] = set()
+                    self.playlist_logs[p.id] = RevisionLog()
                     app.info_updater.item_list_callbacks.add(self.type,
                                                      p.id,
                                                      self.handle_item_list)
@@ -1391,10 +2002,11 @@ class SharingManagerBackend(object):
                             logging.debug('sharing: cannot delete '
                                           'playlist_item_map id = %d', x)
                         try:
-                            del self.deleted_item_map[x]
+                            del self.playlist_logs[x]
                         except KeyError:
                             logging.debug('sharing: cannot delete '
-                                          'deleted_item_map id = %d', x)
+                                          'playlist_logs id = %d', x)
+                        self.snapshots.pop(x, None)
                         messages.StopTrackingItems(self.type,
                                                    x).send_to_backend()
                         app.info_updater.item_list_callbacks.remove(self.type,
@@ -1429,16 +2041,17 @@ class SharingManagerBackend(object):
             for playlist_id in self.daap_playlists.keys():
                 # revision for playlist already created in make_daap_playlist
                 if playlist_id in playlist_ids:
-                    self.playlist_item_map[playlist_id] = [x.item_id
+                    item_ids = set(x.item_id
                       for x in playlist.PlaylistItemMap.playlist_view(
-                      playlist_id)]
+                      playlist_id))
                 elif playlist_id in feed_ids:
-                    self.playlist_item_map[playlist_id] = [x.id
-                      for x in Item.feed_view(playlist_id)]
+                    item_ids = set(x.id for x in Item.feed_view(playlist_id))
                 else:
                     logging.error('playlist id %s not valid', playlist_id)
                     continue
-                self.deleted_item_map[playlist_id] = []
+                self.playlist_item_map[playlist_id] = item_ids
+                self.playlist_logs[playlist_id] = RevisionLog(
+                  (self.revision, item_id) for item_id in item_ids)
 
     def start_tracking(self):
         self.populate_playlists()
@@ -1496,38 +2109,6 @@ class SharingManagerBackend(object):
         app.info_updater.disconnect(self.handle_feed_changed)
         app.info_updater.disconnect(self.handle_feed_removed)
 
-    def watcher(self, session, request):
-        while True:
-            try:
-                r, w, x = select.select([request], [], [])
-                # Unlock the revision by bumping it
-                with self.item_lock:
-                    logging.debug('WAKEUP %s', session)
-                    self.update_revision(directed=session)
-                break
-            except select.error, (err, errstring):
-                if err == errno.EINTR:
-                    continue
-            except StandardError, err:
-                raise ValueError('watcher: unknown error during select')
-
-    def get_revision(self, session, old_revision, request):
-        self.revision_cv.acquire()
-        while self.revision == old_revision:
-            t = threading.Thread(target=self.watcher, args=(session, request))
-            t.daemon = True
-            t.start()
-            self.revision_cv.wait()
-            # If we really did a update or if the wakeup was directed at us
-            # (because we are quitting or something) then release the lock
-            # and return the revision
-            if self.directed is None or self.directed == session:
-                break
-            # update revision and then wait again
-            old_revision = self.revision
-        self.revision_cv.release()
-        return self.revision
-
     def get_file(self, itemid, generation, ext, session, request_path_func,
                  offset=0, chunk=None):
         file_obj = None
@@ -1566,30 +2147,48 @@ class SharingManagerBackend(object):
                             old_transcode_obj = transcode_obj
                 except KeyError:
                     need_create = True
+                presegment_job = None
                 if need_create:
                     yes, info = transcode.needs_transcode(path)
                     transcode_obj = transcode.TranscodeObject(
-                                                          path,
-                                                          itemid,
-                                                          generation,
-                                                          chunk,
-                                                          info,
-                                                          request_path_func)
+                                                path,
+                                                itemid,
+                                                generation,
+                                                chunk,
+                                                info,
+                                                request_path_func,
+                                                self.segment_cache,
+                                                app.transcode_manager)
+                    count = self.transcode_counts.get(itemid, 0) + 1
+                    self.transcode_counts[itemid] = count
+                    # Someone is watching: don't compete with them.
+                    presegment_job = self.presegment_job
+                    self.presegment_job = None
                 self.transcode[session] = transcode_obj
 
             # If there was an old object, shut it down.  Do it outside the
             # loop so that we don't hold onto the transcode lock for excessive
             # time
+            if presegment_job:
+                presegment_job.shutdown()
             if old_transcode_obj:
-                old_transcode_obj.shutdown()
-            if need_create:
-                transcode_obj.transcode()
+                self.retire_transcode(old_transcode_obj)
+            if need_create and not transcode_obj.transcode():
+                if transcode_obj.refused:
+                    # No room for another transcode right now.  Forget the
+                    # job so the client's retry starts a new one.
+                    with self.transcode_lock:
+                        if self.transcode.get(session) is transcode_obj:
+                            del self.transcode[session]
+                    transcode_obj.shutdown()
+                    raise libdaap.ServiceUnavailable(
+                        app.transcode_manager.RETRY_AFTER)
 
             if ext == 'm3u8':
                 file_obj = transcode_obj.get_playlist()
                 file_obj.seek(offset, os.SEEK_SET)
             elif ext == 'ts':
-                file_obj = transcode_obj.get_chunk()
+                file_obj = transcode_obj.get_chunk(chunk)
             else:
                 # Should this be a ValueError instead?  But returning -1
                 # will make the caller return 404.
@@ -1617,6 +2216,43 @@ class SharingManagerBackend(object):
                     file_obj.close()
         return file_obj, os.path.basename(path)
 
+    def retire_transcode(self, transcode_obj):
+        """Shut down a transcode that nobody is using any more.  If its item
+        is popular, start transcoding all of it in the background, so it can
+        be sent straight from the segment cache next time.
+        """
+        transcode_obj.shutdown()
+        itemid = transcode_obj.itemid
+        with self.transcode_lock:
+            if (self.in_shutdown or self.presegment_job or
+              self.transcode_counts.get(itemid, 0) < self.PRESEGMENT_COUNT):
+                return
+            # Don't bother if someone is still watching it.
+            for obj in self.transcode.itervalues():
+                if obj.itemid == itemid and obj is not transcode_obj:
+                    return
+            job = transcode.TranscodeObject(transcode_obj.media_file,
+                                            itemid,
+                                            0,
+                                            None,
+                                            transcode_obj.media_info,
+                                            transcode_obj.request_path_func,
+                                            self.segment_cache,
+                                            app.transcode_manager)
+            self.presegment_job = job
+        thread = threading.Thread(target=thread_body,
+                                  args=[self.presegment, job],
+                                  name='Transcode Presegment')
+        thread.daemon = True
+        thread.start()
+
+    def presegment(self, job):
+        logging.debug('presegmenting item %s', job.itemid)
+        job.fill_cache()
+        with self.transcode_lock:
+            if self.presegment_job is job:
+                self.presegment_job = None
+
     def get_playlists(self):
         returned = dict()
         with self.item_lock:
@@ -1650,10 +2286,12 @@ class SharingManagerBackend(object):
                 # working out what needs to be updated.
                 if share_types_orig != self.share_types:
                     self.update_revision()
-                for p in self.daap_playlists:
-                    self.daap_playlists[p]['revision'] = self.revision
-                for i in self.daapitems:
-                    self.daapitems[i]['revision'] = self.revision
+                    for p in self.daap_playlists.keys():
+                        self.touch_playlist(p)
+                    for i, item in self.daapitems.items():
+                        item = dict(item)
+                        item['revision'] = self.revision
+                        self.set_item(i, item)
 
     # XXX TEMPORARY: should this item be podcast?  We won't need this when
     # the item type's metadata is completely accurate and won't lie to us.
@@ -1663,74 +2301,114 @@ class SharingManagerBackend(object):
         is_feed = not any([feed_url.startswith(x) for x in ersatz_feeds])
         return item.feed_id and is_feed and not item.is_file_item
 
+    # At this point: item_lock acquired
+    def item_visible(self, item):
+        mk = item['com.apple.itunes.mediakind']
+        ik = item['org.participatoryculture.miro.itemkind']
+        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
+        include_if_podcast = (podcast and
+          SharingManagerBackend.SHARE_FEED in self.share_types)
+        return mk in self.share_types and (not podcast or include_if_podcast)
+
+    # At this point: item_lock acquired
+    def shared_item(self, itemid):
+        item = self.daapitems[itemid]
+        if not item['valid'] or self.item_visible(item):
+            return item
+        return self.deleted_item()
+
     def get_items(self, playlist_id=None):
-        # Easy: just return
+        """Return a snapshot of the shared items of the library or of a
+        playlist, as a dict of item id to item.
+
+        The snapshot is shared between callers until the next revision and
+        must not be modified.
+        """
         with self.item_lock:
+            try:
+                revision, items = self.snapshots[playlist_id]
+                if revision == self.revision:
+                    return items
+            except KeyError:
+                pass
             items = dict()
             if not playlist_id:
-                for k in self.daapitems.keys():
-                    item = self.daapitems[k]
-                    valid = item['valid']
-                    if valid:
-                        mk = item['com.apple.itunes.mediakind']
-                        ik = item['org.participatoryculture.miro.itemkind']
-                        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
-                        include_if_podcast = (podcast and
-                          SharingManagerBackend.SHARE_FEED in self.share_types)
-                    if (not valid or
-                      mk in self.share_types and 
-                      (not podcast or include_if_podcast)):
-                        items[k] = item
-                    else:
-                        items[k] = self.deleted_item()
+                for k in self.daapitems:
+                    items[k] = self.shared_item(k)
+            elif self.playlist_item_map.has_key(playlist_id):
+                for k in self.playlist_item_map[playlist_id]:
+                    if k in self.daapitems:
+                        items[k] = self.shared_item(k)
+            self.snapshots[playlist_id] = (self.revision, items)
+            return items
+
+    def get_changed_items(self, playlist_id=None, revision=0):
+        """Like get_items() but only return the items which have changed
+        since revision.  Items removed from the playlist are returned as
+        deleted.
+        """
+        if not revision:
+            return self.get_items(playlist_id)
+        with self.item_lock:
+            items = dict()
+            changed = self.item_log.changed_since(revision)
+            if not playlist_id:
+                for k in changed:
+                    items[k] = self.shared_item(k)
                 return items
-            # XXX Somehow cache this?
-            playlist = dict()
-            if self.playlist_item_map.has_key(playlist_id):
-                for x in self.daapitems.keys():
-                    item = self.daapitems[x]
-                    valid = item['valid']
-                    if valid:
-                        mk = item['com.apple.itunes.mediakind']
-                        ik = item['org.participatoryculture.miro.itemkind']
-                        podcast = ik and (ik & MIRO_ITEMKIND_PODCAST)
-                        include_if_podcast = (podcast and
-                          SharingManagerBackend.SHARE_FEED in self.share_types)
-                    if (x in self.playlist_item_map[playlist_id] and
-                      (not valid or
-                       mk in self.share_types and
-                       (not podcast or include_if_podcast))):
-                        playlist[x] = item
-                    else:
-                        playlist[x] = self.deleted_item()
-            return playlist
+            try:
+                members = self.playlist_item_map[playlist_id]
+                log = self.playlist_logs[playlist_id]
+            except KeyError:
+                return items
+            membership_changed = log.changed_since(revision)
+            for k in changed | membership_changed:
+                if k in members:
+                    if k in self.daapitems:
+                        items[k] = self.shared_item(k)
+                elif k in membership_changed:
+                    items[k] = self.deleted_item()
+            return items
 
+    # At this point: item_lock acquired
     def make_item_dict(self, items):
+        """Bring the DAAP entries of items up to date.
+
+        Items whose ItemInfo we've already made an entry from are left
+        alone, otherwise only the fields that differ from the previous
+        ItemInfo are converted again.
+        """
         # See the daap_rmapping/daap_mapping for a list of mappings that
         # we do.
         for item in items:
-            itemprop = dict()
-            for attr in daap_rmapping.keys():
-                daap_string = daap_rmapping[attr]
-                itemprop[daap_string] = getattr(item, attr, None)
-                if isinstance(itemprop[daap_string], unicode):
-                    itemprop[daap_string] = (
-                      itemprop[daap_string].encode('utf-8'))
-                # Fixup the year, etc being -1.  XXX should read the daap
-                # type then determine what to do.
-                if itemprop[daap_string] == -1:
-                    itemprop[daap_string] = 0
-                # Fixup: these are stored as string?
-                if daap_string in ('daap.songtracknumber',
-                                   'daap.songyear'):
-                    if itemprop[daap_string] is not None:
-                        itemprop[daap_string] = int(itemprop[daap_string])
-                # Fixup the duration: need to convert to millisecond.
-                if daap_string == 'daap.songtime':
-                    if itemprop[daap_string]:
-                        itemprop[daap_string] *= DURATION_SCALE
-                    else:
-                        itemprop[daap_string] = 0
+            old_info = self.daapitem_infos.get(item.id)
+            old_prop = self.daapitems.get(item.id)
+            if old_prop is None or not old_prop['valid']:
+                old_info = None
+            elif old_info is item:
+                continue
+            if old_info is None:
+                itemprop = dict()
+            else:
+                itemprop = dict(old_prop)
+            for attr, daap_string in daap_rmapping.iteritems():
+                if attr in daap_derived_attrs:
+                    continue
+                value = getattr(item, attr, None)
+                if (old_info is None or
+                  getattr(old_info, attr, None) != value):
+                    itemprop[daap_string] = daap_value(daap_string, value)
+
+            # If this should be considered an item from a podcast feed then
+            # mark it as such.  But allow for manual overriding by the user,
+            # as per what was set in the metadata.
+            key = 'org.participatoryculture.miro.itemkind'
+            if self.item_from_podcast(item):
+                itemprop[key] = MIRO_ITEMKIND_PODCAST
+            else:
+                kind = daap_value(key, getattr(item, 'kind', None))
+                itemprop[key] = miro_itemkind_mapping.get(kind, kind)
+
             # Fixup the enclosure format.  This is hardcoded to mp4, 
             # as iTunes requires this.  Other clients seem to be able to sniff
             # out the container.  We can change it if that's no longer true.
@@ -1740,46 +2418,23 @@ class SharingManagerBackend(object):
                 nam, ext = os.path.splitext(item.video_path)
                 if ext in supported_filetypes:
                     enclosure = ext
-
-            # If this should be considered an item from a podcast feed then
-            # mark it as such.  But allow for manual overriding by the user,
-            # as per what was set in the metadata.
-            if self.item_from_podcast(item):
-                key = 'org.participatoryculture.miro.itemkind'
-                itemprop[key] = MIRO_ITEMKIND_PODCAST
-            try:
-                key = 'org.participatoryculture.miro.itemkind'
-                kind = itemprop[key]
-                if kind:
-                    itemprop[key] = miro_itemkind_mapping[kind]
-            except KeyError:
-                pass
-            if itemprop['com.apple.itunes.mediakind'] == u'video':
+            if item.file_type == u'video':
                 itemprop['com.apple.itunes.mediakind'] = (
                   libdaap.DAAP_MEDIAKIND_VIDEO)
                 if not enclosure:
                     enclosure = '.mp4'
-                enclosure = enclosure[1:]
-                itemprop['daap.songformat'] = enclosure
             else:
                 itemprop['com.apple.itunes.mediakind'] = (
                   libdaap.DAAP_MEDIAKIND_AUDIO)
                 if not enclosure:
                     enclosure = '.mp3'
-                enclosure = enclosure[1:]
-                itemprop['daap.songformat'] = enclosure
-            # Normally our strings are fixed up above, but then we re-pull
-            # this out of the input data structure, so have to re-convert.
-            if isinstance(itemprop['daap.songformat'], unicode):
-                tmp = itemprop['daap.songformat'].encode('utf-8')
-                itemprop['daap.songformat'] = tmp
+            itemprop['daap.songformat'] = daap_value('daap.songformat',
+                                                     enclosure[1:])
 
             # don't forget to set the path..
             # ok: it is ignored since this is not valid dmap/daap const.
             itemprop['path'] = item.video_path
-            defaults = (resources.path('images/thumb-default-audio.png'),
-                        resources.path('images/thumb-default-video.png'))
-            if item.thumbnail not in defaults:
+            if item.thumbnail not in self.default_thumbnails:
                 itemprop['cover_art'] = item.thumbnail
             else:
                 itemprop['cover_art'] = ''
@@ -1792,7 +2447,8 @@ class SharingManagerBackend(object):
             itemprop['revision'] = self.revision
             itemprop['valid'] = True
 
-            self.daapitems[item.id] = itemprop
+            self.daapitem_infos[item.id] = item
+            self.set_item(item.id, itemprop)
 
     def finished_callback(self, session):
         # Like shutdown but only shuts down one of the sessions.  No need to
@@ -1800,10 +2456,9 @@ class SharingManagerBackend(object):
         # and and reach here, before a transcode job arrives.  Then the
         # transcode job gets created anyway.
         with self.transcode_lock:
-            try:
-                self.transcode[session].shutdown()
-            except KeyError:
-                pass
+            transcode_obj = self.transcode.pop(session, None)
+        if transcode_obj:
+            self.retire_transcode(transcode_obj)
 
     def shutdown(self):
         # Set the in_shutdown flag inside the transcode lock to ensure that
@@ -1813,6 +2468,8 @@ class SharingManagerBackend(object):
             self.in_shutdown = True
             for key in self.transcode.keys():
                 self.transcode[key].shutdown()
+            if self.presegment_job:
+                self.presegment_job.shutdown()
 
 class SharingManager(object):
     """SharingManager is the sharing server.  It publishes Miro media items
@@ -2035,6 +2692,7 @@ class SharingManager(object):
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
                             del self.thread
+                            self.server.server_close()
                             del self.server
                             self.reload_done_event.set()
                             return
@@ -2085,6 +2743,13 @@ class SharingManager(object):
             self.sharing = False
             return
 
+        # Lets clients that cache our listing tell us apart from other
+        # shares.
+        persistent_id = app.config.get(prefs.SHARE_PERSISTENT_ID)
+        if not persistent_id:
+            persistent_id = u'%016x' % (uuid.uuid4().int >> 65)
+            app.config.set(prefs.SHARE_PERSISTENT_ID, persistent_id)
+        self.server.set_persistent_id(int(persistent_id, 16))
         self.server.set_finished_callback(self.finished_callback)
         self.server.set_log_message_callback(
             lambda format, *args: logging.info(format, *args))
@@ -68,6 +68,7 @@ from miro import iconcache
 from miro import item
 from miro import itemsource
 from miro import iteminfocache
+from miro import mediainfocache
 from miro import feed
 from miro import folder
 from miro import messages
@@ -331,9 +332,10 @@ def finish_startup(obj, thread):
     app.download_state_manager.init_controller()
 
     # Call this late, after the message handlers have been installed.
+    app.media_info_cache = mediainfocache.MediaInfoCache()
+    app.transcode_manager = transcode.TranscodeManager()
     app.sharing_tracker = sharing.SharingTracker()
     app.sharing_manager = sharing.SharingManager()
-    app.transcode_manager = transcode.TranscodeManager()
 
     app.donate_manager = donate.DonateManager()
 
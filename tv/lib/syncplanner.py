@@ -0,0 +1,134 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.syncplanner`` -- Choose which items to put on a device.
+
+Picking items to fill up the free space on a device is a knapsack problem:
+each candidate has a size and a value and we want the most value that fits.
+Solving it exactly takes far too long for a large library, so plan_fill()
+does a greedy pass by value per byte, then spends a bounded amount of time
+swapping items to improve on it.
+"""
+
+import time
+from bisect import bisect_right
+
+# How many of the least valuable chosen items we look at when trying to
+# swap one out for a more valuable one.
+SWAP_WINDOW = 32
+
+def _greedy_fill(order, sizes, chosen, free):
+    for index in order:
+        if sizes[index] <= free and not chosen[index]:
+            chosen[index] = True
+            free -= sizes[index]
+    return free
+
+def plan_fill(candidates, capacity, time_limit=0.02):
+    """Choose items to fill capacity bytes.
+
+    :param candidates: list of (size, value, item) tuples.  Candidates
+                       without a size or value are never chosen.
+    :param capacity: the number of bytes to fill
+    :param time_limit: how many seconds we can spend improving on the
+                       greedy plan
+
+    :returns: (items, total_size) for the chosen items
+    """
+    deadline = time.time() + time_limit
+    candidates = [c for c in candidates
+                  if c[0] > 0 and c[1] > 0 and c[0] <= capacity]
+    if not candidates:
+        return [], 0
+    sizes = [c[0] for c in candidates]
+    values = [c[1] for c in candidates]
+    indexes = range(len(candidates))
+    # best value per byte first
+    density = [float(v) / s for s, v in zip(sizes, values)]
+    order = sorted(indexes, key=density.__getitem__, reverse=True)
+
+    chosen = [False] * len(candidates)
+    free = _greedy_fill(order, sizes, chosen, capacity)
+    # The greedy plan can do badly when a single valuable item gets crowded
+    # out by small ones.  Taking the most valuable item instead when it's
+    # worth more guarantees us at least half of the best possible value.
+    best = max(indexes, key=values.__getitem__)
+    if (not chosen[best] and values[best] >
+        sum(v for v, c in zip(values, chosen) if c)):
+        chosen = [False] * len(candidates)
+        chosen[best] = True
+        free = _greedy_fill(order, sizes, chosen, capacity - sizes[best])
+
+    # Swap a chosen item for a more valuable one that wasn't chosen, as long
+    # as it still fits.  Both lists are sorted by value: chosen_values
+    # ascending so the cheapest items to give up come first, left descending
+    # so that we try the biggest gains first.
+    members = sorted([i for i in indexes if chosen[i]],
+                     key=values.__getitem__)
+    chosen_values = [values[i] for i in members]
+    if members:
+        # only items worth more than some chosen item can be swapped in
+        lowest = chosen_values[0]
+        left = sorted([i for i in indexes
+                       if values[i] > lowest and not chosen[i]],
+                      key=values.__getitem__, reverse=True)
+    else:
+        left = []
+    for count, index in enumerate(left):
+        if count % 64 == 0 and time.time() > deadline:
+            break
+        if not members or values[index] <= chosen_values[0]:
+            # nothing after this can be worth more than what we'd give up
+            break
+        needed = sizes[index] - free
+        if needed <= 0:
+            chosen[index] = True
+            free -= sizes[index]
+            pos = bisect_right(chosen_values, values[index])
+            chosen_values.insert(pos, values[index])
+            members.insert(pos, index)
+            continue
+        for pos in xrange(min(SWAP_WINDOW, len(members))):
+            if chosen_values[pos] >= values[index]:
+                break
+            if sizes[members[pos]] >= needed:
+                out = members.pop(pos)
+                del chosen_values[pos]
+                chosen[out] = False
+                chosen[index] = True
+                free += sizes[out] - sizes[index]
+                pos = bisect_right(chosen_values, values[index])
+                chosen_values.insert(pos, values[index])
+                members.insert(pos, index)
+                break
+
+    # swapping may have left room for some more
+    free = _greedy_fill(order, sizes, chosen, free)
+    items = [c[2] for c, is_chosen in zip(candidates, chosen) if is_chosen]
+    return items, capacity - free
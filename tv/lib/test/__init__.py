@@ -45,6 +45,7 @@ config.load_temporary()
 import unittest
 
 from miro.test.importtest import *
+from miro.test.autodlertest import *
 from miro.test.conversionstest import *
 from miro.test.devicestest import *
 from miro.test.flashscrapertest import *
@@ -77,6 +78,10 @@ from miro.test.searchtest import *
 from miro.test.infolisttest import *
 from miro.test.fileobjecttest import *
 from miro.test.fastresumetest import *
+from miro.test.trackerstest import *
+from miro.test.downloadstatetest import *
+from miro.test.daaptest import *
+from miro.test.sharingtest import *
 from miro.test.widgetstateconstantstest import *
 from miro.test.metadatatest import *
 from miro.test.tableselectiontest import *
@@ -86,6 +91,9 @@ from miro.test.subprocesstest import *
 from miro.test.itemfiltertest import *
 from miro.test.extensiontest import *
 from miro.test.idleiteratetest import *
+from miro.test.transcodetest import *
+from miro.test.mediainfocachetest import *
+from miro.test.syncplannertest import *
 
 # platform specific tests
 
@@ -0,0 +1,79 @@
+from datetime import datetime
+
+from miro.autodler import PendingQueue
+from miro.test.framework import MiroTestCase
+
+class FakeItem(object):
+    def __init__(self, id_):
+        self.id = id_
+
+class PendingQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = PendingQueue()
+        self.items = [FakeItem(i) for i in range(6)]
+
+    def test_newest_first(self):
+        self.queue.add(u'feed', self.items[0], -10)
+        self.queue.add(u'feed', self.items[1], -30)
+        self.queue.add(u'feed', self.items[2], -20)
+        self.assertEquals(self.queue.next_item(u'feed'), self.items[1])
+        self.queue.remove(self.items[1].id)
+        self.assertEquals(self.queue.next_item(u'feed'), self.items[2])
+        self.assertEquals(len(self.queue), 2)
+
+    def test_feed_order(self):
+        self.queue.add(u'a', self.items[0], 0)
+        self.queue.add(u'b', self.items[1], 0)
+        self.queue.update_feed(u'a', 1, datetime.min)
+        self.assertEquals(self.queue.next_feed(), u'b')
+        # with the same number of running downloads, the feed we started
+        # a download for least recently goes first
+        self.queue.update_feed(u'a', 0, datetime(2011, 1, 2))
+        self.queue.update_feed(u'b', 0, datetime(2011, 1, 3))
+        self.assertEquals(self.queue.next_feed(), u'a')
+        self.queue.remove(self.items[0].id)
+        self.assertEquals(self.queue.next_feed(), u'b')
+        self.queue.remove(self.items[1].id)
+        self.assertEquals(self.queue.next_feed(), None)
+
+    def test_park(self):
+        self.queue.add(u'a', self.items[0], 0)
+        self.queue.add(u'b', self.items[1], 0)
+        self.queue.update_feed(u'b', 1, datetime.min)
+        self.queue.park(u'a')
+        self.assertEquals(self.queue.next_feed(), u'b')
+        self.queue.add(u'a', self.items[2], 0)
+        self.assertEquals(self.queue.next_feed(), u'b')
+        self.queue.unpark(u'a')
+        self.assertEquals(self.queue.next_feed(), u'a')
+        self.assertEquals(self.queue.next_item(u'a'), self.items[0])
+
+    def test_defer(self):
+        self.queue.add(u'a', self.items[0], -20)
+        self.queue.add(u'a', self.items[1], -10)
+        self.queue.defer(self.items[0].id)
+        # the feed's other items are still available
+        self.assertEquals(self.queue.next_feed(), u'a')
+        self.assertEquals(self.queue.next_item(u'a'), self.items[1])
+        self.assert_(self.items[0].id in self.queue)
+        self.assertEquals(len(self.queue), 2)
+        self.queue.retry_deferred()
+        self.assertEquals(self.queue.next_item(u'a'), self.items[0])
+
+    def test_remove_deferred(self):
+        self.queue.add(u'a', self.items[0], 0)
+        self.queue.defer(self.items[0].id)
+        self.assertEquals(self.queue.next_feed(), None)
+        self.queue.remove(self.items[0].id)
+        self.assertEquals(len(self.queue), 0)
+        self.queue.retry_deferred()
+        self.assertEquals(self.queue.next_feed(), None)
+
+    def test_readd(self):
+        self.queue.add(u'a', self.items[0], 0)
+        self.queue.remove(self.items[0].id)
+        self.assertEquals(self.queue.next_feed(), None)
+        self.queue.add(u'a', self.items[0], 0)
+        self.assertEquals(self.queue.next_feed(), u'a')
+        self.assertEquals(self.queue.next_item(u'a'), self.items[0])
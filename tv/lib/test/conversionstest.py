@@ -1,5 +1,8 @@
 import os
 import glob
+import subprocess
+import sys
+import threading
 
 from miro.test.framework import MiroTestCase
 
@@ -7,6 +10,7 @@ from miro import app
 from miro import prefs
 from miro import conversions
 from miro.plat import resources
+from miro.plat import utils
 
 DATA = resources.path("testdata/conversions")
 
@@ -79,6 +83,9 @@ class MockFFMpegConversionTask(conversions.FFMpegConversionTask):
         self.error = None
         self.progress = 0
         self.duration = None
+        self.output_buffer = ''
+        self.wants_output = True
+        self.finished = False
 
     def _log_progress(self, line):
         pass
@@ -86,7 +93,27 @@ class MockFFMpegConversionTask(conversions.FFMpegConversionTask):
     def _notify_progress(self):
         pass
 
+    def _finish(self):
+        self.finished = True
+
 class FFMpegConversionTaskTest(MiroTestCase):
+    def test_handle_output(self):
+        f = open(os.path.join(DATA, "ffmpeg.mp4.mp3.txt"), "r")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        mock = MockFFMpegConversionTask()
+        # feed the output in chunks that split lines in odd places
+        for i in xrange(0, len(data), 7):
+            mock.handle_output(data[i:i+7])
+        self.assertFalse(mock.finished)
+        mock.handle_output('')
+        self.assert_(mock.finished)
+        self.assertEquals(mock.error, None)
+        self.assertEquals(mock.progress, 1.0)
+        self.assertEquals(mock.duration, 368)
+
     def test_ffmpeg_mp4_to_mp3(self):
         f = open(os.path.join(DATA, "ffmpeg.mp4.mp3.txt"), "r")
         try:
@@ -161,6 +188,237 @@ class FFMpeg2TheoraConversionTaskTest(MiroTestCase):
         finally:
             f.close()
 
+class FakeConversionTask(object):
+    def __init__(self, key, device_sync=False):
+        self.key = key
+        self.device_sync = device_sync
+        self.started = self.done = False
+
+    def run(self):
+        self.started = True
+
+    def is_failed(self):
+        return False
+
+    def is_finished(self):
+        return self.done
+
+    def done_running(self):
+        return self.done
+
+class ConversionManagerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = conversions.ConversionManager()
+        for name in ('_notify_task_changed', '_notify_tasks_count'):
+            setattr(self.manager, name, lambda *args: None)
+        self.staged = []
+        self.manager.schedule_staging = self.staged.append
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 2)
+
+    def add_tasks(self, *tasks):
+        for task in tasks:
+            self.manager._enqueue_message("add_task", task=task)
+        self.manager._run_loop_cycle()
+
+    def running_keys(self):
+        return [task.key for task in self.manager.running_tasks]
+
+    def test_fill_slots(self):
+        tasks = [FakeConversionTask(key) for key in 'abc']
+        self.add_tasks(*tasks)
+        # both slots get filled at once
+        self.assertEquals(self.running_keys(), ['a', 'b'])
+        self.assertEquals([t.key for t in self.manager.pending_tasks], ['c'])
+
+    def test_task_done(self):
+        tasks = [FakeConversionTask(key) for key in 'abc']
+        self.add_tasks(*tasks)
+        tasks[0].done = True
+        self.manager._enqueue_message("task_done", key='a')
+        self.manager._run_loop_cycle()
+        self.assertEquals(self.running_keys(), ['b', 'c'])
+        self.assertEquals(self.staged, ['a'])
+
+    def test_device_sync_first(self):
+        self.add_tasks(FakeConversionTask('a'),
+                       FakeConversionTask('b', device_sync=True),
+                       FakeConversionTask('c', device_sync=True))
+        self.assertEquals(self.running_keys(), ['b', 'c'])
+        self.add_tasks(FakeConversionTask('d'),
+                       FakeConversionTask('e', device_sync=True))
+        self.assertEquals([t.key for t in self.manager.pending_tasks],
+                          ['e', 'a', 'd'])
+
+    def test_can_convert(self):
+        converters = {}
+        for name, executable in (('mp3', 'ffmpeg'), ('ogg', 'ffmpeg2theora'),
+                                 ('odd', 'something')):
+            converters[name] = FakeConverterInfo()
+            converters[name].executable = executable
+        self.manager.converters = FakeConverterManager(converters)
+        self.assert_(self.manager.can_convert('copy'))
+        self.assert_(self.manager.can_convert('mp3'))
+        self.assert_(self.manager.can_convert('ogg'))
+        self.assert_(not self.manager.can_convert('odd'))
+
+    def test_default_max_conversions(self):
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, None)
+        self.assertEquals(conversions.get_max_concurrent_conversions(),
+                          utils.get_logical_cpu_count())
+
+class FakeConverterManager(object):
+    def __init__(self, converters):
+        self.converters = converters
+
+    def lookup_converter(self, converter_id):
+        return self.converters[converter_id]
+
+class FakeOutputTask(object):
+    def __init__(self, args):
+        self.process_handle = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.output = []
+        self.finished = threading.Event()
+
+    def handle_output(self, data):
+        self.output.append(data)
+        if not data:
+            self.process_handle.wait()
+            self.finished.set()
+
+class ProcessOutputReaderTest(MiroTestCase):
+    def test_read(self):
+        reader = conversions.ProcessOutputReader()
+        tasks = [FakeOutputTask([sys.executable, '-c',
+                                 'print "task %d"' % i])
+                 for i in range(3)]
+        for task in tasks:
+            reader.add(task)
+        for i, task in enumerate(tasks):
+            task.finished.wait(10)
+            self.assert_(task.finished.isSet())
+            self.assertEquals(''.join(task.output).strip(), 'task %d' % i)
+
+class FakeConverterInfo(object):
+    executable = 'ffmpeg'
+    parameters = '-i {input} {output}'
+    extension = 'mp4'
+    screen_size = None
+    bit_rate = 0
+    identifier = 'fake'
+
+class ConversionCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.patch_function('miro.conversions.get_conversions_folder',
+                            lambda: self.tempdir)
+        self.cache = conversions.ConversionCache()
+        self.source = self.make_file('source data')
+
+    def make_file(self, data):
+        path = self.make_temp_path('.mp4')
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_key(self):
+        converter_info = FakeConverterInfo()
+        key = self.cache.get_key(self.source, converter_info)
+        self.assertEquals(self.cache.get_key(self.source, converter_info),
+                          key)
+        self.assert_(key.endswith('.mp4'))
+        # changing the converter settings changes the key
+        converter_info.parameters = '-i {input} -ab 128k {output}'
+        self.assertNotEquals(self.cache.get_key(self.source, converter_info),
+                             key)
+        # so does changing the source file
+        converter_info = FakeConverterInfo()
+        f = open(self.source, 'ab')
+        f.write('more data')
+        f.close()
+        self.assertNotEquals(self.cache.get_key(self.source, converter_info),
+                             key)
+        self.assertEquals(self.cache.get_key(self.source + 'x',
+                                             converter_info), None)
+
+    def test_lookup(self):
+        key = self.cache.get_key(self.source, FakeConverterInfo())
+        self.assertEquals(self.cache.lookup(key), None)
+        self.cache.add(key, self.make_file('converted'))
+        path = self.cache.lookup(key)
+        self.assertEquals(open(path, 'rb').read(), 'converted')
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_prune(self):
+        self.cache.MAX_SIZE = 20
+        for i, key in enumerate(['a', 'b', 'c']):
+            self.cache.add(key, self.make_file('0123456789'))
+            # make sure the entries have different last used times
+            os.utime(self.cache.get_path(key), (i, i))
+        self.assertSameSet(os.listdir(self.cache.get_directory()),
+                           ['b', 'c'])
+        # looking an entry up makes it the most recently used one
+        self.cache.lookup('b')
+        self.cache.add('d', self.make_file('0123456789'))
+        self.assertSameSet(os.listdir(self.cache.get_directory()),
+                           ['b', 'd'])
+
+class FakeItemInfo(object):
+    def __init__(self, duration, size):
+        self.duration = duration
+        self.size = size
+
+class ConversionStatsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.stats = conversions.ConversionStats()
+
+    def tearDown(self):
+        self.stats.close()
+        MiroTestCase.tearDown(self)
+
+    def test_fallback(self):
+        converter_info = FakeConverterInfo()
+        item_info = FakeItemInfo(100, 12345)
+        # no stats and no bit rate: go by the size of the source
+        self.assertEquals(self.stats.estimate_size(converter_info, item_info),
+                          12345)
+        converter_info.bit_rate = 8000
+        self.assertEquals(self.stats.estimate_size(converter_info, item_info),
+                          100000)
+        self.assertEquals(self.stats.estimate_time(converter_info, 100), None)
+
+    def test_record(self):
+        converter_info = FakeConverterInfo()
+        converter_info.bit_rate = 8000
+        # 100 seconds of media -> 50000 bytes in 10 seconds
+        self.stats.record('fake', 100, 50000, 10)
+        self.assertEquals(self.stats.estimate_size(converter_info,
+                                                   FakeItemInfo(200, 1)),
+                          100000)
+        self.assertEquals(self.stats.estimate_time(converter_info, 200), 20)
+        # later conversions move the averages
+        self.stats.record('fake', 100, 100000, 10)
+        size = self.stats.estimate_size(converter_info, FakeItemInfo(200, 1))
+        self.assert_(100000 < size < 200000)
+        self.assertEquals(self.stats.get_stats('fake')[2], 2)
+        self.assertEquals(self.stats.get_stats('other'), None)
+
+    def test_ignore_bad_samples(self):
+        self.stats.record('fake', 0, 50000, 10)
+        self.stats.record('fake', 100, 0, 10)
+        self.assertEquals(self.stats.get_stats('fake'), None)
+
+    def test_persistent(self):
+        self.stats.record('fake', 100, 50000, 10)
+        self.stats.close()
+        stats = conversions.ConversionStats()
+        try:
+            self.assertEquals(stats.get_stats('fake'), (500.0, 10.0, 1))
+        finally:
+            stats.close()
+
 class ConversionInfoTest(MiroTestCase):
     def get_output_file(self, filepath):
         filename = os.path.basename(filepath)
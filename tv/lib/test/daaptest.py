@@ -0,0 +1,229 @@
+import httplib
+import os
+import random
+import socket
+import threading
+
+from miro import libdaap
+from miro.libdaap import subr
+from miro.test.framework import MiroTestCase
+
+class DMAPEncodingTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reply = [('adbs', [
+                          ('mstt', libdaap.DAAP_OK),
+                          ('muty', 0),
+                          ('mlcl', [
+                              ('mlit', [('miid', 1), ('minm', 'one')]),
+                              ('mlit', [('miid', 2), ('minm', 'two')]),
+                          ]),
+                          ('mtco', 2),
+                      ])]
+
+    def test_round_trip(self):
+        data = str(subr.encode_response(self.reply))
+        self.assertEquals(subr.decode_response(data), self.reply)
+
+    def test_container_size(self):
+        data = subr.encode_tags([('mlcl', [('miid', 1)])])
+        # header + miid header + 4 byte integer
+        self.assertEquals(len(data), 8 + 8 + 4)
+        self.assertEquals(data[4:8], '\x00\x00\x00\x0c')
+
+    def test_bad_value_skipped(self):
+        data = subr.encode_tags([('miid', None), ('minm', 'x')])
+        self.assertEquals(subr.decode_response(data), [('minm', 'x')])
+
+    def test_truncated(self):
+        data = str(subr.encode_response(self.reply))
+        self.assertEquals(subr.decode_response(data[:6]), [(-1, [])])
+        self.assertEquals(subr.decode_response('minm\x00\x00\x00\x10abc'),
+                          [(-1, [])])
+
+    def test_encoded_tag(self):
+        itemprop = {'dmap.itemid': 1, 'dmap.itemname': 'one',
+                    'daap.songalbum': None}
+        meta = ('dmap.itemid', 'dmap.itemname', 'daap.songalbum')
+        blob = subr.encode_item(itemprop, meta)
+        self.assert_(isinstance(blob, subr.EncodedTag))
+        plain = subr.encode_tags([('mlcl', [subr.make_item_listing(itemprop,
+                                                                   meta)])])
+        self.assertEquals(subr.encode_tags([('mlcl', [blob])]), plain)
+        self.assertEquals(subr.decode_response(plain),
+                          [('mlcl', [('mlit', [
+                              ('mikd', libdaap.DAAP_ITEMKIND_AUDIO),
+                              ('miid', 1), ('minm', 'one')])])])
+
+def make_socket_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    writer.connect(listener.getsockname())
+    reader, address = listener.accept()
+    listener.close()
+    return reader, writer
+
+def read_all(sock, result):
+    data = []
+    while True:
+        d = sock.recv(65536)
+        if not d:
+            break
+        data.append(d)
+    result.append(''.join(data))
+
+class ChunkedStreamTest(MiroTestCase):
+    SIZE = 300 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path, f = self.make_temp_path_fileobj('.mp3')
+        self.data = ''.join(chr(random.randint(0, 255))
+                            for i in xrange(self.SIZE))
+        f.write(self.data)
+        f.close()
+
+    def send(self, start, end, use_sendfile, use_mmap):
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(start, os.SEEK_SET)
+        stream = subr.ChunkedStreamObj(file_obj, self.path, start, end)
+        stream.use_sendfile = use_sendfile
+        stream.use_mmap = use_mmap
+        reader, writer = make_socket_pair()
+        result = []
+        thread = threading.Thread(target=read_all, args=(reader, result))
+        thread.start()
+        try:
+            stream.send_to(writer)
+        finally:
+            writer.close()
+            thread.join()
+            reader.close()
+            file_obj.close()
+        self.assertEquals(len(result[0]), len(stream))
+        return result[0]
+
+    def check_ranges(self, use_sendfile, use_mmap):
+        # whole file, from an offset (past the first mmap page) and a range
+        for start, end in ((0, 0), (70000, 0), (70000, 250000), (5, 5)):
+            expected = self.data[start:end + 1 if end else None]
+            self.assertEquals(self.send(start, end, use_sendfile, use_mmap),
+                              expected)
+
+    def test_sendfile(self):
+        self.check_ranges(True, True)
+
+    def test_mmap(self):
+        self.check_ranges(False, True)
+
+    def test_chunked(self):
+        self.check_ranges(False, False)
+
+class FakeBackend(object):
+    def __init__(self):
+        self.revision = 1
+        self.listeners = []
+
+    def add_revision_listener(self, listener):
+        self.listeners.append(listener)
+        listener(self.revision)
+
+    def remove_revision_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def update_revision(self):
+        self.revision += 1
+        for listener in self.listeners:
+            listener(self.revision)
+
+class DaapServerTest(MiroTestCase):
+    CLIENTS = 200
+    WORKERS = 4
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.backend = FakeBackend()
+        self.server = libdaap.make_daap_server(self.backend, port=0,
+                                               max_conn=self.CLIENTS,
+                                               workers=self.WORKERS)
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.server_thread.start()
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.close()
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+        MiroTestCase.tearDown(self)
+
+    def request(self, conn, path):
+        conn.request('GET', path)
+        response = conn.getresponse()
+        self.assertEquals(response.status, libdaap.DAAP_OK)
+        return subr.decode_response(response.read())
+
+    def login(self):
+        address, port = self.server.server_address
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        self.connections.append(conn)
+        reply = self.request(conn, '/login')
+        return conn, subr.find_daap_tag('mlid', reply)
+
+    def test_update_waits(self):
+        thread_count = threading.active_count()
+        clients = [self.login() for i in xrange(self.CLIENTS)]
+        for conn, session in clients:
+            conn.request('GET', '/update?session-id=%d&revision-number=1' %
+                         session)
+        # All the clients are waiting without a thread each.
+        self.assert_(threading.active_count() <=
+                     thread_count + self.WORKERS + 1)
+        self.backend.update_revision()
+        for conn, session in clients:
+            response = conn.getresponse()
+            self.assertEquals(response.status, libdaap.DAAP_OK)
+            reply = subr.decode_response(response.read())
+            self.assertEquals(subr.find_daap_tag('musr', reply), 2)
+        # The connections are still usable afterwards.
+        conn, session = clients[0]
+        reply = self.request(conn, '/update?session-id=%d&revision-number=1' %
+                             session)
+        self.assertEquals(subr.find_daap_tag('musr', reply), 2)
+
+    def test_maxconn(self):
+        self.server.set_maxconn(1)
+        self.login()
+        address, port = self.server.server_address
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        self.connections.append(conn)
+        conn.request('GET', '/login')
+        self.assertEquals(conn.getresponse().status,
+                          libdaap.DAAP_UNAVAILABLE)
+
+    def test_stalled_clients(self):
+        old_timeout = libdaap.DaapHttpRequestHandler.timeout
+        self.assertEquals(old_timeout, libdaap.DAAP_REQUEST_TIMEOUT)
+        libdaap.DaapHttpRequestHandler.timeout = 0.2
+        try:
+            address, port = self.server.server_address
+            stalled = []
+            for i in xrange(self.WORKERS):
+                sock = socket.create_connection(('127.0.0.1', port))
+                stalled.append(sock)
+                # send part of a request and then stop
+                sock.sendall('GET /login HTTP/1.1\r\n')
+            # once the stalled clients time out, other clients get served
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+            self.connections.append(conn)
+            self.request(conn, '/login')
+            for sock in stalled:
+                sock.settimeout(10)
+                self.assertEquals(sock.recv(1024), '')
+                sock.close()
+        finally:
+            libdaap.DaapHttpRequestHandler.timeout = old_timeout
@@ -28,6 +28,7 @@
 # statement from all source files in the program, then also delete it here.
 
 import os
+import threading
 try:
     import simplejson as json
 except ImportError:
@@ -37,7 +38,7 @@ import sqlite3
 
 from miro.gtcache import gettext as _
 from miro.plat.utils import PlatformFilenameType
-from miro.test.framework import MiroTestCase
+from miro.test.framework import MiroTestCase, EventLoopTest
 from miro.test import mock
 
 from miro import devices
@@ -399,3 +400,410 @@ class DeviceDatabaseTest(MiroTestCase):
     def test_save_error(self):
         # FIXME: what should we do if we have an error saving to the device?
         pass
+
+    def get_rows(self, table):
+        cursor = self.device.sqlite_database.cursor
+        if table == 'device_item':
+            cursor.execute("SELECT file_type, path, data FROM device_item")
+            return dict(((r[0], r[1]), json.loads(r[2]))
+                        for r in cursor.fetchall())
+        else:
+            cursor.execute("SELECT key, data FROM device_data")
+            return dict((r[0], json.loads(r[1])) for r in cursor.fetchall())
+
+    def reload_from_store(self):
+        ddb = devices.DeviceDatabase()
+        ddb.attach_store(devices.DeviceDatabaseStore(
+            self.device.sqlite_database))
+        return ddb
+
+    def test_import_json(self):
+        self.device.database[u'audio'][u'foo.mp3'] = {u'title': u'Foo'}
+        self.device.database[u'sync'] = {u'audio': {u'enabled': True}}
+        self.device.database[u'device_name'] = u'Foo'
+        self.open_database()
+        # import_old_items() marks old items as having run MDP before the
+        # JSON data gets copied
+        foo = {u'title': u'Foo', u'mdp_state': item.MDP_STATE_RAN}
+        self.assertEquals(self.get_rows('device_item'),
+                          {(u'audio', u'foo.mp3'): foo})
+        self.assertEquals(self.get_rows('device_data'),
+                          {u'sync': {u'audio': {u'enabled': True}},
+                           u'device_name': u'Foo'})
+        self.assertEquals(self.device.database[u'audio'], {u'foo.mp3': foo})
+        self.assert_(self.device.database.store is not None)
+
+    def test_import_only_once(self):
+        self.device.database[u'device_name'] = u'Foo'
+        self.open_database()
+        self.device.sqlite_database.finish_transaction()
+        # the SQLite data wins over the (older) JSON data from now on
+        self.device.database = devices.DeviceDatabase({
+            u'device_name': u'Bar',
+            u'audio': {u'bar.mp3': {u'title': u'Bar'}}})
+        self.open_database()
+        self.assertEquals(self.device.database[u'device_name'], u'Foo')
+        self.assertEquals(self.device.database[u'audio'], {})
+
+    def test_incremental_write(self):
+        self.device.database[u'audio'][u'foo.mp3'] = {u'title': u'Foo'}
+        self.device.database[u'audio'][u'bar.mp3'] = {u'title': u'Bar'}
+        self.open_database()
+        ddb = self.device.database
+        ddb[u'audio'][u'foo.mp3'][u'rating'] = 5
+        del ddb[u'audio'][u'bar.mp3']
+        ddb[u'video'][u'baz.mp4'] = {u'title': u'Baz'}
+        self.assertEquals(ddb.dirty_items,
+                          set([(u'audio', u'foo.mp3'), (u'audio', u'bar.mp3'),
+                               (u'video', u'baz.mp4')]))
+        ddb.store.write(ddb)
+        self.assertEquals(ddb.dirty_items, set())
+        self.assertEquals(self.get_rows('device_item'), {
+            (u'audio', u'foo.mp3'): {u'title': u'Foo', u'rating': 5,
+                                     u'mdp_state': item.MDP_STATE_RAN},
+            (u'video', u'baz.mp4'): {u'title': u'Baz'},
+            })
+        self.assertEquals(dict(self.reload_from_store()), dict(ddb))
+
+    def test_write_replaced_file_type(self):
+        self.device.database[u'audio'][u'foo.mp3'] = {u'title': u'Foo'}
+        self.open_database()
+        ddb = self.device.database
+        ddb[u'audio'] = {u'bar.mp3': {u'title': u'Bar'}}
+        ddb.store.write(ddb)
+        self.assertEquals(self.get_rows('device_item'),
+                          {(u'audio', u'bar.mp3'): {u'title': u'Bar'}})
+
+    def test_write_other_keys(self):
+        self.open_database()
+        ddb = self.device.database
+        # setdefault() and in-place changes don't go through __setitem__
+        ddb.setdefault(u'sync', {}).setdefault(u'audio', {})[u'items'] = [1]
+        ddb[u'device_name'] = u'Foo'
+        ddb.store.write(ddb)
+        self.assertEquals(self.get_rows('device_data'),
+                          {u'sync': {u'audio': {u'items': [1]}},
+                           u'device_name': u'Foo'})
+        ddb[u'sync'][u'audio'][u'items'].append(2)
+        del ddb[u'device_name']
+        ddb.store.write(ddb)
+        self.assertEquals(self.get_rows('device_data'),
+                          {u'sync': {u'audio': {u'items': [1, 2]}}})
+
+    def test_directory_fingerprints(self):
+        self.open_database()
+        ddb = self.device.database
+        fingerprints = {u'': [10.0, 2], u'music': [20.0, 1]}
+        ddb.set_directory_fingerprints(fingerprints)
+        # they are written straight away, and not with the other keys
+        self.assertEquals(self.get_rows('device_data'), {})
+        self.assertEquals(self.reload_from_store().directory_fingerprints,
+                          fingerprints)
+        ddb.set_directory_fingerprints({u'': [11.0, 2]})
+        self.assertEquals(self.reload_from_store().directory_fingerprints,
+                          {u'': [11.0, 2]})
+
+    def test_reopen_with_directory_fingerprints(self):
+        # the directory_fingerprint table has no id column, reopening the
+        # database shouldn't trip over it
+        self.open_database()
+        self.make_device_items('foo.mp3')
+        self.device.database.set_directory_fingerprints({u'': [10.0, 1]})
+        self.device.sqlite_database.finish_transaction()
+        self.device.database = devices.DeviceDatabase()
+        self.open_database()
+        self.assertEquals(self.device.database.directory_fingerprints,
+                          {u'': [10.0, 1]})
+        cursor = self.device.sqlite_database.cursor
+        cursor.execute("SELECT path FROM metadata_status")
+        self.assertSameSet([r[0] for r in cursor.fetchall()], ['foo.mp3'])
+
+    def test_write_database_export(self):
+        self.open_database()
+        ddb = self.device.database
+        ddb[u'audio'][u'foo.mp3'] = {u'title': u'Foo'}
+        devices.write_database(ddb, self.device.mount)
+        self.assertEquals(self.get_rows('device_item'),
+                          {(u'audio', u'foo.mp3'): {u'title': u'Foo'}})
+        with open(os.path.join(self.device.mount, '.miro', 'json')) as f:
+            self.assertEquals(json.load(f), dict(ddb))
+
+class FakeDeviceItem(object):
+    def __init__(self, id_, file_type=u'audio'):
+        self.id = id_
+        self.file_type = file_type
+
+class DeviceDatabaseIndexTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.database = devices.DeviceDatabase()
+        self.database[u'audio'] = {
+            u'one.mp3': {u'url': u'http://example.com/one.mp3',
+                         u'title': u'One', u'size': 100},
+            u'two.mp3': {u'title': u'Two', u'description': u'Second',
+                         u'size': 200, u'duration': 5000},
+            }
+        self.database[u'video'] = {}
+
+    def make_info(self, **kwargs):
+        info = FakeDeviceItem(None)
+        info.file_url = None
+        info.name = u'Other'
+        info.description = None
+        info.size = 300
+        info.duration = None
+        info.__dict__.update(kwargs)
+        return info
+
+    def test_item_exists(self):
+        db = self.database
+        self.assert_(db.item_exists(self.make_info(
+            file_url=u'http://example.com/one.mp3')))
+        self.assert_(db.item_exists(self.make_info(
+            name=u'Two', description=u'Second', size=200, duration=5)))
+        self.assert_(not db.item_exists(self.make_info()))
+        self.assert_(not db.item_exists(self.make_info(
+            file_url=u'http://example.com/one.mp3', file_type=u'video')))
+
+    def test_signals(self):
+        db = self.database
+        info = self.make_info(file_url=u'http://example.com/three.mp3')
+        self.assert_(not db.item_exists(info))
+        db[u'audio'][u'three.mp3'] = {u'url': u'http://example.com/three.mp3'}
+        db.emit('item-added', FakeDeviceItem(u'three.mp3'))
+        self.assert_(db.item_exists(info))
+        db[u'audio'][u'three.mp3'] = {u'url': u'http://example.com/3.mp3'}
+        db.emit('item-changed', FakeDeviceItem(u'three.mp3'))
+        self.assert_(not db.item_exists(info))
+        self.assert_(db.item_exists(self.make_info(
+            file_url=u'http://example.com/3.mp3')))
+        del db[u'audio'][u'three.mp3']
+        db.emit('item-removed', FakeDeviceItem(u'three.mp3'))
+        self.assert_(not db.item_exists(self.make_info(
+            file_url=u'http://example.com/3.mp3')))
+
+    def test_removed_without_signal(self):
+        info = self.make_info(file_url=u'http://example.com/one.mp3')
+        self.assert_(self.database.item_exists(info))
+        del self.database[u'audio'][u'one.mp3']
+        self.assert_(not self.database.item_exists(info))
+
+class DeviceDatabaseViewTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.database = devices.DeviceDatabase({
+            u'audio': {u'one.mp3': {u'title': u'One'}},
+            u'sync': {u'audio': {u'enabled': False}},
+            })
+        self.changes = 0
+        self.database.connect('changed', self.on_changed)
+
+    def on_changed(self, database):
+        self.changes += 1
+
+    def test_access(self):
+        db = self.database
+        self.assertEquals(db[u'audio'][u'one.mp3'][u'title'], u'One')
+        self.assertEquals(db[u'audio'], {u'one.mp3': {u'title': u'One'}})
+        self.assertEquals(db[u'audio'].keys(), [u'one.mp3'])
+        self.assert_(u'one.mp3' in db[u'audio'])
+        self.assertEquals(len(db[u'audio']), 1)
+        self.assertEquals(db.get(u'sync').get(u'audio')[u'enabled'], False)
+        self.assertEquals(db[u'audio'].get(u'two.mp3'), None)
+
+    def test_views_not_stored(self):
+        self.database[u'audio'][u'one.mp3'][u'rating'] = 5
+        # we only keep plain dictionaries around
+        items = dict.__getitem__(self.database, u'audio')
+        self.assertEquals(type(items), dict)
+        self.assertEquals(type(items[u'one.mp3']), dict)
+        self.assertEquals(items[u'one.mp3'][u'rating'], 5)
+
+    def test_changes(self):
+        db = self.database
+        db[u'audio'][u'one.mp3'][u'rating'] = 5
+        db[u'audio'][u'two.mp3'] = {u'title': u'Two'}
+        del db[u'audio'][u'two.mp3']
+        db[u'audio'].setdefault(u'three.mp3', {})[u'title'] = u'Three'
+        db.get(u'sync')[u'audio'][u'enabled'] = True
+        self.assertEquals(self.changes, 6)
+        self.assertEquals(db.dirty_items,
+                          set([(u'audio', u'one.mp3'), (u'audio', u'two.mp3'),
+                               (u'audio', u'three.mp3')]))
+        self.assertEquals(db.dirty_types, set())
+        self.assertEquals(dict.__getitem__(db, u'sync'),
+                          {u'audio': {u'enabled': True}})
+
+    def test_set_view(self):
+        db = self.database
+        db[u'video'] = db[u'audio']
+        self.assertEquals(type(dict.__getitem__(db, u'video')), dict)
+        self.assertEquals(db.dirty_types, set([u'video']))
+
+class WalkChangedDirectoriesTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.mount = os.path.join(self.tempdir, 'device') + os.path.sep
+        self.fingerprints = {}
+        self.make_file('a.mp3')
+        self.make_file(os.path.join('music', 'b.mp3'))
+        self.make_file(os.path.join('music', 'artist', 'c.mp3'))
+        self.make_file(os.path.join('.hidden', 'd.mp3'))
+
+    def make_file(self, path):
+        path = os.path.join(self.mount, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'wb').close()
+
+    def walk(self):
+        old_fingerprints = self.fingerprints
+        self.fingerprints = {}
+        self.seen = set()
+        return sorted(path for path in devices.walk_changed_directories(
+            self.mount, old_fingerprints, self.fingerprints, self.seen)
+                      if path is not None)
+
+    def test_first_scan(self):
+        self.assertEquals(self.walk(), [
+            'a.mp3',
+            os.path.join('music', 'artist', 'c.mp3'),
+            os.path.join('music', 'b.mp3'),
+            ])
+        self.assertSameSet(self.fingerprints.keys(),
+                           [u'', u'music', os.path.join(u'music', u'artist')])
+        self.assert_(os.path.normcase(os.path.join('music', 'b.mp3'))
+                     in self.seen)
+        self.assert_('.hidden' not in self.seen)
+
+    def test_unchanged(self):
+        self.walk()
+        fingerprints = self.fingerprints
+        self.assertEquals(self.walk(), [])
+        self.assertEquals(self.fingerprints, fingerprints)
+        # we still know which files exist
+        self.assert_(os.path.normcase(os.path.join('music', 'artist', 'c.mp3'))
+                     in self.seen)
+
+    def test_changed_subdirectory(self):
+        self.walk()
+        self.make_file(os.path.join('music', 'artist', 'e.mp3'))
+        self.assertEquals(self.walk(), [
+            os.path.join('music', 'artist', 'c.mp3'),
+            os.path.join('music', 'artist', 'e.mp3'),
+            ])
+
+    def test_new_subdirectory(self):
+        self.walk()
+        self.make_file(os.path.join('music', 'new', 'f.mp3'))
+        self.assertEquals(self.walk(), [
+            os.path.join('music', 'b.mp3'),
+            os.path.join('music', 'new', 'f.mp3'),
+            ])
+
+    def test_removed_subdirectory(self):
+        self.walk()
+        os.remove(os.path.join(self.mount, 'music', 'artist', 'c.mp3'))
+        os.rmdir(os.path.join(self.mount, 'music', 'artist'))
+        self.assertEquals(self.walk(), [os.path.join('music', 'b.mp3')])
+        self.assertSameSet(self.fingerprints.keys(), [u'', u'music'])
+
+    def test_keeps_case(self):
+        # act like a case-insensitive filesystem
+        self.patch_function('os.path.normcase', lambda path: path.lower())
+        self.make_file(os.path.join('Album', 'Song.MP3'))
+        self.assert_(os.path.join('Album', 'Song.MP3') in self.walk())
+        self.assert_(os.path.join('album', 'song.mp3') in self.seen)
+
+class BlockingDeviceCopier(devices.DeviceCopier):
+    """DeviceCopier that waits after writing the first block."""
+    def __init__(self, *args):
+        devices.DeviceCopier.__init__(self, *args)
+        self.first_block_written = threading.Event()
+        self.resume = threading.Event()
+
+    def _write(self, output, data):
+        devices.DeviceCopier._write(self, output, data)
+        if not self.first_block_written.isSet():
+            self.first_block_written.set()
+            self.resume.wait()
+
+class DeviceCopierTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.source_dir = self.make_temp_dir_path()
+        self.dest_dir = self.make_temp_dir_path()
+        self.progress = []
+        self.finished = []
+
+    def make_copier(self, klass=devices.DeviceCopier):
+        copier = klass('Device', self.progress.append,
+                       lambda dest, success: self.finished.append(
+                           (os.path.basename(dest), success)))
+        copier.MIN_BLOCK_SIZE = 1024
+        copier.block_size = 1024
+        copier.PROGRESS_INTERVAL = 0
+        return copier
+
+    def make_source(self, name, size):
+        path = os.path.join(self.source_dir, name)
+        f = open(path, 'wb')
+        f.write(os.urandom(size))
+        f.close()
+        return path
+
+    def start_copy(self, copier, name, size):
+        source = self.make_source(name, size)
+        dest = os.path.join(self.dest_dir, name)
+        open(dest, 'wb').close()
+        copier.copy(source, dest, name)
+        return source, dest
+
+    def wait_for(self, copier):
+        self.assert_(copier.wait(10))
+        self.runPendingIdles()
+
+    def test_copy(self):
+        copier = self.make_copier()
+        source, dest = self.start_copy(copier, 'a.mp3', 10000)
+        self.wait_for(copier)
+        self.assertEquals(self.finished, [('a.mp3', True)])
+        self.assertEquals(open(dest, 'rb').read(), open(source, 'rb').read())
+        self.assertEquals(os.listdir(self.dest_dir), ['a.mp3'])
+        self.assertEquals(self.progress[-1], {'a.mp3': 10000})
+
+    def test_copy_order(self):
+        copier = self.make_copier(BlockingDeviceCopier)
+        self.start_copy(copier, 'first.mp3', 5000)
+        copier.first_block_written.wait()
+        for name in ('c.mp3', 'a.mp3', 'b.mp3'):
+            self.start_copy(copier, name, 100)
+        copier.resume.set()
+        self.wait_for(copier)
+        self.assertEquals([name for name, success in self.finished],
+                          ['first.mp3', 'a.mp3', 'b.mp3', 'c.mp3'])
+
+    def test_cancel(self):
+        copier = self.make_copier(BlockingDeviceCopier)
+        self.start_copy(copier, 'a.mp3', 5000)
+        self.start_copy(copier, 'b.mp3', 5000)
+        copier.first_block_written.wait()
+        copier.cancel()
+        copier.resume.set()
+        self.wait_for(copier)
+        # copies asked for after cancelling fail straight away
+        self.start_copy(copier, 'c.mp3', 5000)
+        self.runPendingIdles()
+        self.assertEquals(self.finished, [('a.mp3', False), ('b.mp3', False),
+                                          ('c.mp3', False)])
+        # neither the partial copy nor the placeholders are left behind
+        self.assertEquals(os.listdir(self.dest_dir), [])
+
+    def test_missing_source(self):
+        copier = self.make_copier()
+        dest = os.path.join(self.dest_dir, 'a.mp3')
+        open(dest, 'wb').close()
+        copier.copy(os.path.join(self.source_dir, 'missing.mp3'), dest, 1)
+        self.wait_for(copier)
+        self.assertEquals(self.finished, [('a.mp3', False)])
+        self.assertEquals(os.listdir(self.dest_dir), [])
@@ -0,0 +1,120 @@
+from miro import downloader
+from miro.test import mock
+from miro.test.framework import MiroTestCase
+
+class FakeRemoteDownloader(object):
+    status_updates_frozen = False
+
+class DownloadStateManagerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = downloader.DownloadStateManager()
+        self.manager.RESTORE_BATCH_SIZE = 2
+        self.manager.RESTORE_WINDOW = 2
+        self.batches = []
+        self.batch_ids = []
+        self.patch_function('miro.dl_daemon.command.RestoreDownloadersCommand',
+                            self.make_restore_command)
+        self.patch_function('miro.messages.DownloaderRestoreProgress',
+                            self.make_progress_message)
+        self.progress = []
+        # RemoteDownloader.dldaemon is only set once the daemon starts
+        patcher = mock.patch.object(downloader.RemoteDownloader, 'dldaemon',
+                                    mock.Mock(), create=True)
+        patcher.start()
+        self.mock_patchers.append(patcher)
+
+    def make_restore_command(self, daemon, batch_id, batch):
+        self.batches.append([dlid for dlid, status in batch])
+        self.batch_ids.append(batch_id)
+        return FakeCommand()
+
+    def make_progress_message(self, restored, total):
+        self.progress.append((restored, total))
+        return FakeCommand()
+
+    def batch_done(self, index):
+        self.manager.restore_batch_done(self.batch_ids[index],
+                                        len(self.batches[index]))
+
+    def queue_restore(self, dlid, state):
+        self.manager.add_download(dlid, FakeRemoteDownloader())
+        self.manager.queue(dlid, self.manager.RESTORE,
+                           {'downloader': {'state': state}})
+
+    def test_batches(self):
+        self.queue_restore(u'seed1', u'uploading')
+        self.queue_restore(u'paused1', u'paused')
+        self.queue_restore(u'dl1', u'downloading')
+        self.queue_restore(u'dl2', u'offline')
+        self.queue_restore(u'seed2', u'uploading')
+        self.queue_restore(u'dl3', u'downloading')
+        self.manager.send_initial_updates()
+        # active downloads go first, seeds last.  We only send
+        # RESTORE_WINDOW batches until the daemon replies.
+        self.assertEquals(self.batches, [[u'dl1', u'dl2'],
+                                         [u'dl3', u'paused1']])
+        self.batch_done(0)
+        self.assertEquals(self.batches[2:], [[u'seed1', u'seed2']])
+        self.batch_done(1)
+        self.batch_done(2)
+        self.assertEquals(len(self.batches), 3)
+        self.assertEquals(self.manager.restore_timeout_dc, None)
+        self.assertEquals(self.progress, [(2, 6), (4, 6), (6, 6)])
+
+    def test_command_waits_for_restore(self):
+        self.manager.RESTORE_WINDOW = 1
+        for i in range(4):
+            self.queue_restore(u'dl%d' % i, u'downloading')
+        self.queue_restore(u'seed', u'uploading')
+        self.manager.send_initial_updates()
+        self.manager.start_updates = lambda: None
+        self.manager.queue(u'seed', self.manager.PAUSE, {'upload': True})
+        self.manager.send_updates()
+        # the pause has to wait until the seed is restored, and the seed
+        # gets restored next.
+        self.assert_(u'seed' in self.manager.commands)
+        # holding onto the command doesn't queue the restore again
+        queue_length = len(self.manager.restore_queue)
+        self.manager.send_updates()
+        self.assertEquals(len(self.manager.restore_queue), queue_length)
+        self.batch_done(0)
+        self.assertEquals(self.batches[1], [u'seed', u'dl2'])
+
+    def test_timeout(self):
+        for i in range(4):
+            self.queue_restore(u'dl%d' % i, u'downloading')
+        self.queue_restore(u'seed', u'uploading')
+        self.manager.send_initial_updates()
+        self.batch_done(0)
+        # the reply for the second batch got lost.  After RESTORE_TIMEOUT
+        # it gets sent again, before the seed.
+        self.assertEquals(self.batches[2], [u'seed'])
+        self.manager._on_restore_timeout()
+        self.assertEquals(self.batches[3:], [[u'dl2', u'dl3'], [u'seed']])
+        # a late reply for the old batch is ignored
+        self.batch_done(1)
+        self.assertEquals(self.manager.restored_count, 2)
+        self.batch_done(3)
+        self.batch_done(4)
+        self.assertEquals(self.progress[-1], (5, 5))
+
+    def test_daemon_restart(self):
+        for i in range(6):
+            self.queue_restore(u'dl%d' % i, u'downloading')
+        self.manager.send_initial_updates()
+        self.assertEquals(len(self.batches), 2)
+        # a new daemon never replies for batches sent to the old one, so
+        # starting it sends them again.
+        self.manager.send_initial_updates()
+        self.assertEquals(self.batches[2:], [[u'dl0', u'dl1'],
+                                             [u'dl2', u'dl3']])
+        self.batch_done(2)
+        self.assertEquals(self.batches[4:], [[u'dl4', u'dl5']])
+
+class FakeCommand(object):
+    def send(self):
+        pass
+
+    def send_to_frontend(self):
+        pass
@@ -9,12 +9,18 @@ from miro import app
 from miro.test.framework import MiroTestCase
 from miro.dl_daemon.download import (save_fast_resume_data,
                                      load_fast_resume_data,
-                                     generate_fast_resume_filename)
+                                     remove_fast_resume_data,
+                                     generate_fast_resume_filename,
+                                     FAST_RESUME_STORE, RecheckQueue)
 
 FAKE_INFO_HASH = 'PINKPASTA'
 FAKE_RESUME_DATA = 'BEER'
   
 class FastResumeTest(MiroTestCase):
+    def tearDown(self):
+        FAST_RESUME_STORE.close()
+        MiroTestCase.tearDown(self)
+
     # test_resume_data: Test easy load/store.
     def test_resume_data(self):
         save_fast_resume_data(FAKE_INFO_HASH, FAKE_RESUME_DATA)
@@ -31,8 +37,9 @@ class FastResumeTest(MiroTestCase):
         f.close()
         os.chmod(filename, 0)
         save_fast_resume_data(FAKE_INFO_HASH, FAKE_RESUME_DATA)
-        # We did not lock down the directory so check save_fast_resume_data
-        # nuked the file for us.
+        FAST_RESUME_STORE.flush()
+        # We did not lock down the directory so check the flush nuked the
+        # file for us.
         self.assertFalse(os.path.exists(filename))
 
     # Try to load a unreadable file so the load fails.
@@ -48,3 +55,152 @@ class FastResumeTest(MiroTestCase):
         data = load_fast_resume_data(FAKE_INFO_HASH)
         self.assertEquals(data, None)
         os.chmod(filename, old_mode)
+
+    # test_store_persists: data survives closing and reopening the store
+    def test_store_persists(self):
+        save_fast_resume_data(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        save_fast_resume_data('OTHER', 'WINE')
+        FAST_RESUME_STORE.close()
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA)
+        self.assertEquals(load_fast_resume_data('OTHER'), 'WINE')
+
+    # test_remove: removing data also removes it from the store
+    def test_remove(self):
+        save_fast_resume_data(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        FAST_RESUME_STORE.flush()
+        remove_fast_resume_data(FAKE_INFO_HASH)
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH), None)
+        FAST_RESUME_STORE.close()
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH), None)
+
+    # test_old_file: data written by older versions is still loaded, then
+    # moved into the store on the next flush.
+    def test_old_file(self):
+        filename = generate_fast_resume_filename(FAKE_INFO_HASH)
+        os.makedirs(os.path.dirname(filename))
+        f = open(filename, 'wb')
+        f.write(FAKE_RESUME_DATA)
+        f.close()
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA)
+        save_fast_resume_data(FAKE_INFO_HASH, 'NEW')
+        # the old file has to stay around until the new data is committed
+        self.assert_(os.path.exists(filename))
+        FAST_RESUME_STORE.flush()
+        self.assertFalse(os.path.exists(filename))
+        FAST_RESUME_STORE.close()
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH), 'NEW')
+
+    # test_failed_flush: if the commit fails, the data stays pending, the
+    # old file is kept and another flush is scheduled.
+    def test_failed_flush(self):
+        filename = generate_fast_resume_filename(FAKE_INFO_HASH)
+        os.makedirs(os.path.dirname(filename))
+        f = open(filename, 'wb')
+        f.write(FAKE_RESUME_DATA)
+        f.close()
+        save_fast_resume_data(FAKE_INFO_HASH, 'NEW')
+        FAST_RESUME_STORE._ensure_connection()
+        FAST_RESUME_STORE.connection.execute("DROP TABLE fast_resume")
+        FAST_RESUME_STORE.flush()
+        self.assert_(os.path.exists(filename))
+        self.assert_(FAST_RESUME_STORE.flush_dc is not None)
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH), 'NEW')
+        # don't leak the pending data into other tests
+        FAST_RESUME_STORE.flush_dc.cancel()
+        FAST_RESUME_STORE.flush_dc = None
+        FAST_RESUME_STORE.pending = {}
+
+class FakeRecheckDownloader(object):
+    def __init__(self, priority, disk):
+        self.priority = priority
+        self.disk = disk
+        self.checking = False
+        self.disk_lookups = 0
+
+    def get_recheck_priority(self):
+        return self.priority
+
+    def get_disk(self):
+        self.disk_lookups += 1
+        return self.disk
+
+    def start_recheck(self):
+        self.checking = True
+
+    def is_checking_files(self):
+        return self.checking
+
+class RecheckQueueTest(MiroTestCase):
+    def test_one_check_per_disk(self):
+        queue = RecheckQueue()
+        old = FakeRecheckDownloader((False, -1), 'disk1')
+        new = FakeRecheckDownloader((False, -2), 'disk1')
+        other_disk = FakeRecheckDownloader((True, -1), 'disk2')
+        queue.add(old)
+        queue.add(new)
+        queue.add(other_disk)
+        # the first torrent on disk1 starts right away.  The second one
+        # has to wait, but the one on disk2 can start.
+        self.assert_(old.checking)
+        self.assert_(not new.checking)
+        self.assert_(other_disk.checking)
+        self.assert_(queue.is_waiting(new))
+        old.checking = False
+        queue.update()
+        self.assert_(new.checking)
+        self.assert_(not queue.is_queued(old))
+
+    def test_priority(self):
+        queue = RecheckQueue()
+        busy = FakeRecheckDownloader((False, 0), 'disk')
+        seed = FakeRecheckDownloader((True, -10), 'disk')
+        recent = FakeRecheckDownloader((False, -10), 'disk')
+        older = FakeRecheckDownloader((False, -5), 'disk')
+        for downloader in (busy, seed, older, recent):
+            queue.add(downloader)
+        busy.checking = False
+        queue.update()
+        self.assert_(recent.checking)
+        self.assert_(not older.checking)
+        self.assert_(not seed.checking)
+
+    def test_remove(self):
+        queue = RecheckQueue()
+        first = FakeRecheckDownloader((False, 0), 'disk')
+        second = FakeRecheckDownloader((False, 0), 'disk')
+        queue.add(first)
+        queue.add(second)
+        queue.remove(first)
+        self.assert_(second.checking)
+
+    def test_disk_looked_up_once(self):
+        queue = RecheckQueue()
+        first = FakeRecheckDownloader((False, 0), 'disk')
+        second = FakeRecheckDownloader((False, 0), 'disk')
+        queue.add(first)
+        queue.add(second)
+        for i in xrange(5):
+            queue.update()
+        self.assertEquals(second.disk_lookups, 1)
+        self.assert_(queue.is_waiting(second))
+
+    def test_remove_and_add_again(self):
+        queue = RecheckQueue()
+        busy = FakeRecheckDownloader((False, 0), 'disk')
+        first = FakeRecheckDownloader((False, 1), 'disk')
+        second = FakeRecheckDownloader((False, 2), 'disk')
+        queue.add(busy)
+        queue.add(first)
+        queue.add(second)
+        queue.remove(first)
+        self.assert_(not queue.is_queued(first))
+        # added again, now it goes after second
+        first.get_recheck_priority = lambda: (False, 3)
+        queue.add(first)
+        busy.checking = False
+        queue.update()
+        self.assert_(second.checking)
+        self.assert_(not first.checking)
+        self.assert_(queue.is_waiting(first))
@@ -0,0 +1,98 @@
+import os
+import time
+
+from miro import mediainfocache
+from miro.test.framework import MiroTestCase
+
+class MediaInfoCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.ffmpeg_calls = []
+        self.ffmpeg_fails = False
+        self.patch_function('miro.mediainfocache.run_ffmpeg',
+                            self.fake_run_ffmpeg)
+        self.media_file = self.make_temp_path('.mp4')
+        self.write_media_file('data')
+        self.cache = mediainfocache.MediaInfoCache()
+
+    def tearDown(self):
+        self.cache.close()
+        MiroTestCase.tearDown(self)
+
+    def fake_run_ffmpeg(self, path):
+        self.ffmpeg_calls.append(path)
+        if self.ffmpeg_fails:
+            return 'ffmpeg: not found'
+        return 'Input #0, from %r: call %d' % (path, len(self.ffmpeg_calls))
+
+    def write_media_file(self, data, mtime=None):
+        f = open(self.media_file, 'wb')
+        f.write(data)
+        f.close()
+        if mtime is not None:
+            os.utime(self.media_file, (mtime, mtime))
+
+    def test_hit(self):
+        output = self.cache.get_ffmpeg_output(self.media_file)
+        self.assertEquals(self.cache.get_ffmpeg_output(self.media_file),
+                          output)
+        self.assertEquals(len(self.ffmpeg_calls), 1)
+
+    def test_persistent(self):
+        output = self.cache.get_ffmpeg_output(self.media_file)
+        self.cache.close()
+        cache = mediainfocache.MediaInfoCache()
+        try:
+            self.assertEquals(cache.get_ffmpeg_output(self.media_file),
+                              output)
+        finally:
+            cache.close()
+        self.assertEquals(len(self.ffmpeg_calls), 1)
+
+    def test_size_changed(self):
+        mtime = time.time() - 100
+        self.write_media_file('data', mtime)
+        self.cache.get_ffmpeg_output(self.media_file)
+        self.write_media_file('more data', mtime)
+        self.assert_(self.cache.get_ffmpeg_output(self.media_file).endswith(
+            'call 2'))
+        self.assertEquals(len(self.ffmpeg_calls), 2)
+
+    def test_mtime_changed(self):
+        self.write_media_file('data', time.time() - 100)
+        self.cache.get_ffmpeg_output(self.media_file)
+        self.write_media_file('data', time.time() - 50)
+        self.cache.get_ffmpeg_output(self.media_file)
+        self.cache.get_ffmpeg_output(self.media_file)
+        self.assertEquals(len(self.ffmpeg_calls), 2)
+
+    def test_missing_file(self):
+        missing = self.media_file + 'x'
+        self.cache.get_ffmpeg_output(missing)
+        self.cache.get_ffmpeg_output(missing)
+        self.assertEquals(self.ffmpeg_calls, [missing, missing])
+
+    def test_failed_run_not_cached(self):
+        self.ffmpeg_fails = True
+        self.cache.get_ffmpeg_output(self.media_file)
+        self.ffmpeg_fails = False
+        self.assert_(self.cache.get_ffmpeg_output(
+            self.media_file).startswith('Input #0'))
+        self.assertEquals(len(self.ffmpeg_calls), 2)
+
+    def test_prune(self):
+        self.cache.MAX_ENTRIES = 3
+        self.cache.PRUNE_INTERVAL = 1
+        paths = []
+        for i in range(5):
+            path = self.make_temp_path('.mp4')
+            open(path, 'wb').close()
+            paths.append(path)
+            self.cache.get_ffmpeg_output(path)
+            # make sure last_used is different for each entry
+            self.cache.connection.execute("UPDATE media_info "
+                                          "SET last_used=? WHERE path=?",
+                                          (i, path))
+        rows = self.cache.connection.execute("SELECT path FROM media_info "
+                                             "ORDER BY last_used").fetchall()
+        self.assertEquals([row[0] for row in rows], paths[2:])
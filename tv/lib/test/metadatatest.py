@@ -674,6 +674,26 @@ class MetadataManagerTest(MiroTestCase):
         self.check_run_movie_data('foo2.avi', 'audio', 100, True)
         self.assertEquals(self.get_metadata('foo2.avi')['has_drm'], False)
 
+    def test_run_updates_limit(self):
+        filenames = ['foo.mp3', 'bar.mp3', 'baz.mp3']
+        for filename in filenames:
+            self.check_add_file(filename)
+        self.metadata_manager.run_updates()
+        for filename in filenames:
+            self.processor.run_mutagen_callback(self.make_path(filename),
+                                                {'file_type': u'audio',
+                                                 'title': u'Title'})
+        signal_handler = mock.Mock()
+        self.metadata_manager.connect("new-metadata", signal_handler)
+        # with a limit, the rest of the results wait for the next run
+        self.metadata_manager.run_updates(limit=2)
+        self.assertEquals(len(signal_handler.call_args[0][1]), 2)
+        self.assertEquals(len(self.metadata_manager.metadata_finished), 1)
+        self.metadata_manager.run_updates()
+        self.assertEquals(signal_handler.call_args[0][1].keys(),
+                          [self.make_path('baz.mp3')])
+        self.assertEquals(self.metadata_manager.metadata_finished, [])
+
     def test_cover_art_and_new_metadata(self):
         # Test that when we get cover art for one item, we update it for all
         # items for that album
@@ -1,14 +1,23 @@
 import shutil
 import os
+import socket
+import threading
 import pstats
 import cProfile
+import random
+import time
+from datetime import datetime, timedelta
 
 from miro import app
+from miro import devices
 from miro import messagehandler
 from miro import messages
 from miro import models
+from miro import syncplanner
+from miro.autodler import PendingQueue, _release_sort_key
 from miro.fileobject import FilenameType
-from miro.test.framework import EventLoopTest
+from miro.libdaap import subr
+from miro.test.framework import EventLoopTest, MiroTestCase
 from miro.test import messagetest
 
 class PerformanceTest(EventLoopTest):
@@ -66,3 +75,228 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class FakePendingItem(object):
+    def __init__(self, id_, release_date):
+        self.id = id_
+        self.release_date = release_date
+
+    def get_pub_date_parsed(self):
+        return self.release_date
+
+class PendingQueuePerformanceTest(MiroTestCase):
+    ITEM_COUNT = 50000
+    FEED_COUNT = 500
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        start = datetime(2011, 1, 1)
+        self.items = [FakePendingItem(i, start + timedelta(hours=i))
+                      for i in xrange(self.ITEM_COUNT)]
+        random.shuffle(self.items)
+
+    def test_pending_queue(self):
+        queue = PendingQueue()
+        start = time.time()
+        for item in self.items:
+            key = u'feed-%d' % (item.id % self.FEED_COUNT)
+            queue.add(key, item, _release_sort_key(item))
+        added = time.time()
+        running = {}
+        while len(queue):
+            key = queue.next_feed()
+            item = queue.next_item(key)
+            queue.remove(item.id)
+            running[key] = running.get(key, 0) + 1
+            queue.update_feed(key, running[key], datetime.now())
+        drained = time.time()
+        print
+        print 'added %d pending items in %0.3f seconds' % (
+            self.ITEM_COUNT, added - start)
+        print 'started %d downloads in %0.3f seconds' % (
+            self.ITEM_COUNT, drained - added)
+
+class DMAPEncodingPerformanceTest(MiroTestCase):
+    ITEM_COUNT = 10000
+    META = ('dmap.itemid', 'dmap.itemname', 'dmap.persistentid',
+            'daap.songalbum', 'daap.songartist', 'daap.songtime',
+            'daap.songformat', 'com.apple.itunes.mediakind')
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.items = []
+        for i in xrange(self.ITEM_COUNT):
+            self.items.append({
+                'dmap.itemid': i,
+                'dmap.itemname': 'Item %d' % i,
+                'dmap.persistentid': i,
+                'daap.songalbum': 'Album %d' % (i % 100),
+                'daap.songartist': 'Artist %d' % (i % 50),
+                'daap.songtime': i * 1000,
+                'daap.songformat': 'mp3',
+                'com.apple.itunes.mediakind': 1,
+            })
+
+    def make_reply(self, itemlist):
+        return [('adbs', [('mstt', 200), ('muty', 0),
+                          ('mtco', len(itemlist)), ('mrco', len(itemlist)),
+                          ('mlcl', itemlist)])]
+
+    def test_encode_decode(self):
+        start = time.time()
+        itemlist = [subr.make_item_listing(item, self.META)
+                    for item in self.items]
+        data = str(subr.encode_response(self.make_reply(itemlist)))
+        encoded = time.time()
+        blobs = [subr.encode_item(item, self.META) for item in self.items]
+        str(subr.encode_response(self.make_reply(blobs)))
+        cached_start = time.time()
+        str(subr.encode_response(self.make_reply(blobs)))
+        cached = time.time()
+        decoded = subr.decode_response(data)
+        decode_end = time.time()
+        self.assertEquals(len(decoded[0][1][4][1]), self.ITEM_COUNT)
+        print
+        print 'encoded %d items (%d bytes) in %0.3f seconds' % (
+            self.ITEM_COUNT, len(data), encoded - start)
+        print 'encoded %d cached items in %0.3f seconds' % (
+            self.ITEM_COUNT, cached - cached_start)
+        print 'decoded %d items in %0.3f seconds' % (
+            self.ITEM_COUNT, decode_end - cached)
+
+class StreamingPerformanceTest(MiroTestCase):
+    FILE_SIZE = 256 * 1024 * 1024
+    BLOCK_SIZE = 1024 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = self.make_temp_path('.mp4')
+        # Write real data, so the reads actually hit the page cache/disk
+        # rather than the holes of a sparse file.
+        block = os.urandom(self.BLOCK_SIZE)
+        f = open(self.path, 'wb')
+        for i in xrange(self.FILE_SIZE / self.BLOCK_SIZE):
+            f.write(block)
+        f.close()
+
+    def send(self, use_sendfile, use_mmap, chunked):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        writer.connect(listener.getsockname())
+        reader, address = listener.accept()
+        listener.close()
+        received = []
+        def read_all():
+            count = 0
+            while True:
+                data = reader.recv(1024 * 1024)
+                if not data:
+                    break
+                count += len(data)
+            received.append(count)
+        thread = threading.Thread(target=read_all)
+        thread.start()
+        file_obj = open(self.path, 'rb')
+        stream = subr.ChunkedStreamObj(file_obj, self.path)
+        stream.use_sendfile = use_sendfile
+        stream.use_mmap = use_mmap
+        start = time.time()
+        if chunked:
+            for chunk in stream:
+                writer.sendall(chunk)
+        else:
+            stream.send_to(writer)
+        writer.close()
+        thread.join()
+        end = time.time()
+        reader.close()
+        file_obj.close()
+        self.assertEquals(received[0], self.FILE_SIZE)
+        return end - start
+
+    def test_streaming(self):
+        print
+        for name, args in (('chunked reads', (False, False, True)),
+                           ('buffered send_to', (False, False, False)),
+                           ('mmap', (False, True, False)),
+                           ('sendfile', (True, False, False))):
+            if name == 'sendfile' and subr.sendfile is None:
+                print 'sendfile not available'
+                continue
+            elapsed = self.send(*args)
+            print '%s: %d MB in %0.2f seconds (%0.1f MB/s)' % (
+                name, self.FILE_SIZE / (1024 * 1024), elapsed,
+                self.FILE_SIZE / (1024 * 1024) / elapsed)
+
+class FakeSyncInfo(object):
+    def __init__(self, i):
+        self.file_type = u'audio'
+        self.file_url = u'http://example.com/%d.mp3' % i
+        self.name = u'Track %d' % i
+        self.description = None
+        self.size = 1000 + i
+        self.duration = 180
+
+class DeviceSyncPlanningPerformanceTest(MiroTestCase):
+    DEVICE_ITEMS = 10000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.database = devices.DeviceDatabase()
+        self.database[u'audio'] = dict(
+            (u'track%d.mp3' % i, {u'url': u'http://example.com/%d.mp3' % i,
+                                  u'title': u'Track %d' % i,
+                                  u'size': 1000 + i})
+            for i in xrange(self.DEVICE_ITEMS))
+        # half of the candidates are already on the device
+        self.infos = [FakeSyncInfo(i) for i in
+                      xrange(self.DEVICE_ITEMS / 2,
+                             self.DEVICE_ITEMS * 3 / 2)]
+
+    def test_item_exists(self):
+        start = time.time()
+        existing = [info for info in self.infos
+                    if self.database.item_exists(info)]
+        end = time.time()
+        self.assertEquals(len(existing), self.DEVICE_ITEMS / 2)
+        print
+        print 'checked %d items against %d device items in %0.3f seconds' % (
+            len(self.infos), self.DEVICE_ITEMS, end - start)
+
+    def test_access_items(self):
+        start = time.time()
+        items = self.database[u'audio']
+        for path in items:
+            items[path][u'size']
+        end = time.time()
+        # lookups don't leave an object behind for each item
+        self.assertEquals(set(type(data) for data in
+                              dict.__getitem__(self.database,
+                                               u'audio').itervalues()),
+                          set([dict]))
+        print
+        print 'looked up %d device items in %0.3f seconds' % (
+            self.DEVICE_ITEMS, end - start)
+
+class AutoFillPlanningPerformanceTest(MiroTestCase):
+    CANDIDATES = 50000
+    # 16GB device, about a tenth of the candidates fit
+    CAPACITY = 16 * (2 ** 30)
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        r = random.Random(0)
+        self.candidates = [(r.randint(1, 70 * (2 ** 20)), r.random(), i)
+                           for i in xrange(self.CANDIDATES)]
+
+    def test_plan_fill(self):
+        start = time.time()
+        items, size = syncplanner.plan_fill(self.candidates, self.CAPACITY)
+        end = time.time()
+        self.assert_(size <= self.CAPACITY)
+        print
+        print 'planned %d of %d items (%0.1f%% full) in %0.3f seconds' % (
+            len(items), self.CANDIDATES, 100.0 * size / self.CAPACITY,
+            end - start)
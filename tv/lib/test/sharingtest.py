@@ -0,0 +1,277 @@
+import time
+
+from miro import sharing
+from miro.sharing import (RevisionLog, ShareListingCache, ShareProber,
+                          KnownShareCache, SharingManagerBackend)
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class RevisionLogTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.log = RevisionLog()
+
+    def test_changed_since(self):
+        self.log.stamp(2, 10)
+        self.log.stamp(3, 11)
+        self.log.stamp(3, 12)
+        self.log.stamp(5, 10)
+        self.assertEquals(self.log.changed_since(0), set([10, 11, 12]))
+        self.assertEquals(self.log.changed_since(3), set([10]))
+        self.assertEquals(self.log.changed_since(5), set())
+
+    def test_initial_entries(self):
+        log = RevisionLog([(4, 1), (2, 3)])
+        self.assertEquals(log.changed_since(3), set([1]))
+
+    def test_compact(self):
+        for revision in xrange(1, 3000):
+            self.log.stamp(revision, revision % 10)
+        # only the latest stamp of each id is kept
+        self.assert_(len(self.log.entries) < 1100)
+        self.assertEquals(self.log.changed_since(2989), set(range(10)))
+        self.assertEquals(self.log.changed_since(2995), set([6, 7, 8, 9]))
+
+class ShareListingCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = ShareListingCache('abc:1')
+        self.playlists = {1: {'daap.baseplaylist': 1},
+                          2: {'dmap.itemname': 'two'}}
+        self.items = dict((i, {'dmap.itemid': i}) for i in xrange(5))
+        self.cache.save(10, 1, self.playlists, [], self.items, [],
+                        {2: [0, 1]}, {}, full=True)
+
+    def tearDown(self):
+        self.cache.close()
+        MiroTestCase.tearDown(self)
+
+    def reload(self):
+        self.cache.close()
+        self.cache = ShareListingCache('abc:1')
+        return self.cache.load()
+
+    def test_load(self):
+        items, members = self.reload()
+        self.assertEquals(items, self.items)
+        self.assertEquals(members, {2: set([0, 1])})
+        self.assertEquals(self.cache.revision, 10)
+        self.assertEquals(self.cache.base_playlist, 1)
+        self.assertEquals(self.cache.playlists, self.playlists)
+        self.assertEquals(self.cache.get_item(3), {'dmap.itemid': 3})
+        self.assertEquals(self.cache.get_item(7), None)
+
+    def test_other_share(self):
+        other = ShareListingCache('abc:2')
+        self.assertEquals(other.load(), None)
+        other.close()
+
+    def test_changes(self):
+        self.cache.save(12, 1, {3: {'dmap.itemname': 'three'}}, [2],
+                        {5: {'dmap.itemid': 5}}, [0],
+                        {3: [5]}, {}, full=False)
+        self.cache.save(13, 1, {}, [], {}, [], {3: [1]}, {3: [5]},
+                        full=False)
+        self.check_changes()
+        items, members = self.reload()
+        self.assertEquals(sorted(items), [1, 2, 3, 4, 5])
+        self.check_changes()
+
+    def check_changes(self):
+        self.assertEquals(self.cache.revision, 13)
+        self.assertEquals(sorted(self.cache.playlists), [1, 3])
+        self.assertEquals(self.cache.item_ids, set([1, 2, 3, 4, 5]))
+        self.assertEquals(self.cache.members, {3: set([1])})
+
+    def test_full_replaces(self):
+        self.cache.save(20, 1, {1: {'daap.baseplaylist': 1}}, [],
+                        {9: {'dmap.itemid': 9}}, [], {}, {}, full=True)
+        items, members = self.reload()
+        self.assertEquals(items, {9: {'dmap.itemid': 9}})
+        self.assertEquals(members, {})
+
+class ShareProberTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.prober = ShareProber()
+        self.probes = []
+        self.results = []
+        self.prober.testconnect = self.fake_testconnect
+
+    def fake_testconnect(self, host, port, timeout):
+        self.probes.append((host, timeout))
+        if host == 'slow' and timeout < ShareProber.MAX_TIMEOUT:
+            time.sleep(timeout)
+            return False
+        return host != 'down'
+
+    def run_probes(self, *hosts):
+        for host in hosts:
+            self.prober.queue.put((host, 3689,
+                                   lambda unused: self.results.append('ok'),
+                                   lambda unused: self.results.append('fail'),
+                                   None))
+        while not self.prober.queue.empty():
+            self.prober.run_probe(*self.prober.queue.get())
+        self.runPendingIdles()
+
+    def test_timeout(self):
+        self.assertEquals(self.prober.get_timeout(),
+                          ShareProber.INITIAL_TIMEOUT)
+        for i in xrange(20):
+            self.prober.record_time(0.01)
+        self.assertEquals(self.prober.get_timeout(), ShareProber.MIN_TIMEOUT)
+        for i in xrange(20):
+            self.prober.record_time(60)
+        self.assertEquals(self.prober.get_timeout(), ShareProber.MAX_TIMEOUT)
+
+    def test_probe(self):
+        self.run_probes('up', 'down')
+        self.assertEquals(self.results, ['ok', 'fail'])
+
+    def test_retry_after_timeout(self):
+        self.prober.MIN_TIMEOUT = self.prober.INITIAL_TIMEOUT = 0.01
+        self.run_probes('slow', 'up')
+        # the slow share goes to the back of the queue
+        self.assertEquals(self.probes, [('slow', 0.01), ('up', 0.01),
+                                        ('slow', ShareProber.MAX_TIMEOUT)])
+        self.assertEquals(self.results, ['ok', 'ok'])
+
+    def test_testconnect_disconnects(self):
+        clients = []
+        class FakeClient(object):
+            def __init__(self, databases):
+                self.databases_result = databases
+                self.disconnected = False
+                clients.append(self)
+            def connect(self):
+                return True
+            def databases(self):
+                if isinstance(self.databases_result, Exception):
+                    raise self.databases_result
+                return self.databases_result
+            def disconnect(self):
+                self.disconnected = True
+        results = [{1: 'db'}, None, ValueError()]
+        self.patch_function('miro.sharing.libdaap.make_daap_client',
+                            lambda host, port, timeout: FakeClient(
+                                results[len(clients)]))
+        testconnect = ShareProber.testconnect
+        self.assert_(testconnect(self.prober, 'up', 3689, 1))
+        self.assert_(not testconnect(self.prober, 'up', 3689, 1))
+        self.assertRaises(ValueError, testconnect, self.prober, 'up', 3689, 1)
+        self.assertEquals([c.disconnected for c in clients],
+                          [True, True, True])
+
+class KnownShareCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = KnownShareCache()
+
+    def tearDown(self):
+        self.cache.close()
+        MiroTestCase.tearDown(self)
+
+    def test_add_remove(self):
+        self.cache.add('one', '10.0.0.1', 3689)
+        self.cache.add('two', '10.0.0.2', 3689)
+        self.cache.add('one renamed', '10.0.0.1', 3689)
+        self.cache.remove('10.0.0.2', 3689)
+        self.cache.close()
+        self.assertEquals(self.cache.load(),
+                          [('one renamed', '10.0.0.1', 3689)])
+
+    def test_expire(self):
+        self.cache.add('one', '10.0.0.1', 3689)
+        self.cache.connection.execute("UPDATE known_share SET verified=?",
+                                      (time.time() - KnownShareCache.TTL - 1,))
+        self.cache.add('two', '10.0.0.2', 3689)
+        self.assertEquals(self.cache.load(), [('two', '10.0.0.2', 3689)])
+
+class FakeItemInfo(object):
+    def __init__(self, id_, **kwargs):
+        self.id = id_
+        self.name = u'Item %d' % id_
+        self.file_format = u'.mp3'
+        self.file_type = u'audio'
+        self.duration = 60
+        self.size = 1000
+        self.artist = u'Artist'
+        self.album_artist = None
+        self.album = u'Album \u00e9'
+        self.year = -1
+        self.genre = u'Genre'
+        self.track = u'3'
+        self.kind = None
+        self.show = None
+        self.season_number = None
+        self.episode_id = None
+        self.episode_number = None
+        self.feed_url = u'dtv:manualFeed'
+        self.feed_id = 1
+        self.is_file_item = False
+        self.video_path = '/media/item%d.mp3' % id_
+        self.thumbnail = None
+        self.__dict__.update(kwargs)
+
+class SharingBackendItemTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.backend = SharingManagerBackend()
+
+    def make_item_dict(self, *infos):
+        with self.backend.item_lock:
+            self.backend.update_revision()
+            self.backend.make_item_dict(infos)
+
+    def test_item_dict(self):
+        self.make_item_dict(FakeItemInfo(1, kind=u'movie'))
+        item = self.backend.daapitems[1]
+        self.assertEquals(item['dmap.itemname'], 'Item 1')
+        self.assertEquals(item['daap.songalbum'], 'Album \xc3\xa9')
+        self.assertEquals(item['daap.songtime'], 60 * sharing.DURATION_SCALE)
+        self.assertEquals(item['daap.songyear'], 0)
+        self.assertEquals(item['daap.songtracknumber'], 3)
+        self.assertEquals(item['daap.songformat'], 'mp3')
+        self.assertEquals(item['org.participatoryculture.miro.itemkind'],
+                          sharing.MIRO_ITEMKIND_MOVIE)
+        self.assertEquals(item['dmap.containeritemid'], 1)
+        self.assert_(item['valid'])
+
+    def test_strings_interned(self):
+        self.make_item_dict(FakeItemInfo(1), FakeItemInfo(2))
+        one, two = self.backend.daapitems[1], self.backend.daapitems[2]
+        self.assert_(one['daap.songartist'] is two['daap.songartist'])
+        self.assert_(one['daap.songalbum'] is two['daap.songalbum'])
+
+    def test_unchanged_info(self):
+        info = FakeItemInfo(1)
+        self.make_item_dict(info)
+        item = self.backend.daapitems[1]
+        self.make_item_dict(info)
+        self.assert_(self.backend.daapitems[1] is item)
+
+    def test_changed_info(self):
+        self.make_item_dict(FakeItemInfo(1))
+        item = self.backend.daapitems[1]
+        self.make_item_dict(FakeItemInfo(1, name=u'New name',
+                                         file_type=u'video'))
+        new_item = self.backend.daapitems[1]
+        self.assertEquals(new_item['dmap.itemname'], 'New name')
+        self.assertEquals(new_item['com.apple.itunes.mediakind'],
+                          sharing.libdaap.DAAP_MEDIAKIND_VIDEO)
+        self.assertEquals(new_item['revision'], item['revision'] + 1)
+        # the old entry is left alone for anybody still using it
+        self.assertEquals(item['dmap.itemname'], 'Item 1')
+        self.assertEquals(item['com.apple.itunes.mediakind'],
+                          sharing.libdaap.DAAP_MEDIAKIND_AUDIO)
+
+    def test_removed_item_forgotten(self):
+        self.make_item_dict(FakeItemInfo(1))
+        self.backend.transcode_counts[1] = 2
+        with self.backend.item_lock:
+            self.backend.update_revision()
+            self.backend.remove_item(1)
+        self.assert_(not self.backend.daapitems[1]['valid'])
+        self.assert_(1 not in self.backend.daapitem_infos)
+        self.assert_(1 not in self.backend.encoded_items)
+        self.assert_(1 not in self.backend.transcode_counts)
@@ -0,0 +1,52 @@
+import itertools
+import random
+
+from miro import syncplanner
+from miro.test.framework import MiroTestCase
+
+class PlanFillTest(MiroTestCase):
+    def plan(self, candidates, capacity, time_limit=1.0):
+        items, size = syncplanner.plan_fill(candidates, capacity, time_limit)
+        self.assertEquals(size, sum(candidates[i][0] for i in items))
+        self.assert_(size <= capacity)
+        return items
+
+    def value(self, candidates, items):
+        return sum(candidates[i][1] for i in items)
+
+    def test_empty(self):
+        self.assertEquals(syncplanner.plan_fill([], 100), ([], 0))
+
+    def test_everything_fits(self):
+        candidates = [(10, 1, 0), (20, 2, 1), (30, 3, 2)]
+        self.assertSameSet(self.plan(candidates, 100), [0, 1, 2])
+
+    def test_skip_unknown(self):
+        # no size, no value, or too big to ever fit
+        candidates = [(0, 1, 0), (10, 0, 1), (200, 5, 2), (10, 1, 3)]
+        self.assertEquals(self.plan(candidates, 100), [3])
+
+    def test_best_single_item(self):
+        # the big item has the lower value per byte, but is worth more than
+        # all the small ones together
+        candidates = [(2, 3, 0), (9, 10, 1), (5, 4, 2)]
+        self.assertEquals(self.plan(candidates, 10), [1])
+
+    def test_swap(self):
+        # greedy picks 3 and 0, swapping 0 for 1 is worth more
+        candidates = [(3, 6, 0), (4, 7, 1), (7, 1, 2), (1, 9, 3)]
+        self.assertSameSet(self.plan(candidates, 7), [1, 3])
+
+    def test_close_to_best(self):
+        r = random.Random(0)
+        for i in xrange(100):
+            candidates = [(r.randint(1, 20), r.randint(1, 20), j)
+                          for j in xrange(8)]
+            capacity = r.randint(5, 60)
+            best = max(sum(c[1] for c in combination)
+                       for count in xrange(len(candidates) + 1)
+                       for combination in itertools.combinations(candidates,
+                                                                 count)
+                       if sum(c[0] for c in combination) <= capacity)
+            value = self.value(candidates, self.plan(candidates, capacity))
+            self.assert_(value * 2 >= best)
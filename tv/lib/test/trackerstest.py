@@ -0,0 +1,91 @@
+import binascii
+
+import libtorrent as lt
+
+from miro import httpclient
+from miro.test.framework import MiroTestCase
+from miro.dl_daemon.trackers import (scrape_url, build_scrape_request,
+                                     parse_scrape_response, TrackerCache)
+
+HASH1 = '01' * 20
+HASH2 = 'ab' * 20
+
+class ScrapeURLTest(MiroTestCase):
+    def test_scrape_url(self):
+        self.assertEquals(scrape_url('http://example.com/announce'),
+                          'http://example.com/scrape')
+        self.assertEquals(scrape_url('http://example.com/x/announce.php'),
+                          'http://example.com/x/scrape.php')
+        self.assertEquals(scrape_url('http://example.com/announce?key=1'),
+                          'http://example.com/scrape?key=1')
+        self.assertEquals(scrape_url('http://example.com/a'), None)
+        self.assertEquals(scrape_url('udp://example.com:80/announce'), None)
+
+    def test_build_request(self):
+        url = build_scrape_request('http://example.com/scrape',
+                                   [HASH1, HASH2])
+        self.assertEquals(url, 'http://example.com/scrape?'
+                          'info_hash=%01%01%01%01%01%01%01%01%01%01'
+                          '%01%01%01%01%01%01%01%01%01%01&'
+                          'info_hash=%AB%AB%AB%AB%AB%AB%AB%AB%AB%AB'
+                          '%AB%AB%AB%AB%AB%AB%AB%AB%AB%AB')
+
+    def test_parse_response(self):
+        body = lt.bencode({'files': {
+            binascii.unhexlify(HASH1): {'complete': 5, 'incomplete': 3,
+                                        'downloaded': 10},
+            binascii.unhexlify(HASH2): {'complete': 1},
+        }})
+        self.assertEquals(parse_scrape_response(body), {HASH1: (5, 3)})
+        self.assertEquals(parse_scrape_response('garbage'), {})
+
+class TrackerCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = TrackerCache()
+
+    def tearDown(self):
+        self.cache.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def test_trackers_shared(self):
+        self.cache.add_torrent(HASH1, ['http://example.com/announce',
+                                       'udp://example.com/announce'])
+        self.cache.add_torrent(HASH2, ['http://example.com/announce'])
+        self.assertEquals(self.cache.trackers,
+                          {'http://example.com/scrape': set([HASH1, HASH2])})
+        self.cache.remove_torrent(HASH1)
+        self.cache.remove_torrent(HASH2)
+        self.assertEquals(self.cache.trackers, {})
+
+    def test_counts_saved(self):
+        self.cache.add_torrent(HASH1, ['http://example.com/announce'])
+        self.assertEquals(self.cache.get_counts(HASH1), None)
+        self.cache.update_counts(HASH1, 10, 2)
+        self.assertEquals(self.cache.get_counts(HASH1), (10, 2))
+        self.cache.shutdown()
+        new_cache = TrackerCache()
+        new_cache.startup()
+        try:
+            self.assertEquals(new_cache.get_counts(HASH1), (10, 2))
+        finally:
+            new_cache.shutdown()
+
+    def test_address_forgotten_on_connection_error(self):
+        transfers = []
+        class FakeTransfer(object):
+            def __init__(self, options, callback, errback):
+                transfers.append((options, callback, errback))
+            def start(self):
+                pass
+        self.patch_function('miro.httpclient.CurlTransfer', FakeTransfer)
+        self.cache.add_torrent(HASH1, ['http://example.com/announce'])
+        self.cache.addresses['example.com'] = ('10.0.0.1', 0)
+        self.cache.request_scrape(HASH1)
+        self.cache._do_scrapes()
+        self.assertEquals(len(transfers), 1)
+        options, callback, errback = transfers[0]
+        self.assertEquals(options.resolve_address, '10.0.0.1')
+        errback(httpclient.ConnectionError('example.com'))
+        self.assert_('example.com' not in self.cache.addresses)
+        self.assertEquals(self.cache.scraping, set())
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+
+from miro import transcode
+from miro.test.framework import MiroTestCase
+
+class SegmentCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.directory = os.path.join(self.make_temp_dir_path(), 'cache')
+        self.cache = transcode.SegmentCache(self.directory, max_size=250)
+        self.media_file = self.make_temp_path('.avi')
+        self.key = self.cache.make_key(self.media_file, ('params',))
+
+    def add(self, index, data, cache=None):
+        cache = cache or self.cache
+        fileobj, path = cache.new_segment()
+        fileobj.write(data)
+        return cache.add_segment(self.key, index, fileobj, path)
+
+    def test_add_get(self):
+        self.assertEquals(self.add(0, 'abc').read(), 'abc')
+        self.assert_(self.cache.has_segment(self.key, 0))
+        self.assert_(not self.cache.has_segment(self.key, 1))
+        self.assertEquals(self.cache.get_segment(self.key, 0).read(), 'abc')
+        self.assertEquals(self.cache.get_segment(self.key, 1), None)
+
+    def test_key(self):
+        self.assertNotEquals(self.key,
+                             self.cache.make_key(self.media_file, ('other',)))
+        f = open(self.media_file, 'wb')
+        f.write('changed')
+        f.close()
+        self.assertNotEquals(self.key,
+                             self.cache.make_key(self.media_file, ('params',)))
+        self.assertEquals(self.cache.make_key(self.media_file + 'x', ()),
+                          None)
+
+    def test_evict_lru(self):
+        self.add(0, 'x' * 100)
+        self.add(1, 'x' * 100)
+        # 0 was used last, so 1 goes first
+        self.cache.get_segment(self.key, 0).close()
+        self.add(2, 'x' * 100)
+        self.assert_(self.cache.has_segment(self.key, 0))
+        self.assert_(not self.cache.has_segment(self.key, 1))
+        self.assert_(self.cache.has_segment(self.key, 2))
+        self.assertEquals(self.cache.size, 200)
+        self.assertEquals(len(os.listdir(self.directory)), 2)
+
+    def test_rescan(self):
+        self.add(0, 'abc')
+        unfinished, path = self.cache.new_segment()
+        unfinished.close()
+        cache = transcode.SegmentCache(self.directory, max_size=250)
+        self.assertEquals(cache.get_segment(self.key, 0).read(), 'abc')
+        self.assertEquals(cache.size, 3)
+        self.assert_(not os.path.exists(path))
+
+class TranscodeObjectTest(MiroTestCase):
+    # (duration, has_audio, acodec, sample rate, has_video, vcodec, size)
+    media_info = (35, True, 'aac', 44100, True, 'h264', '640x480')
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = transcode.SegmentCache(self.make_temp_dir_path())
+        self.media_file = self.make_temp_path('.avi')
+        self.objects = []
+
+    def tearDown(self):
+        for obj in self.objects:
+            # No transcode was started, let shutdown() through.
+            obj.transcode_gate.set()
+            obj.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def make_object(self, chunk=None):
+        obj = transcode.TranscodeObject(self.media_file, 1, 0, chunk,
+                                        self.media_info,
+                                        lambda itemid, ext: 'daap://x/',
+                                        self.cache)
+        self.objects.append(obj)
+        return obj
+
+    def send_chunk(self, obj, data):
+        obj.data_callback(data)
+        obj.data_callback('')
+
+    def test_chunks(self):
+        obj = self.make_object()
+        self.assertEquals(obj.nchunks, 4)
+        self.send_chunk(obj, 'zero')
+        self.send_chunk(obj, 'one')
+        self.assert_(not obj.isseek(0))
+        self.assert_(not obj.isseek(2))
+        self.assert_(obj.isseek(3))
+        self.assertEquals(obj.get_chunk(0).read(), 'zero')
+        self.assertEquals(obj.get_chunk().read(), 'one')
+        obj.data_callback('')
+        self.assertEquals(obj.get_chunk(2).read(), '')
+
+    def test_skip(self):
+        obj = self.make_object()
+        for data in ('zero', 'one', 'two'):
+            self.send_chunk(obj, data)
+        self.assertEquals(obj.get_chunk(2).read(), 'two')
+        self.assertEquals(len(obj.chunk_buffer), 0)
+
+    def test_throttle(self):
+        obj = self.make_object()
+        for i in xrange(obj.buffer_high_watermark):
+            self.send_chunk(obj, str(i))
+        self.assert_(not obj.chunk_throttle.is_set())
+        obj.get_chunk(0)
+        self.assert_(obj.chunk_throttle.is_set())
+
+    def test_reuse(self):
+        obj = self.make_object()
+        self.send_chunk(obj, 'zero')
+        self.send_chunk(obj, 'one')
+        # Another session seeking into what we already have doesn't need
+        # a new transcode.
+        other = self.make_object(chunk=1)
+        self.assert_(not other.isseek(0))
+        self.assertEquals(other.get_chunk(1).read(), 'one')
+        self.assertEquals(other.get_chunk(0).read(), 'zero')
+
+    def test_all_cached(self):
+        obj = self.make_object()
+        for i in xrange(4):
+            self.send_chunk(obj, str(i))
+        other = self.make_object(chunk=2)
+        # Nothing to do: no ffmpeg is started.
+        self.assert_(other.transcode())
+        self.assertEquals(other.ffmpeg_handle, None)
+        self.assertEquals(other.get_chunk(3).read(), '3')
+
+    def test_refused(self):
+        manager = transcode.TranscodeManager(cpu_count=1)
+        manager.get_load = lambda: 0.0
+        manager.acquire(FakeJob())
+        obj = self.make_object()
+        obj.manager = manager
+        # No room: transcode() returns straight away.
+        self.assert_(not obj.transcode())
+        self.assert_(obj.refused)
+        self.assertEquals(obj.get_chunk(0).read(), '')
+
+class FakeJob(object):
+    in_shutdown = False
+
+class TranscodeManagerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = transcode.TranscodeManager(cpu_count=2)
+        self.manager.get_load = lambda: 0.0
+        self.manager.POLL_INTERVAL = 0.01
+        self.admitted = []
+
+    def start(self, job, **kwargs):
+        def run():
+            if self.manager.acquire(job, **kwargs):
+                self.admitted.append(job)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def wait_for(self, condition):
+        for i in xrange(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('timed out')
+
+    def test_capacity(self):
+        jobs = [FakeJob() for i in xrange(3)]
+        for job in jobs[:2]:
+            self.assert_(self.manager.acquire(job))
+        # Clients don't wait for a slot, they are refused.
+        self.assert_(not self.manager.acquire(jobs[2]))
+        self.assertEquals(self.manager.get_stats()['refused'], 1)
+        self.manager.release(jobs[0])
+        self.assert_(self.manager.acquire(jobs[2]))
+
+    def test_load(self):
+        # Someone else is keeping a core busy.
+        self.manager.get_load = lambda: 1.0
+        self.assertEquals(self.manager.capacity(), 1.0)
+        # Our own jobs don't count as load.
+        self.assert_(self.manager.acquire(FakeJob()))
+        self.assertEquals(self.manager.capacity(), 2.0)
+        self.manager.get_load = lambda: 2.0
+        self.assertEquals(self.manager.capacity(), 1.0)
+        # There's always room for one.
+        self.manager.get_load = lambda: 5.0
+        self.assertEquals(self.manager.capacity(), 1.0)
+
+    def test_copy_fits(self):
+        running = [FakeJob(), FakeJob()]
+        self.manager.acquire(running[0])
+        self.manager.acquire(running[1], copy_only=True)
+        # Remuxes are cheap, so there's room for another remux but not for
+        # another transcode.
+        self.assert_(not self.manager.acquire(FakeJob()))
+        self.assert_(self.manager.acquire(FakeJob(), copy_only=True))
+
+    def test_background_waits(self):
+        self.manager.cpu_count = 1
+        running = FakeJob()
+        self.manager.acquire(running)
+        background = FakeJob()
+        thread = self.start(background, background=True)
+        self.wait_for(lambda: len(self.manager.waiting) == 1)
+        self.manager.release(running)
+        thread.join()
+        self.assertEquals(self.admitted, [background])
+
+    def test_background_after_refused_client(self):
+        self.manager.cpu_count = 1
+        running = FakeJob()
+        self.manager.acquire(running)
+        background, client = FakeJob(), FakeJob()
+        thread = self.start(background, background=True)
+        self.wait_for(lambda: len(self.manager.waiting) == 1)
+        self.assert_(not self.manager.acquire(client))
+        self.manager.release(running)
+        # The slot is kept for the client's retry.
+        time.sleep(0.05)
+        self.assertEquals(self.admitted, [])
+        self.assert_(self.manager.acquire(client))
+        self.manager.release(client)
+        self.manager.clients_waiting_until = 0
+        thread.join()
+        self.assertEquals(self.admitted, [background])
+
+    def test_cancel(self):
+        self.manager.acquire(FakeJob())
+        self.manager.acquire(FakeJob())
+        job = FakeJob()
+        thread = self.start(job, background=True)
+        self.wait_for(lambda: self.manager.waiting)
+        job.in_shutdown = True
+        self.manager.cancel(job)
+        thread.join()
+        self.assertEquals(self.admitted, [])
+        stats = self.manager.get_stats()
+        self.assertEquals(stats['cancelled'], 1)
+        self.assertEquals(stats['waiting'], 0)
+
+    def test_stats(self):
+        job = FakeJob()
+        self.manager.acquire(job)
+        time.sleep(0.05)
+        self.manager.release(job, media_seconds=30)
+        stats = self.manager.get_stats()
+        self.assertEquals(stats['admitted'], 1)
+        self.assertEquals(stats['running'], 0)
+        self.assert_(stats['mean_queue_time'] < 0.05)
+        self.assert_(0 < stats['realtime_factor'] <= 600)
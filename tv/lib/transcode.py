@@ -27,6 +27,7 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import collections
 import errno
 import logging
 import subprocess
@@ -39,12 +40,18 @@ import subprocess
 import sys
 import SocketServer
 import threading
+import time
 
+from hashlib import md5
+
+from miro import fileutil
+from miro import mediainfocache
 from miro import util
 from miro.plat.utils import (get_ffmpeg_executable_path, setup_ffmpeg_presets,
                              get_segmenter_executable_path, thread_body,
                              get_transcode_video_options,
-                             get_transcode_audio_options)
+                             get_transcode_audio_options,
+                             get_logical_cpu_count)
 from miro.plat.popen import Popen
 
 # Transcoding
@@ -69,17 +76,161 @@ has_video_regex = re.compile('Video: \w+( \(hq\))*(, \w+)*(, \d+x\d+)*')
 has_audio_regex = re.compile('Audio: \w+(, \d+ Hz)*')
 
 class TranscodeManager(object):
-    MAX_TRANSCODE_PIPELINES = 5
-    def __init__(self):
-        self.ffmpeg_event = threading.Event()
-        self.ffmpeg_event.set()
+    """TranscodeManager
+
+    Decides when transcode jobs get to run, so that several clients
+    streaming at once neither serialize nor swamp the CPU.
+
+    A job costs one slot, or a fraction of one if it only remuxes (copies
+    the streams into mpegts), and the number of slots is the number of
+    cores less the load that isn't ours.  Jobs for clients run on the DAAP
+    server's worker threads, so they never wait for a slot: they get one
+    straight away or are refused, and the client is told to try again in
+    RETRY_AFTER seconds.  Background jobs wait their turn, in order, and
+    stay out of the way for a while after a client has been refused so the
+    client gets the slot when it asks again.
+    """
+    # Seconds a refused client is told to wait before asking again.
+    RETRY_AFTER = 2
+    # Slots taken by a job which doesn't need to transcode.
+    COPY_COST = 0.25
+    # How often waiting jobs check the load again, in seconds.
+    POLL_INTERVAL = 1
+
+    def __init__(self, cpu_count=None):
+        if cpu_count is None:
+            cpu_count = get_logical_cpu_count()
+        self.cpu_count = cpu_count
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.waiting = []       # background jobs, in order
+        self.submitted = dict() # waiting job -> time it was submitted
+        self.running = dict()   # job -> (cost, time it was admitted)
+        # Background jobs don't start before this, see acquire().
+        self.clients_waiting_until = 0
+        self.stats = dict(admitted=0, refused=0, cancelled=0,
+                          queue_time=0.0, transcoded=0.0, transcode_time=0.0)
+
+    def get_load(self):
+        try:
+            return os.getloadavg()[0]
+        except (AttributeError, OSError):
+            # Not available (Windows).
+            return 0.0
+
+    # At this point: lock acquired
+    def capacity(self):
+        # The load average counts our own jobs too, don't hold those against
+        # ourselves.
+        ours = sum(cost for cost, admitted in self.running.itervalues())
+        others = max(0.0, self.get_load() - ours)
+        return max(1.0, self.cpu_count - others)
+
+    # At this point: lock acquired
+    def drop_waiting(self):
+        # Drop jobs which have been shut down.
+        keep = []
+        for job in self.waiting:
+            if job.in_shutdown:
+                self.stats['cancelled'] += 1
+                del self.submitted[job]
+            else:
+                keep.append(job)
+        if len(keep) != len(self.waiting):
+            self.waiting = keep
+            self.cond.notify_all()
 
-    def acquire(self):
-        self.ffmpeg_event.wait()
-        self.ffmpeg_event.clear()
+    # At this point: lock acquired
+    def admit(self, job, cost, submitted):
+        now = time.time()
+        self.running[job] = (cost, now)
+        self.stats['admitted'] += 1
+        self.stats['queue_time'] += now - submitted
 
-    def release(self):
-        self.ffmpeg_event.set()
+    def acquire(self, job, copy_only=False, background=False):
+        """Get a slot for job.  Returns False if the job was refused, or
+        shut down while waiting.
+
+        Jobs for clients never wait.  Background jobs wait until there's a
+        slot for them.
+
+        job is a TranscodeObject, or anything else with an in_shutdown flag
+        that calls cancel() after setting it.
+        """
+        now = time.time()
+        cost = self.COPY_COST if copy_only else 1.0
+        with self.lock:
+            if job.in_shutdown:
+                return False
+            if not background:
+                if self.fits(cost):
+                    self.admit(job, cost, now)
+                    return True
+                self.stats['refused'] += 1
+                self.clients_waiting_until = max(self.clients_waiting_until,
+                                                 now + 2 * self.RETRY_AFTER)
+                return False
+            self.waiting.append(job)
+            self.submitted[job] = now
+            while True:
+                self.drop_waiting()
+                if job not in self.submitted:
+                    return False
+                if (self.waiting[0] is job and self.fits(cost) and
+                        time.time() >= self.clients_waiting_until):
+                    self.waiting.pop(0)
+                    self.admit(job, cost, self.submitted.pop(job))
+                    # The next one may fit too.
+                    self.cond.notify_all()
+                    return True
+                self.cond.wait(self.POLL_INTERVAL)
+
+    # At this point: lock acquired
+    def fits(self, cost):
+        if not self.running:
+            return True
+        used = sum(c for c, admitted in self.running.itervalues())
+        return used + cost <= self.capacity()
+
+    def release(self, job, media_seconds=0):
+        """Called when job stops running, with how much of the media it got
+        through.  Jobs that are not running are ignored.
+        """
+        with self.lock:
+            try:
+                cost, admitted = self.running.pop(job)
+            except KeyError:
+                return
+            self.stats['transcoded'] += media_seconds
+            self.stats['transcode_time'] += time.time() - admitted
+            self.cond.notify_all()
+        logging.debug('transcode manager: %s', self.get_stats())
+
+    def cancel(self, job):
+        """Call after setting job.in_shutdown, so that acquire() stops
+        waiting for it.
+        """
+        with self.lock:
+            self.cond.notify_all()
+
+    def get_stats(self):
+        """Return a dict of statistics: the number of jobs running, waiting,
+        admitted, refused and cancelled, the mean time admitted jobs spent
+        waiting and the realtime factor (seconds of media per second of
+        transcoding) of the finished ones.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['running'] = len(self.running)
+            stats['waiting'] = len(self.waiting)
+        admitted = stats['admitted']
+        stats['mean_queue_time'] = (stats.pop('queue_time') / admitted
+                                    if admitted else 0.0)
+        transcode_time = stats.pop('transcode_time')
+        transcoded = stats.pop('transcoded')
+        stats['realtime_factor'] = (transcoded / transcode_time
+                                    if transcode_time else 0.0)
+        return stats
 
 # What is -vbsf?  See:
 # http://www.shortword.net/blog/2009/12/18/converting-h-264-mpeg4-to-ts-with-ffmpeg/
@@ -163,17 +314,8 @@ def needs_transcode(media_file):
     unreliable (does not exist).
 
     May throw exception if ffmpeg not found.  Remember to catch."""
-    ffmpeg_exe = get_ffmpeg_executable_path()
-    kwargs = {"stdout": subprocess.PIPE,
-              "stderr": subprocess.PIPE,
-              "stdin": subprocess.PIPE,
-              "close_fds": True}
-    args = [ffmpeg_exe, "-i", media_file]
-    handle = Popen(args, **kwargs)
-    # XXX unbounded read here but should be okay, ffmpeg output is finite.
-    # note that we need to read from stderr, since that's what ffmpeg spits 
-    # out.
-    text = handle.stderr.read()
+    # Usually cached: this gets called again each time a client seeks.
+    text = mediainfocache.get_ffmpeg_output(media_file)
     # Initial determination based on the file type - need to drill down
     # to see if the resolution, etc are within parameters.
     if container_regex.search(text):
@@ -210,6 +352,175 @@ def needs_transcode(media_file):
     return (transcode, (seconds, has_audio, acodec, sample_rate,
                         has_video, vcodec, size))
 
+# Default size limit of the SegmentCache, in bytes.
+SEGMENT_CACHE_SIZE = 1024 * 1024 * 1024
+
+class SegmentCache(object):
+    """SegmentCache
+
+    Transcoded segments kept on disk, so that a seek, another session or
+    another client playing the same item doesn't have to transcode it again.
+
+    Segments are stored under a key made from the media file (path, size
+    and mtime) and the transcode parameters, plus the segment index.  When
+    the cache grows over max_size bytes, the least recently used segments
+    are removed.  File mtimes record when a segment was last used, so the
+    order survives restarts.
+    """
+    def __init__(self, directory, max_size=SEGMENT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = dict()    # filename -> [size, last used]
+        self.size = 0
+        self.clock = 0
+        self.scanned = False
+
+    def _ensure_scanned(self):
+        if self.scanned:
+            return
+        self.scanned = True
+        try:
+            if not os.path.exists(self.directory):
+                fileutil.makedirs(self.directory)
+            names = os.listdir(self.directory)
+        except OSError:
+            logging.exception('segment cache: cannot read %s',
+                              self.directory)
+            return
+        found = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.part'):
+                    # Left over from a transcode we didn't finish.
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+            except OSError:
+                continue
+            found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        for mtime, name, size in found:
+            self.clock += 1
+            self.entries[name] = [size, self.clock]
+            self.size += size
+        self._evict()
+
+    def make_key(self, media_file, params):
+        """Return the key for the segments of media_file transcoded with
+        params, or None if the file can't be looked at.
+        """
+        try:
+            st = os.stat(media_file)
+        except OSError:
+            return None
+        return md5(repr((media_file, st.st_size, st.st_mtime,
+                         params))).hexdigest()
+
+    def _filename(self, key, index):
+        return '%s-%d.ts' % (key, index)
+
+    def has_segment(self, key, index):
+        with self.lock:
+            self._ensure_scanned()
+            return self._filename(key, index) in self.entries
+
+    def get_segment(self, key, index):
+        """Open a cached segment for reading.  Returns None if it isn't
+        cached.
+        """
+        name = self._filename(key, index)
+        with self.lock:
+            self._ensure_scanned()
+            try:
+                entry = self.entries[name]
+            except KeyError:
+                return None
+            self.clock += 1
+            entry[1] = self.clock
+        path = os.path.join(self.directory, name)
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            with self.lock:
+                self._forget(name)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return fileobj
+
+    def new_segment(self):
+        """Create a file for a segment as it's being transcoded.  Returns
+        the open file and its path, which is given to add_segment() or
+        discard_segment() once done.
+        """
+        with self.lock:
+            self._ensure_scanned()
+        fd, path = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        return os.fdopen(fd, 'w+b'), path
+
+    def add_segment(self, key, index, fileobj, path):
+        """Move a finished segment into the cache.  fileobj is closed, and
+        the segment reopened for reading is returned.
+        """
+        fileobj.close()
+        name = self._filename(key, index)
+        final_path = os.path.join(self.directory, name)
+        try:
+            size = os.path.getsize(path)
+            if os.path.exists(final_path):
+                # Can't rename over an existing file on Windows.
+                os.remove(final_path)
+            os.rename(path, final_path)
+        except OSError:
+            logging.exception('segment cache: cannot add %s', name)
+            self.discard_segment(path)
+            return None
+        with self.lock:
+            self._forget(name)
+            self.clock += 1
+            self.entries[name] = [size, self.clock]
+            self.size += size
+            self._evict()
+        try:
+            return open(final_path, 'rb')
+        except IOError:
+            return None
+
+    def discard_segment(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # At this point: lock acquired
+    def _forget(self, name):
+        try:
+            size, last_used = self.entries.pop(name)
+        except KeyError:
+            return
+        self.size -= size
+
+    # At this point: lock acquired
+    def _evict(self):
+        if self.size <= self.max_size:
+            return
+        by_age = sorted(self.entries.iteritems(), key=lambda e: e[1][1])
+        for name, (size, last_used) in by_age:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    # Probably open for streaming on Windows.  Try again
+                    # next time.
+                    continue
+            self._forget(name)
+
 class TranscodeSinkServer(SocketServer.TCPServer):
     pass
 
@@ -259,13 +570,16 @@ class TranscodeRequestHandler(SocketServer.BaseRequestHandler):
 # the signaling.  This mainly allows for two things: (1) to allow the segmenter
 # signal when data is ready, and (2) for throttling.  One advantage of this
 # scheme is there is no need to deal with temporary files on the filesystem.
-# Once a chunk is sent to the client, it is thrown away.
+# Once a chunk is sent to the client, it is thrown away, unless there is a
+# SegmentCache: then chunks are written into the cache, and sent from there
+# to anyone who asks for them again.
 #
 # When a client seeks to a position that is not in its current playing chunk
 # and does not have the seeked-to chunk in its cache, it may request
 # the chunk from the server.  In this case, the current transcode operation
 # stops, and a new transcode operation begins at the requested time offset
-# calculated based on which chunk was requested.
+# calculated based on which chunk was requested.  Chunks that are already
+# in the cache are skipped, the new job starts at the first one that isn't.
 class TranscodeObject(object):
     """TranscodeObject
 
@@ -292,13 +606,11 @@ class TranscodeObject(object):
     buffer_high_watermark = 6
 
     def __init__(self, media_file, itemid, generation, chunk, media_info,
-                 request_path_func):
+                 request_path_func, cache=None, manager=None):
         self.media_file = media_file
         self.in_shutdown = False
-        if chunk is not None:
-            self.time_offset = chunk * TranscodeObject.segment_duration
-        else:
-            self.time_offset = 0
+        self.time_offset = 0
+        self.media_info = media_info
         d, a, acodec, rate, v, vcodec, siz = media_info
         self.generation = generation
         self.duration = d
@@ -309,6 +621,19 @@ class TranscodeObject(object):
         self.has_video = v
         self.video_codec = vcodec
         self.video_size = siz
+        self.copy_only = False
+        try:
+            self.codec_args = self.get_codec_args()
+        except ValueError:
+            self.codec_args = None
+        self.cache = cache
+        self.cache_key = None
+        self.manager = manager
+        # Set if the manager had no slot for us, see transcode().
+        self.refused = False
+        if cache and self.codec_args is not None:
+            params = (TranscodeObject.segment_duration, self.codec_args)
+            self.cache_key = cache.make_key(media_file, params)
         # This setting makes the environment global to the app instead of
         # the subtask.  But I guess that's okay.
         setup_ffmpeg_presets()
@@ -333,15 +658,20 @@ class TranscodeObject(object):
         logging.debug('TRANSCODE INFO, trailer %s' % self.trailer)
 
         if chunk is not None:
-            self.current_chunk = self.start_chunk = chunk
+            self.start_chunk = chunk
         else:
-            self.current_chunk = self.start_chunk = 0
-        self.chunk_buffer = []
+            self.start_chunk = 0
+        # Index of the chunk the transcode job is producing.
+        self.next_chunk = self.start_chunk
+        # Where the transcode job started, past any chunks already cached.
+        self.first_chunk = self.start_chunk
+        # Transcoded chunks waiting to be sent, in order: (index, file)
+        self.chunk_buffer = collections.deque()
         self.chunk_throttle = threading.Event()
         self.chunk_throttle.set()
         self.chunk_lock = threading.Lock()
-        self.chunk_sem = threading.Semaphore(0)
-        self.tmp_file = tempfile.TemporaryFile()
+        self.chunk_ready = threading.Condition(self.chunk_lock)
+        self.tmp_file, self.tmp_path = self.new_chunk_file()
         self.finished = False
 
         self.transcode_gate = threading.Event()
@@ -385,14 +715,78 @@ class TranscodeObject(object):
         return tmpf
 
     def isseek(self, chunk):
-        # Is it requesting the next available chunk in the sequence?
-        if self.current_chunk == chunk:
+        # Can we answer from the cache, or with a chunk that is in the
+        # buffer or being transcoded right now?
+        if self.has_cached_chunk(chunk):
             return False
-        return True
+        with self.chunk_lock:
+            if self.chunk_buffer:
+                lowest = self.chunk_buffer[0][0]
+            else:
+                lowest = self.next_chunk
+            return not lowest <= chunk <= self.next_chunk
+
+    def has_cached_chunk(self, chunk):
+        return (self.cache_key is not None and
+                self.cache.has_segment(self.cache_key, chunk))
+
+    def get_codec_args(self):
+        # Also sets copy_only: whether the streams only need to be copied
+        # into mpegts, which is much cheaper than transcoding them.
+        args = []
+        copy_only = True
+        if self.has_video:
+            logging.debug('Video codec: %s', self.video_codec)
+            logging.debug('Video size: %s', self.video_size)
+            if video_can_copy(self.video_codec, self.video_size):
+                args += get_transcode_video_copy_options()
+            else:
+                args += get_transcode_video_options()
+                copy_only = False
+        if self.has_audio:
+            logging.debug('Audio codec: %s', self.audio_codec)
+            logging.debug('Audio sample rate: %s', self.audio_sample_rate)
+            if (valid_av_combo(self.video_codec, self.audio_codec) and
+              audio_can_copy(self.audio_codec, self.audio_sample_rate)):
+                args += get_transcode_audio_copy_options()
+            else:
+                args += get_transcode_audio_options()
+                copy_only = False
+        else:
+           raise ValueError('no video or audio stream present')
+        self.copy_only = copy_only
+        return args
 
-    def transcode(self):
+    def transcode(self, background=False):
+        """Start the transcode job, once the manager lets us.  background
+        jobs wait for everything else, other jobs set refused and return
+        False straight away if there's no room for them.
+        """
         rc = True
+        # Start at the first chunk we don't have yet.
+        chunk = self.start_chunk
+        while chunk < self.nchunks and self.has_cached_chunk(chunk):
+            chunk += 1
+        with self.chunk_lock:
+            self.next_chunk = chunk
+            if chunk >= self.nchunks and self.start_chunk < self.nchunks:
+                logging.debug('transcode: all chunks cached')
+                self.finished = True
+        if self.finished:
+            self.transcode_gate.set()
+            return rc
+        self.first_chunk = chunk
+        self.time_offset = chunk * TranscodeObject.segment_duration
+        if self.manager and not self.manager.acquire(self, self.copy_only,
+                                                     background):
+            logging.debug('transcode: job refused before it started')
+            self.refused = not self.in_shutdown
+            self.end_transcode()
+            self.transcode_gate.set()
+            return False
         try:
+            if self.codec_args is None:
+               raise ValueError('no video or audio stream present')
             ffmpeg_exe = get_ffmpeg_executable_path()
             kwargs = {"stdin": open(os.devnull, 'rb'),
                       "stdout": subprocess.PIPE,
@@ -403,26 +797,7 @@ class TranscodeObject(object):
                 logging.debug('transcode: start job @ %d' % self.time_offset)
                 args += TranscodeObject.time_offset_args + [
                     str(self.time_offset)]
-            video_needs_trancode = False
-            if self.has_video:
-                logging.debug('Video codec: %s', self.video_codec)
-                logging.debug('Video size: %s', self.video_size)
-                if video_can_copy(self.video_codec, self.video_size):
-                    args += get_transcode_video_copy_options()
-                else:
-                    args += get_transcode_video_options()
-                    video_needs_transcode = True
-            if self.has_audio:
-                logging.debug('Audio codec: %s', self.audio_codec)
-                logging.debug('Audio sample rate: %s', self.audio_sample_rate)
-                if (valid_av_combo(self.video_codec, self.audio_codec) and
-                  audio_can_copy(self.audio_codec, self.audio_sample_rate)):
-                    args += get_transcode_audio_copy_options()
-                else:
-                    args += get_transcode_audio_options()
-            else:
-               raise ValueError('no video or audio stream present')
-
+            args += self.codec_args
             args += TranscodeObject.output_args
             logging.debug('Running command %s' % ' '.join(args))
             self.ffmpeg_handle = Popen(args, **kwargs)
@@ -449,36 +824,69 @@ class TranscodeObject(object):
         except StandardError:
             (typ, value, tb) = sys.exc_info()
             logging.error('ERROR: %s %s' % (str(typ), str(value)))
+            self.end_transcode()
             rc = False
         self.transcode_gate.set()
         return rc
 
+    def end_transcode(self):
+        # No more chunks are coming: give up our slot, and wake up the
+        # consumer, it may be waiting for a chunk that isn't going to come.
+        if self.manager:
+            produced = self.next_chunk - self.first_chunk
+            self.manager.release(self,
+                                 produced * TranscodeObject.segment_duration)
+        with self.chunk_lock:
+            self.finished = True
+            self.chunk_ready.notify_all()
+
+    def new_chunk_file(self):
+        # Returns the file to write the next chunk to, and its path if it is
+        # going into the cache.
+        if self.cache_key is not None:
+            try:
+                return self.cache.new_segment()
+            except (IOError, OSError):
+                logging.exception('transcode: cannot create cache file')
+        return tempfile.TemporaryFile(), None
+
+    def finish_chunk_file(self, index):
+        # Returns the finished chunk, ready for reading.
+        if self.tmp_path is None:
+            self.tmp_file.seek(0, os.SEEK_SET)
+            return self.tmp_file
+        return self.cache.add_segment(self.cache_key, index, self.tmp_file,
+                                      self.tmp_path)
+
+    def discard_chunk_file(self):
+        self.tmp_file.close()
+        if self.tmp_path is not None:
+            self.cache.discard_segment(self.tmp_path)
+            self.tmp_path = None
+
     def data_callback(self, d):
         self.tmp_file.write(d)
         if not d:
             self.tmp_file.flush()
-            with self.chunk_lock:
-                # This is empty ... we haven't actually written anything.
-                # This an end of transcode marker.
-                if not self.tmp_file.tell():
-                    logging.debug('Transcode: end-of-transcode marker')
-                    self.finished = True
-                else:
-                    self.tmp_file.seek(0, os.SEEK_SET)
-                    self.chunk_buffer.append(self.tmp_file)
-                    chunk_buffer_size = len(self.chunk_buffer)
-                    if (chunk_buffer_size >= 
-                      TranscodeObject.buffer_high_watermark):
+            # This is empty ... we haven't actually written anything.
+            # This an end of transcode marker.
+            if not self.tmp_file.tell():
+                logging.debug('Transcode: end-of-transcode marker')
+                self.discard_chunk_file()
+                self.end_transcode()
+            else:
+                fileobj = self.finish_chunk_file(self.next_chunk)
+                with self.chunk_lock:
+                    if fileobj is not None:
+                        self.chunk_buffer.append((self.next_chunk, fileobj))
+                    self.next_chunk += 1
+                    if len(self.chunk_buffer) >= self.buffer_high_watermark:
                         logging.debug('TranscodeObject: throttling')
                         self.chunk_throttle.clear()
-
-            # Tell consumer there is stuff available.  We do this for the
-            # end of transcode marker too.  Why?  Because it may be stuck in
-            # the chunk_sem acquiring state.  This will kick start it.
-            self.chunk_sem.release()
+                    # Tell consumer there is stuff available.
+                    self.chunk_ready.notify_all()
             # ready for next segment
-            self.tmp_file = tempfile.TemporaryFile()
-           
+            self.tmp_file, self.tmp_path = self.new_chunk_file()
 
     # Data consumer from segmenter.  Here, we listen for incoming request.
     # no need to handle quit signal - the sink should return a zero read
@@ -503,29 +911,67 @@ class TranscodeObject(object):
             except StandardError:
                 raise
 
-    def get_chunk(self):
-        # End of transcode check: if the transcode returned not enough
-        # chunks, then send an empty file.
+    def get_chunk(self, chunk=None):
+        """Return the file for a chunk, waiting for it to be transcoded if
+        needed.  If chunk is None, the next one in the sequence is returned.
+        """
+        if chunk is not None and self.cache_key is not None:
+            tmpf = self.cache.get_segment(self.cache_key, chunk)
+            if tmpf is not None:
+                with self.chunk_lock:
+                    self.drop_chunks(chunk + 1)
+                return tmpf
         with self.chunk_lock:
-            if self.finished and not self.chunk_buffer:
-                return tempfile.TemporaryFile()
-
-        # Consume an item
-        self.chunk_sem.acquire()
-        with self.chunk_lock:
-            # If we got woken up, and there is nothing there, maybe it's
-            # because the job has been aborted?  If this is the case,
-            # ensure we return a sensible empty file. (or maybe alternatively
-            # an error).
-            if self.chunk_buffer:
-                tmpf = self.chunk_buffer[0]
-                self.current_chunk += 1
-                self.chunk_buffer = self.chunk_buffer[1:]
+            while True:
+                if chunk is not None:
+                    # Throw away anything the client skipped over.
+                    self.drop_chunks(chunk)
+                if self.chunk_buffer:
+                    index, tmpf = self.chunk_buffer[0]
+                    if chunk is None or index == chunk:
+                        self.chunk_buffer.popleft()
+                    else:
+                        # Couldn't keep that one, see data_callback().
+                        tmpf = tempfile.TemporaryFile()
+                    break
+                # End of transcode check: if the transcode returned not
+                # enough chunks, then send an empty file.  Same if the job
+                # has been aborted.
+                if self.finished or self.in_shutdown:
+                    tmpf = tempfile.TemporaryFile()
+                    break
+                self.chunk_ready.wait()
+            if len(self.chunk_buffer) < self.buffer_high_watermark:
                 self.chunk_throttle.set()
-            else:
-                tmpf = tempfile.TemporaryFile()
         return tmpf
 
+    # At this point: chunk_lock acquired
+    def drop_chunks(self, chunk):
+        # Drop buffered chunks before chunk.
+        while self.chunk_buffer and self.chunk_buffer[0][0] < chunk:
+            index, tmpf = self.chunk_buffer.popleft()
+            tmpf.close()
+        if len(self.chunk_buffer) < self.buffer_high_watermark:
+            self.chunk_throttle.set()
+
+    def fill_cache(self):
+        """Transcode the whole item into the cache, without sending it
+        anywhere.  Used to get items ready before they are asked for.
+        """
+        if self.cache_key is None:
+            # Nowhere to put it.  Open the gate for shutdown().
+            self.transcode_gate.set()
+            return
+        if not self.transcode(background=True):
+            return
+        with self.chunk_lock:
+            while True:
+                self.drop_chunks(self.next_chunk)
+                if self.finished or self.in_shutdown:
+                    break
+                self.chunk_ready.wait()
+        self.shutdown()
+
     # Shutdown the transcode job.  If we quitting, make sure you call this
     # so the segmenter et al have a chance to clean up.
     def shutdown(self):
@@ -546,6 +992,9 @@ class TranscodeObject(object):
         # we end up unblocking it anyway.
         logging.info('TranscodeObject.shutdown')
         self.in_shutdown = True
+        if self.manager:
+            # In case we are still waiting for a slot.
+            self.manager.cancel(self)
         self.transcode_gate.wait()
         try:
             self.ffmpeg_handle.kill()
@@ -580,7 +1029,10 @@ class TranscodeObject(object):
             logging.debug('transcode shutdown: sink join %s', e)
 
         # Ensure we unblock the get_chunk().
-        self.chunk_sem.release()
+        self.end_transcode()
+        # The chunk being written won't be finished now.
+        if self.tmp_path is not None:
+            self.discard_chunk_file()
         logging.info('TranscodeObject sink reaped')
         # Set these last: sink thread relies on it.
         self.ffmpeg_handle = None
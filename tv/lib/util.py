@@ -632,17 +632,20 @@ def call_command(*args, **kwargs):
         ignore_stderr is True, so you don't need to explicitly state
         that, too.
     :param env: dict.  Environment to pass to subprocess.Popen
+    :param close_fds: boolean.  defaults to False.  Passed to
+        subprocess.Popen.
     """
     ignore_stderr = kwargs.pop('ignore_stderr', False)
     return_everything = kwargs.pop('return_everything', False)
     env = kwargs.pop('env', None)
+    close_fds = kwargs.pop('close_fds', False)
 
     if kwargs:
         raise TypeError('extra keyword arguments: %s' % kwargs)
 
     pipe = Popen(args, stdout=subprocess.PIPE,
                  stdin=subprocess.PIPE, stderr=subprocess.PIPE,
-                 env=env)
+                 env=env, close_fds=close_fds)
     stdout, stderr = pipe.communicate()
     if return_everything:
         return (pipe.returncode, stdout, stderr)